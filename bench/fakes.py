@@ -0,0 +1,229 @@
+"""In-process stand-ins for the discord.py objects the message pipeline touches.
+
+Every method that would be a REST call against Discord is counted in `rest_calls`, and replies are
+recorded against the message that triggered them so end-to-end latency can be measured.
+"""
+
+import itertools
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import AsyncIterator
+
+import discord
+
+rest_calls: Counter[str] = Counter()
+
+# the message a scheduled job is handling; set when the message is delivered and carried into the
+# job by the scheduler, so sends can be attributed to it
+current_message: ContextVar["FakeMessage | None"] = ContextVar(
+    "current_message", default=None
+)
+
+_ids = itertools.count(1_000_000)
+
+
+def next_id() -> int:
+    return next(_ids)
+
+
+@dataclass
+class Reply:
+    message_id: int
+    latency: float
+    content: str
+
+
+@dataclass
+class ReplyLog:
+    replies: list[Reply] = field(default_factory=list)
+
+    def record(self, content: str) -> None:
+        if (message := current_message.get()) is None:
+            return
+        self.replies.append(
+            Reply(
+                message_id=message.id,
+                latency=time.perf_counter() - message.delivered_at,
+                content=content,
+            )
+        )
+
+
+reply_log = ReplyLog()
+
+
+class FakeUser:
+    def __init__(self, name: str, bot: bool = False):
+        self.id = next_id()
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+
+class FakeEmoji:
+    def __init__(self, name: str):
+        self.id = next_id()
+        self.name = name
+
+    def __str__(self) -> str:
+        return f"<:{self.name}:{self.id}>"
+
+
+class FakeGuild:
+    def __init__(self, name: str, bot_user: FakeUser, num_emojis: int = 20):
+        self.id = next_id()
+        self.name = name
+        self.bot_member = bot_user
+        self.emojis = tuple(FakeEmoji(f"emoji_{idx}") for idx in range(num_emojis))
+
+    def get_member(self, user_id: int) -> FakeUser | None:
+        return self.bot_member if user_id == self.bot_member.id else None
+
+
+class Typing:
+    async def __aenter__(self) -> None:
+        rest_calls["typing"] += 1
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+class FakeSentMessage:
+    """A message the bot sent."""
+
+    def __init__(self, channel: "FakeChannelMixin", content: str):
+        self.id = next_id()
+        self.channel = channel
+        self.guild = getattr(channel, "guild", None)
+        self.content = content
+
+    async def edit(self, **params) -> "FakeSentMessage":
+        rest_calls["edit"] += 1
+        self.content = params.get("content", self.content)
+        return self
+
+
+class FakeChannelMixin:
+    # messages returned by `history()`, newest first like the real thing
+    backfill: list["FakeMessage"]
+
+    def typing(self) -> Typing:
+        return Typing()
+
+    async def send(self, content: str = "", **params) -> FakeSentMessage:
+        rest_calls["send"] += 1
+        reply_log.record(content)
+        return FakeSentMessage(self, content)
+
+    async def history(
+        self, limit: int | None = 100, before=None, **kwargs
+    ) -> AsyncIterator["FakeMessage"]:
+        rest_calls["history"] += 1
+        messages = [
+            message
+            for message in self.backfill
+            if before is None or message.id < before.id
+        ]
+        for message in messages[:limit]:
+            yield message
+
+
+class FakeTextChannel(FakeChannelMixin):
+    def __init__(self, guild: FakeGuild, name: str):
+        self.id = next_id()
+        self.guild = guild
+        self.name = name
+        self.backfill = []
+
+    def permissions_for(self, member: FakeUser) -> SimpleNamespace:
+        return SimpleNamespace(send_messages=True)
+
+
+class FakeDMChannel(FakeChannelMixin, discord.DMChannel):
+    """Passes the `isinstance(channel, DMChannel)` check in the DM handler."""
+
+    def __init__(self, recipient: FakeUser):
+        # deliberately skips `DMChannel.__init__`, which wants gateway data
+        self.id = next_id()
+        self.recipients = [recipient]  # type: ignore
+        self.backfill = []
+
+
+class FakeAttachment:
+    def __init__(self, url: str):
+        self.id = next_id()
+        self.filename = "image.png"
+        self.content_type = "image/png"
+        self.url = url
+        self.proxy_url = url
+        self.size = 68
+
+
+class FakeMessage:
+    def __init__(
+        self,
+        channel: FakeTextChannel | FakeDMChannel,
+        author: FakeUser,
+        content: str,
+        mentions: list[FakeUser] | None = None,
+        attachments: list[FakeAttachment] | None = None,
+        created_at: datetime | None = None,
+    ):
+        self.id = next_id()
+        self.channel = channel
+        self.guild = getattr(channel, "guild", None)
+        self.author = author
+        self.content = content
+        self.mentions = mentions or []
+        self.attachments = attachments or []
+        self.reference = None
+        self.created_at = created_at or datetime.now(timezone.utc)
+        self.jump_url = f"https://discord.com/channels/bench/{channel.id}/{self.id}"
+        # when the message was handed to the bot, for latency measurements
+        self.delivered_at = 0.0
+
+    async def reply(self, content: str = "", **params) -> FakeSentMessage:
+        rest_calls["reply"] += 1
+        reply_log.record(content)
+        return FakeSentMessage(self.channel, content)
+
+    async def add_reaction(self, emoji) -> None:
+        rest_calls["add_reaction"] += 1
+
+
+def make_backfill(
+    channel: FakeTextChannel | FakeDMChannel,
+    authors: list[FakeUser],
+    count: int,
+    attachment_url: str | None = None,
+    attachment_every: int = 0,
+) -> None:
+    """Give a channel `count` older messages for the history cache to backfill from, optionally
+    with an image attached to every `attachment_every`th one.
+    """
+    now = datetime.now(timezone.utc)
+    messages = []
+    for idx in range(count):
+        attachments = []
+        if attachment_url and attachment_every and idx % attachment_every == 0:
+            attachments.append(FakeAttachment(attachment_url))
+        messages.append(
+            FakeMessage(
+                channel,
+                authors[idx % len(authors)],
+                content=f"earlier message {idx} about nothing in particular",
+                attachments=attachments,
+                created_at=now - timedelta(seconds=30 * (count - idx)),
+            )
+        )
+    channel.backfill = messages[::-1]
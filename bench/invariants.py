@@ -0,0 +1,301 @@
+"""Check the behaviour the pipeline benchmark's numbers depend on, without running a workload.
+
+    python -m bench.invariants
+
+Covers the channel scheduler (coalescing by priority, dropping the oldest waiting job), the OpenAI
+dispatcher (waiting out `retry-after`, shedding background requests when it's backed up), message
+splitting at Discord's 2000 character limit and the image intent gate. Prints each check's result
+and exits non-zero if any failed, so it can be used as a regression check in CI. Nothing here
+talks to Discord or OpenAI.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+from types import SimpleNamespace
+
+import structlog
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+
+async def check_scheduler_coalescing() -> None:
+    """A waiting job is only replaced by a job that's at least as important as it."""
+    from src.messaging.scheduler import ChannelScheduler
+    from src.openai_api.dispatcher import RequestPriority
+
+    scheduler = ChannelScheduler(max_concurrent=1, max_backlog=10)
+    ran = []
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def blocker() -> None:
+        started.set()
+        await release.wait()
+
+    def job(name: str):
+        async def run() -> None:
+            ran.append(name)
+
+        return run
+
+    # holds the only slot, so everything after it waits
+    scheduler.submit(1, blocker)
+    await started.wait()
+
+    scheduler.submit(1, job("mention"), "reply", RequestPriority.DIRECT)
+    scheduler.submit(1, job("random reply"), "reply", RequestPriority.BACKGROUND)
+    scheduler.submit(2, job("random reply"), "reply", RequestPriority.BACKGROUND)
+    scheduler.submit(2, job("later mention"), "reply", RequestPriority.DIRECT)
+    assert scheduler.coalesced == 2, scheduler.stats()
+    assert scheduler.backlog_size == 2, scheduler.stats()
+
+    release.set()
+    while scheduler.workers:
+        await asyncio.sleep(0.01)
+    assert sorted(ran) == ["later mention", "mention"], ran
+
+
+async def check_scheduler_drops_oldest() -> None:
+    """Past `max_backlog` waiting jobs, the oldest waiting job is dropped, not the newest."""
+    from src.messaging.scheduler import ChannelScheduler
+
+    scheduler = ChannelScheduler(max_concurrent=1, max_backlog=2)
+    ran = []
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def blocker() -> None:
+        started.set()
+        await release.wait()
+
+    def job(name: str):
+        async def run() -> None:
+            ran.append(name)
+
+        return run
+
+    scheduler.submit(0, blocker)
+    await started.wait()
+    for channel_id in (1, 2, 3):
+        scheduler.submit(channel_id, job(f"channel {channel_id}"))
+    assert scheduler.dropped == 1, scheduler.stats()
+    assert scheduler.backlog_size == 2, scheduler.stats()
+
+    release.set()
+    while scheduler.workers:
+        await asyncio.sleep(0.01)
+    assert sorted(ran) == ["channel 2", "channel 3"], ran
+
+
+class FakeRawResponse:
+    """What a `.with_raw_response` call returns, as far as the dispatcher is concerned."""
+
+    def __init__(self, headers: dict[str, str] | None = None):
+        self.headers = headers or {}
+
+    def parse(self) -> SimpleNamespace:
+        return SimpleNamespace(usage=None)
+
+
+async def check_dispatcher_retry_after() -> None:
+    """A rate limited request is retried once the API's `retry-after` has passed."""
+    import httpx
+    import openai
+
+    from src.openai_api.dispatcher import OpenAIDispatcher
+
+    dispatcher = OpenAIDispatcher(
+        "invariants", requests_per_minute=60_000, tokens_per_minute=None
+    )
+    retry_after = 0.5
+    attempts = []
+
+    async def request() -> FakeRawResponse:
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            response = httpx.Response(
+                429,
+                headers={"retry-after": str(retry_after)},
+                request=httpx.Request("POST", "http://bench.invalid/v1/chat"),
+            )
+            raise openai.RateLimitError("rate limited", response=response, body=None)
+        return FakeRawResponse()
+
+    await dispatcher.call(request, model="bench-chat")
+    assert len(attempts) == 2, attempts
+    assert dispatcher.retries == 1, dispatcher.stats()
+    waited = attempts[1] - attempts[0]
+    assert waited >= retry_after, f"retried after {waited:.3f}s"
+
+
+async def check_dispatcher_shedding() -> None:
+    """Background requests are shed once the queue is backed up; direct ones still wait."""
+    from src.openai_api.dispatcher import (
+        OpenAIDispatcher,
+        RequestPriority,
+        RequestShedError,
+    )
+    from src.settings import get_settings
+
+    max_depth = get_settings().OPENAI_BACKGROUND_MAX_QUEUE_DEPTH
+    # one request a minute, so everything after the first has to queue
+    dispatcher = OpenAIDispatcher(
+        "invariants", requests_per_minute=1, tokens_per_minute=None
+    )
+
+    async def request() -> FakeRawResponse:
+        return FakeRawResponse()
+
+    await dispatcher.call(request, model="bench-chat")
+    waiting = [
+        asyncio.create_task(
+            dispatcher.call(
+                request, model="bench-chat", priority=RequestPriority.DIRECT
+            )
+        )
+        for _ in range(max_depth)
+    ]
+    try:
+        while dispatcher.queue_depth < max_depth:
+            await asyncio.sleep(0.01)
+
+        try:
+            await dispatcher.call(
+                request, model="bench-chat", priority=RequestPriority.BACKGROUND
+            )
+        except RequestShedError:
+            pass
+        else:
+            raise AssertionError("background request wasn't shed")
+        assert dispatcher.shed == 1, dispatcher.stats()
+
+        direct = asyncio.create_task(
+            dispatcher.call(
+                request, model="bench-chat", priority=RequestPriority.DIRECT
+            )
+        )
+        waiting.append(direct)
+        await asyncio.sleep(0.05)
+        assert not direct.done(), "direct request didn't wait its turn"
+        assert dispatcher.queue_depth == max_depth + 1, dispatcher.stats()
+    finally:
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+    assert dispatcher.queue_depth == 0, dispatcher.stats()
+
+
+async def check_message_splitting() -> None:
+    """Chunks fit in a Discord message, and ones already sent don't change as the text grows."""
+    from src.messaging.streaming import MAX_MESSAGE_LENGTH, split_message_content
+
+    assert MAX_MESSAGE_LENGTH == 2000
+    assert split_message_content("x" * 2000) == ["x" * 2000]
+    # no space or newline to break on
+    assert split_message_content("x" * 2001) == ["x" * 2000, "x"]
+
+    # prefers a newline over a (later) space
+    text = "a" * 1500 + "\n" + "word " * 200
+    chunks = split_message_content(text)
+    assert chunks[0] == "a" * 1500, len(chunks[0])
+
+    text = " ".join(f"word{idx}" for idx in range(2000))
+    chunks = split_message_content(text)
+    assert all(len(chunk) <= 2000 for chunk in chunks), [len(c) for c in chunks]
+    assert " ".join(chunks).split() == text.split()
+    for length in range(1, len(text), 97):
+        partial = split_message_content(text[:length])
+        assert partial[:-1] == chunks[: len(partial) - 1], length
+
+
+async def check_image_intent_gate() -> None:
+    """The gate fires on requests for an image and not on ordinary chat about one."""
+    from src.openai_api.image_intent import image_intent_gate
+
+    def user(content: str) -> dict:
+        return {"role": "user", "content": content}
+
+    fires = [
+        [user("draw me a cat")],
+        [user("can you make a picture of a dog in a hat")],
+        [user("what would a cyberpunk london look like?")],
+        [
+            {"role": "assistant", "content": "want me to draw one for you?"},
+            user("yes please"),
+        ],
+        # summaries of attached images don't count as the last message
+        [user("paint a sunset"), {"role": "system", "content": "an image of a cat"}],
+    ]
+    skips = [
+        [],
+        [user("hello, how are you?")],
+        [user("please don't draw anything, just answer")],
+        [{"role": "assistant", "content": "want me to draw one?"}, user("what?")],
+    ]
+    for messages in fires:
+        fired, score = image_intent_gate(messages)
+        assert fired, f"gate didn't fire ({score:.2f}) on {messages}"
+    for messages in skips:
+        fired, score = image_intent_gate(messages)
+        assert not fired, f"gate fired ({score:.2f}) on {messages}"
+
+
+CHECKS = [
+    check_scheduler_coalescing,
+    check_scheduler_drops_oldest,
+    check_dispatcher_retry_after,
+    check_dispatcher_shedding,
+    check_message_splitting,
+    check_image_intent_gate,
+]
+
+
+async def run_checks() -> int:
+    failed = 0
+    for check in CHECKS:
+        try:
+            await asyncio.wait_for(check(), timeout=30)
+        except Exception:
+            failed += 1
+            print(f"FAIL: {check.__name__}")
+            traceback.print_exc(limit=-1)
+        else:
+            print(f"ok: {check.__name__}")
+    return failed
+
+
+def main() -> int:
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.CRITICAL)
+    )
+    # settings read `initial_prompt.md` and `.env` from the working directory
+    work_dir = tempfile.mkdtemp(prefix="discordgpt-invariants-")
+    prompt_file = REPO_ROOT / "initial_prompt.md"
+    if not prompt_file.exists():
+        prompt_file = REPO_ROOT / "initial_prompt.example.md"
+    shutil.copy(prompt_file, Path(work_dir) / "initial_prompt.md")
+    os.chdir(work_dir)
+    os.environ.update(
+        {
+            "OPENAI_API_KEY": "bench",
+            "DATA_DIR": str(Path(work_dir) / "data"),
+        }
+    )
+    try:
+        failed = asyncio.run(run_checks())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"{len(CHECKS) - failed}/{len(CHECKS)} checks passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""A local stand-in for the OpenAI API, for benchmarking without network calls or API costs.
+
+Only the endpoints the bot uses are implemented (chat completions, with tools, streaming and
+vision; image generation), and responses are canned. Latency and error rates are configurable.
+"""
+
+import asyncio
+import base64
+import json
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from aiohttp import web
+
+# the smallest valid PNG: a single transparent pixel
+PIXEL_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+REPLY_TEXT = (
+    "Sure thing! Here's a reasonably sized reply, long enough to stream in a few chunks and "
+    "take up a realistic number of completion tokens."
+)
+
+
+@dataclass
+class StubConfig:
+    # seconds before a chat completion responds (or starts streaming)
+    chat_latency: float = 0.3
+    image_latency: float = 2.0
+    # +/- this fraction of the latency, uniformly
+    jitter: float = 0.2
+    # fraction of requests that fail with a 500 / 429
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    # chance that an image-intent check asks for an image
+    image_request_rate: float = 0.1
+    # delay between streamed chunks
+    stream_chunk_interval: float = 0.02
+
+
+class OpenAIStub:
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.calls: Counter[str] = Counter()
+        self.errors: Counter[str] = Counter()
+        self.runner: web.AppRunner | None = None
+        self.base_url = ""
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self.errors.clear()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/images/generations", self.image_generations)
+        app.router.add_get("/files/{name}", self.files)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        sockets = site._server.sockets  # type: ignore
+        bound_port = sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{bound_port}"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def file_url(self, name: str) -> str:
+        return f"{self.base_url}/files/{name}"
+
+    async def _delay(self, latency: float) -> None:
+        jitter = latency * self.config.jitter
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+    def _injected_error(self, endpoint: str) -> web.Response | None:
+        roll = random.random()
+        if roll < self.config.rate_limit_rate:
+            self.errors[f"{endpoint}:429"] += 1
+            return web.json_response(
+                {"error": {"message": "stub rate limit", "type": "requests"}},
+                status=429,
+                headers={"retry-after": "0.5"},
+            )
+        if roll < self.config.rate_limit_rate + self.config.error_rate:
+            self.errors[f"{endpoint}:500"] += 1
+            return web.json_response(
+                {"error": {"message": "stub server error", "type": "server_error"}},
+                status=500,
+            )
+        return None
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        kind = self._classify(body)
+        self.calls[kind] += 1
+        await self._delay(self.config.chat_latency)
+        if (error := self._injected_error("chat")) is not None:
+            return error
+
+        if body.get("stream"):
+            return await self._stream(request, body)
+
+        message = self._reply_message(body)
+        prompt_tokens = sum(len(json.dumps(m)) // 4 for m in body["messages"])
+        completion_tokens = len(json.dumps(message)) // 4
+        return web.json_response(
+            {
+                "id": f"chatcmpl-{time.monotonic_ns()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+            headers={
+                "x-ratelimit-remaining-requests": "10000",
+                "x-ratelimit-remaining-tokens": "10000000",
+            },
+        )
+
+    def _classify(self, body: dict) -> str:
+        if tools := body.get("tools"):
+            return "tools:" + ",".join(sorted(t["function"]["name"] for t in tools))
+        for message in body["messages"]:
+            if isinstance(message.get("content"), list):
+                return "vision"
+        return "stream" if body.get("stream") else "completion"
+
+    def _tool_call(self, name: str, arguments: dict) -> dict:
+        return {
+            "id": f"call_{time.monotonic_ns()}",
+            "type": "function",
+            "function": {"name": name, "arguments": json.dumps(arguments)},
+        }
+
+    def _reply_message(self, body: dict) -> dict:
+        tools = {t["function"]["name"] for t in body.get("tools") or []}
+        if not tools:
+            if self._classify(body) == "vision":
+                summary = "A single transparent pixel."
+                if body.get("response_format", {}).get("type") == "json_object":
+                    # a batch of images, summarized together
+                    num_images = sum(
+                        part.get("type") == "image_url"
+                        for part in body["messages"][-1]["content"]
+                    )
+                    summary = json.dumps({"summaries": [summary] * num_images})
+                return {"role": "assistant", "content": summary}
+            return {"role": "assistant", "content": REPLY_TEXT}
+
+        tool_choice = body.get("tool_choice")
+        if isinstance(tool_choice, dict):
+            tools = {tool_choice["function"]["name"]}
+
+        tool_calls = []
+        if "generate_message_reaction" in tools:
+            tool_calls.append(
+                self._tool_call(
+                    "generate_message_reaction",
+                    {"emojis": ["👍"], "reasoning": "benchmark"},
+                )
+            )
+        wants_image = (
+            isinstance(tool_choice, dict)
+            or random.random() < self.config.image_request_rate
+        )
+        if "generate_image" in tools and wants_image:
+            tool_calls.append(
+                self._tool_call(
+                    "generate_image", {"prompt": "a benchmark", "style": "natural"}
+                )
+            )
+        if "generate_text_response" in tools:
+            tool_calls.append(
+                self._tool_call("generate_text_response", {"response_text": REPLY_TEXT})
+            )
+        return {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": tool_calls or None,
+        }
+
+    async def _stream(self, request: web.Request, body: dict) -> web.StreamResponse:
+        response = web.StreamResponse(
+            headers={
+                "content-type": "text/event-stream",
+                "x-ratelimit-remaining-requests": "10000",
+                "x-ratelimit-remaining-tokens": "10000000",
+            }
+        )
+        await response.prepare(request)
+        words = REPLY_TEXT.split(" ")
+        for idx, word in enumerate(words):
+            chunk = {
+                "id": "chatcmpl-stream",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word if idx == 0 else f" {word}"},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.config.stream_chunk_interval)
+        if body.get("stream_options", {}).get("include_usage"):
+            prompt_tokens = sum(len(json.dumps(m)) // 4 for m in body["messages"])
+            completion_tokens = len(REPLY_TEXT) // 4
+            usage_chunk = {
+                "id": "chatcmpl-stream",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }
+            await response.write(f"data: {json.dumps(usage_chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def image_generations(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.calls["image"] += 1
+        await self._delay(self.config.image_latency)
+        if (error := self._injected_error("image")) is not None:
+            return error
+
+        image: dict = {"revised_prompt": body["prompt"]}
+        if body.get("response_format") == "b64_json":
+            image["b64_json"] = base64.b64encode(PIXEL_PNG).decode()
+        else:
+            image["url"] = self.file_url(f"generated-{self.calls['image']}.png")
+        return web.json_response({"created": int(time.time()), "data": [image]})
+
+    async def files(self, request: web.Request) -> web.Response:
+        self.calls["file download"] += 1
+        return web.Response(body=PIXEL_PNG, content_type="image/png")
@@ -0,0 +1,375 @@
+"""Benchmark the message pipeline end to end, with fake Discord objects and a local OpenAI stub.
+
+    python -m bench.pipeline --workload all
+    python -m bench.pipeline --workload mention_storm --messages 200 --chat-latency 0.5 --json out.json
+
+Reports reply latency percentiles (from a message being delivered to the reply being sent), model
+calls per message and Discord REST calls per message, so runs can be compared across changes.
+Nothing here talks to Discord or OpenAI.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import structlog
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from bench import fakes  # noqa: E402
+from bench.openai_stub import OpenAIStub, StubConfig  # noqa: E402
+
+
+@dataclass
+class WorkloadResult:
+    workload: str
+    messages: int
+    replies: int
+    duration_seconds: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    model_calls_per_message: float
+    rest_calls_per_message: float
+    model_calls: dict[str, int]
+    rest_calls: dict[str, int]
+    # attachment/generated image downloads (from the CDN, not the API)
+    downloads: int
+    errors_injected: dict[str, int]
+    scheduler: dict[str, int]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(pct) - 1]
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace, stub: OpenAIStub):
+        self.args = args
+        self.stub = stub
+
+        # imported late: settings are read from the environment on import
+        from src.client import client
+        from src.messaging.direct_message_channel import handle_direct_message
+        from src.messaging.history import history_cache
+        from src.messaging.main import pending_image_edits, pending_reactions
+        from src.messaging.scheduler import scheduler
+        from src.messaging.text_channel import handle_text_channel_message
+
+        self.client = client
+        self.scheduler = scheduler
+        self.history_cache = history_cache
+        self.pending_image_edits = pending_image_edits
+        self.pending_reactions = pending_reactions
+        self.handle_text_channel_message = handle_text_channel_message
+        self.handle_direct_message = handle_direct_message
+
+        self.bot_user = fakes.FakeUser("benchbot", bot=True)
+        # what `client.user` returns; normally set when logging in
+        client._connection.user = self.bot_user  # type: ignore
+        self.users = [fakes.FakeUser(f"user{idx}") for idx in range(20)]
+
+    async def deliver(
+        self,
+        message: fakes.FakeMessage,
+        handler: Callable[[fakes.FakeMessage], Awaitable[None]],
+    ) -> None:
+        fakes.current_message.set(message)
+        message.delivered_at = time.perf_counter()
+        # what `on_message` does before handing the message off
+        self.history_cache.add(message)  # type: ignore
+        await handler(message)  # type: ignore
+
+    async def drain(self) -> None:
+        """Wait until every scheduled job has finished, along with any generated images that are
+        still to be attached to replies that were already sent and any reactions still running.
+        """
+        while (
+            self.scheduler.workers or self.pending_image_edits or self.pending_reactions
+        ):
+            await asyncio.sleep(0.05)
+
+    def mention(self, channel, author: fakes.FakeUser) -> fakes.FakeMessage:
+        return fakes.FakeMessage(
+            channel,
+            author,
+            content=f"hey @{self.bot_user.name}, what do you think about this?",
+            mentions=[self.bot_user],
+        )
+
+    async def arrive(self, deliveries: list[Awaitable[None]]) -> None:
+        """Deliver messages spread out over `--arrival-window` seconds."""
+        tasks = []
+        for delivery in deliveries:
+            tasks.append(asyncio.create_task(delivery))  # type: ignore
+            if self.args.arrival_window:
+                await asyncio.sleep(self.args.arrival_window / len(deliveries))
+        await asyncio.gather(*tasks)
+
+    async def mention_storm(self) -> int:
+        """Lots of mentions in a single busy channel."""
+        guild = fakes.FakeGuild("storm", self.bot_user)
+        channel = fakes.FakeTextChannel(guild, "general")
+        fakes.make_backfill(channel, self.users, 50)
+        messages = [
+            self.mention(channel, random.choice(self.users))
+            for _ in range(self.args.messages)
+        ]
+        await self.arrive(
+            [self.deliver(m, self.handle_text_channel_message) for m in messages]
+        )
+        return len(messages)
+
+    async def image_history(self) -> int:
+        """Mentions in channels whose history is full of image attachments."""
+        guild = fakes.FakeGuild("gallery", self.bot_user)
+        channels = [
+            fakes.FakeTextChannel(guild, f"images-{idx}")
+            for idx in range(max(1, self.args.channels // 4))
+        ]
+        for channel in channels:
+            fakes.make_backfill(
+                channel,
+                self.users,
+                50,
+                attachment_url=self.stub.file_url("attachment.png"),
+                attachment_every=3,
+            )
+        messages = [
+            self.mention(channels[idx % len(channels)], random.choice(self.users))
+            for idx in range(self.args.messages)
+        ]
+        await self.arrive(
+            [self.deliver(m, self.handle_text_channel_message) for m in messages]
+        )
+        return len(messages)
+
+    async def many_channels(self) -> int:
+        """Mentions spread over many channels (and servers), plus DMs."""
+        guilds = [
+            fakes.FakeGuild(f"server-{idx}", self.bot_user)
+            for idx in range(max(1, self.args.channels // 10))
+        ]
+        channels: list = [
+            fakes.FakeTextChannel(guilds[idx % len(guilds)], f"channel-{idx}")
+            for idx in range(self.args.channels)
+        ]
+        for channel in channels:
+            fakes.make_backfill(channel, self.users, 20)
+        dm_channels = [fakes.FakeDMChannel(user) for user in self.users[:5]]
+
+        deliveries = []
+        for idx in range(self.args.messages):
+            if idx % 10 == 0:
+                dm_channel = dm_channels[idx % len(dm_channels)]
+                message = fakes.FakeMessage(
+                    dm_channel, dm_channel.recipients[0], content="hello there"
+                )
+                deliveries.append(self.deliver(message, self.handle_direct_message))
+                continue
+            message = self.mention(
+                channels[idx % len(channels)], random.choice(self.users)
+            )
+            deliveries.append(self.deliver(message, self.handle_text_channel_message))
+        await self.arrive(deliveries)
+        return len(deliveries)
+
+    async def run(self, workload: str) -> WorkloadResult:
+        fakes.rest_calls.clear()
+        fakes.reply_log.replies.clear()
+        self.stub.reset()
+        scheduler_before = self.scheduler.stats()
+
+        started_at = time.perf_counter()
+        num_messages = await getattr(self, workload)()
+        await self.drain()
+        duration = time.perf_counter() - started_at
+
+        latencies = [reply.latency * 1000 for reply in fakes.reply_log.replies]
+        model_calls = {
+            kind: count
+            for kind, count in self.stub.calls.items()
+            if kind != "file download"
+        }
+        scheduler_after = self.scheduler.stats()
+        return WorkloadResult(
+            workload=workload,
+            messages=num_messages,
+            # coalesced messages share a reply, so this can be lower than `messages`
+            replies=len(fakes.reply_log.replies),
+            duration_seconds=round(duration, 3),
+            p50_ms=round(percentile(latencies, 50), 1),
+            p95_ms=round(percentile(latencies, 95), 1),
+            p99_ms=round(percentile(latencies, 99), 1),
+            model_calls_per_message=round(sum(model_calls.values()) / num_messages, 3),
+            rest_calls_per_message=round(
+                sum(fakes.rest_calls.values()) / num_messages, 3
+            ),
+            model_calls=dict(sorted(model_calls.items())),
+            rest_calls=dict(sorted(fakes.rest_calls.items())),
+            downloads=self.stub.calls["file download"],
+            errors_injected=dict(self.stub.errors),
+            scheduler={
+                stat: scheduler_after[stat] - scheduler_before.get(stat, 0)
+                for stat in ("coalesced", "dropped")
+            },
+        )
+
+
+WORKLOADS = ["mention_storm", "image_history", "many_channels"]
+
+
+def configure_environment(args: argparse.Namespace, base_url: str, data_dir: str):
+    """Point the bot at the stub, with settings that don't depend on a local `.env`."""
+    os.environ.update(
+        {
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": f"{base_url}/v1",
+            "OPENAI_MODEL": "bench-chat",
+            "OPENAI_VISION_MODEL": "bench-vision",
+            "OPENAI_IMAGE_GEN_MODEL": "bench-image",
+            "DISCORD_BOT_NAME": "benchbot",
+            "DATA_DIR": data_dir,
+            "RANDOM_REPLY_CHANCE": "0",
+            "RANDOM_REACTION_CHANCE": str(args.reaction_chance),
+            "OPENAI_TOOL_ROUTING_MODE": args.routing_mode,
+            "OPENAI_STREAM_RESPONSES": str(args.stream).lower(),
+            "OPENAI_REQUESTS_PER_MINUTE": "1000000",
+            "OPENAI_TOKENS_PER_MINUTE": "1000000000",
+            "OPENAI_IMAGES_PER_MINUTE": "100000",
+            "OPENAI_RETRY_BASE_DELAY_SECONDS": "0.1",
+            "STREAM_EDIT_INTERVAL_SECONDS": "0.2",
+        }
+    )
+
+
+def print_results(results: list[WorkloadResult]) -> None:
+    columns = [
+        ("workload", 14),
+        ("messages", 9),
+        ("replies", 8),
+        ("duration_seconds", 10),
+        ("p50_ms", 9),
+        ("p95_ms", 9),
+        ("p99_ms", 9),
+        ("model_calls_per_message", 12),
+        ("rest_calls_per_message", 12),
+    ]
+    headers = [
+        "workload",
+        "messages",
+        "replies",
+        "secs",
+        "p50 ms",
+        "p95 ms",
+        "p99 ms",
+        "model/msg",
+        "rest/msg",
+    ]
+    print(" ".join(h.rjust(w) for h, (_, w) in zip(headers, columns)))
+    for result in results:
+        row = asdict(result)
+        print(" ".join(str(row[name]).rjust(width) for name, width in columns))
+    for result in results:
+        print(f"\n{result.workload}:")
+        print(f"  model calls: {result.model_calls}")
+        print(f"  REST calls:  {result.rest_calls}")
+        print(f"  downloads:   {result.downloads}")
+        print(f"  scheduler:   {result.scheduler}")
+        if result.errors_injected:
+            print(f"  injected errors: {result.errors_injected}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--workload", choices=[*WORKLOADS, "all"], default="all", help="what to run"
+    )
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--channels", type=int, default=40)
+    parser.add_argument(
+        "--arrival-window",
+        type=float,
+        default=2.0,
+        help="spread message arrivals over this many seconds (0 = all at once)",
+    )
+    parser.add_argument("--chat-latency", type=float, default=0.3)
+    parser.add_argument("--image-latency", type=float, default=2.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--image-request-rate", type=float, default=0.1)
+    parser.add_argument("--reaction-chance", type=float, default=0.3)
+    parser.add_argument("--routing-mode", choices=["multi", "unified"], default="multi")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="error", help="bot log level")
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> list[WorkloadResult]:
+    random.seed(args.seed)
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(
+            logging.getLevelName(args.log_level.upper())
+        )
+    )
+    stub = OpenAIStub(
+        StubConfig(
+            chat_latency=args.chat_latency,
+            image_latency=args.image_latency,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            image_request_rate=args.image_request_rate,
+        )
+    )
+    base_url = await stub.start()
+
+    # settings read `initial_prompt.md` and `.env` from the working directory, so run from a
+    # scratch directory to keep the real ones (and their API keys) out of it
+    work_dir = tempfile.mkdtemp(prefix="discordgpt-bench-")
+    prompt_file = REPO_ROOT / "initial_prompt.md"
+    if not prompt_file.exists():
+        prompt_file = REPO_ROOT / "initial_prompt.example.md"
+    shutil.copy(prompt_file, Path(work_dir) / "initial_prompt.md")
+    os.chdir(work_dir)
+    configure_environment(args, base_url, str(Path(work_dir) / "data"))
+
+    bench = Bench(args, stub)
+    workloads = WORKLOADS if args.workload == "all" else [args.workload]
+    results = []
+    try:
+        for workload in workloads:
+            results.append(await bench.run(workload))
+    finally:
+        await bench.client.close()
+        await stub.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.json:
+        # the benchmark runs from a scratch directory
+        args.json = args.json.resolve()
+    results = asyncio.run(main(args))
+    print_results(results)
+    if args.json:
+        args.json.write_text(json.dumps([asdict(r) for r in results], indent=2))
@@ -0,0 +1,128 @@
+"""Check how long a cold `import src.app` takes, against a budget.
+
+    python -m bench.startup
+    python -m bench.startup --runs 10 --budget-ms 800 --top 15
+
+Each run imports the bot in a fresh interpreter (so nothing is cached in `sys.modules`), from a
+scratch directory so the real `.env` isn't read. Reports the median import time and the modules
+that took longest, and exits non-zero if the median is over budget or if a module that's meant to
+be loaded lazily got imported at startup, so it can be used as a regression check in CI.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+# only loaded on first use (or in the background once logged in), never during startup
+LAZY_MODULES = ["openai", "aiohttp.web"]
+
+CHILD_SCRIPT = f"""
+import json, sys, time
+started_at = time.perf_counter()
+import src.app
+seconds = time.perf_counter() - started_at
+lazy_loaded = [name for name in {LAZY_MODULES!r} if name in sys.modules]
+print(json.dumps({{"seconds": seconds, "lazy_loaded": lazy_loaded}}))
+"""
+
+
+def parse_importtime(stderr: str) -> dict[str, float]:
+    """Self time (in seconds) per module from `python -X importtime` output."""
+    self_times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line.removeprefix("import time:").split("|")
+        self_times[name.strip()] = int(self_us) / 1_000_000
+    return self_times
+
+
+def import_once(work_dir: str) -> tuple[dict, dict[str, float]]:
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(REPO_ROOT),
+        "DATA_DIR": str(Path(work_dir) / "data"),
+    }
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD_SCRIPT],
+        cwd=work_dir,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1]), parse_importtime(
+        result.stderr
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=1000.0,
+        help="fail if the median import time is over this",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="how many of the slowest modules to list"
+    )
+    return parser.parse_args()
+
+
+def main(args: argparse.Namespace) -> int:
+    # settings read `initial_prompt.md` from the working directory
+    work_dir = tempfile.mkdtemp(prefix="discordgpt-startup-")
+    prompt_file = REPO_ROOT / "initial_prompt.md"
+    if not prompt_file.exists():
+        prompt_file = REPO_ROOT / "initial_prompt.example.md"
+    shutil.copy(prompt_file, Path(work_dir) / "initial_prompt.md")
+
+    durations = []
+    lazy_loaded: set[str] = set()
+    module_times: dict[str, list[float]] = defaultdict(list)
+    try:
+        for _ in range(args.runs):
+            result, self_times = import_once(work_dir)
+            durations.append(result["seconds"])
+            lazy_loaded.update(result["lazy_loaded"])
+            for name, seconds in self_times.items():
+                module_times[name].append(seconds)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    median_ms = statistics.median(durations) * 1000
+    print(
+        f"import src.app: median {median_ms:.0f}ms over {args.runs} run(s) "
+        f"(min {min(durations) * 1000:.0f}ms, max {max(durations) * 1000:.0f}ms, "
+        f"budget {args.budget_ms:.0f}ms)"
+    )
+    print("slowest modules (median self time):")
+    slowest = sorted(
+        module_times.items(), key=lambda item: statistics.median(item[1]), reverse=True
+    )
+    for name, times in slowest[: args.top]:
+        print(f"  {statistics.median(times) * 1000:7.1f}ms  {name}")
+
+    failed = False
+    if median_ms > args.budget_ms:
+        print(f"FAIL: median import time is over the {args.budget_ms:.0f}ms budget")
+        failed = True
+    if lazy_loaded:
+        print(f"FAIL: imported at startup but meant to be lazy: {sorted(lazy_loaded)}")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -1,11 +1,29 @@
+from typing import Sequence
+
 import structlog
-from discord import DMChannel, Message, RawReactionActionEvent, TextChannel
+from discord import (
+    DMChannel,
+    Emoji,
+    Guild,
+    Message,
+    RawBulkMessageDeleteEvent,
+    RawMessageDeleteEvent,
+    RawMessageUpdateEvent,
+    RawReactionActionEvent,
+    TextChannel,
+)
 
 from src.client import client
 from src.feedback import handle_reaction
+from src.log_config import configure_logging
 from src.messaging.direct_message_channel import handle_direct_message
+from src.messaging.emojis import emoji_index
+from src.messaging.history import history_cache
+from src.messaging.sent_messages import sent_message_index
 from src.messaging.text_channel import handle_text_channel_message
+from src.openai_api.tokens import warn_if_estimating_tokens
 from src.settings import get_settings
+from src.startup import startup_timer
 
 logger = structlog.get_logger()
 settings = get_settings()
@@ -32,12 +50,43 @@ async def on_ready():
     # some other user's id
     settings.CLIENT_USER_ID = client.user.id
 
+    # index server emojis up front so reactions don't need to fetch them
+    for guild in client.guilds:
+        emoji_index.update_guild(guild)
+
+    await sent_message_index.load()
+
+    if not startup_timer.reported:
+        startup_timer.mark("ready")
+        startup_timer.report()
+
+
+@client.event
+async def on_guild_join(guild: Guild):
+    emoji_index.update_guild(guild)
+
+
+@client.event
+async def on_guild_remove(guild: Guild):
+    emoji_index.remove_guild(guild)
+
+
+@client.event
+async def on_guild_emojis_update(
+    guild: Guild, before: Sequence[Emoji], after: Sequence[Emoji]
+):
+    emoji_index.update_guild(guild, after)
+
 
 @client.event
 async def on_message(message: Message):
     if not client.user:
         # ignore messages before the bot is ready
         return
+
+    # keep the channel history cache up to date with every message we see, including our own
+    history_cache.add(message)
+
     if message.author == client.user:
         # ignore messages from self
         return
@@ -57,26 +106,56 @@ async def on_message(message: Message):
         )
 
 
+# the raw events fire for every message, not just ones still in discord.py's own message cache
+# (which doesn't have anything the history cache backfilled over REST)
+@client.event
+async def on_raw_message_edit(payload: RawMessageUpdateEvent):
+    history_cache.edit(payload.channel_id, payload.message_id, payload.data)
+
+
+@client.event
+async def on_raw_message_delete(payload: RawMessageDeleteEvent):
+    history_cache.delete(payload.channel_id, payload.message_id)
+
+
+@client.event
+async def on_raw_bulk_message_delete(payload: RawBulkMessageDeleteEvent):
+    for message_id in payload.message_ids:
+        history_cache.delete(payload.channel_id, message_id)
+
+
 @client.event
 async def on_raw_reaction_add(reaction_event: RawReactionActionEvent):
     if not reaction_event.member:
         return
 
-    channel = client.get_channel(reaction_event.channel_id)
-    if not isinstance(channel, (DMChannel, TextChannel)):
-        logger.warning(
-            f"ignoring reaction event from unknown channel type: {type(channel)}"
-        )
+    if (sent := sent_message_index.get(reaction_event.message_id)) is None:
+        # we get reaction add events for all messages, not just ones applied to our bot's messages
         return
 
-    message = await channel.fetch_message(reaction_event.message_id)
-    if not message.author == client.user:
-        # we get reaction add events for all messages, not just ones applied to our bot's messages
+    if reaction_event.emoji.name not in (
+        *settings.POSITIVE_FEEDBACK_EMOJIS,
+        *settings.NEGATIVE_FEEDBACK_EMOJIS,
+    ):
         return
 
-    set_log_contextvars(message)
+    # everything feedback needs is in the event and the sent message record, so the message
+    # itself is never fetched
+    structlog.contextvars.bind_contextvars(reactor=reaction_event.member.name)
+    if server_name := getattr(reaction_event.member.guild, "name", None):
+        structlog.contextvars.bind_contextvars(server=server_name)
+    if channel_name := getattr(
+        client.get_channel(reaction_event.channel_id), "name", None
+    ):
+        structlog.contextvars.bind_contextvars(channel=channel_name)
     logger.debug("received emoji for message", emoji=reaction_event.emoji)
-    await handle_reaction(message, reaction_event)
+    await handle_reaction(reaction_event, sent)
 
 
-client.run(settings.DISCORD_BOT_TOKEN.get_secret_value())
+if __name__ == "__main__":
+    configure_logging()
+    startup_timer.mark("import")
+    warn_if_estimating_tokens()
+    # discord.py's own log output goes through our (non-blocking) handler instead of the one it
+    # would otherwise install
+    client.run(settings.DISCORD_BOT_TOKEN.get_secret_value(), log_handler=None)
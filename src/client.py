@@ -1,10 +1,52 @@
-from discord import Client, Intents
+import asyncio
+
+from discord import AutoShardedClient, Client, Intents
+
+from src.feedback_store import feedback_store
+from src.http_session import close_http_session
+from src.metrics import metrics_server
+from src.openai_api.client import close_openai_client
+from src.settings import get_settings, get_settings_provider
+from src.startup import preload_modules, startup_timer
+
+settings = get_settings()
+
+
+class DiscordGPTClient(AutoShardedClient):
+    async def setup_hook(self) -> None:
+        # runs inside `client.run`, once the event loop is up and we've logged in, before
+        # connecting to the gateway
+        startup_timer.mark("login")
+        self.preload_task = asyncio.create_task(preload_modules())
+        get_settings_provider().start()
+        if settings.METRICS_ENABLED:
+            await metrics_server.start()
+
+    async def close(self) -> None:
+        await get_settings_provider().stop()
+        await metrics_server.stop()
+        # release pooled connections before the event loop goes away
+        await close_openai_client()
+        await close_http_session()
+        await feedback_store.close()
+        if self.shards:
+            await super().close()
+        else:
+            # `AutoShardedClient.close` assumes the shards were launched, which isn't the case
+            # after a failed login (or in the benchmark, which never connects)
+            await Client.close(self)
 
 
 def create_client() -> Client:
     intents = Intents.default()
     intents.message_content = True
-    return Client(intents=intents)
+    # sharding only kicks in once the bot is in enough servers to need it (Discord recommends a
+    # single shard below ~1000), so this costs nothing for small deployments
+    return DiscordGPTClient(
+        intents=intents,
+        shard_count=settings.DISCORD_SHARD_COUNT,
+        shard_ids=settings.DISCORD_SHARD_IDS,  # type: ignore
+    )
 
 
 client: Client = create_client()
@@ -1,29 +1,66 @@
+import time
+
 import structlog
-from discord import Message, RawReactionActionEvent
+from discord import RawReactionActionEvent
 
+from src.feedback_store import FeedbackRow, feedback_store
+from src.messaging.sent_messages import SentMessage
 from src.settings import get_settings
 
 logger = structlog.get_logger()
 settings = get_settings()
 
 
+def message_jump_url(guild_id: int | None, channel_id: int, message_id: int) -> str:
+    """Same as `Message.jump_url`, without needing the message itself."""
+    return f"https://discord.com/channels/{guild_id or '@me'}/{channel_id}/{message_id}"
+
+
 async def handle_reaction(
-    message: Message, reaction_event: RawReactionActionEvent
+    reaction_event: RawReactionActionEvent, sent: SentMessage
 ) -> None:
-    structlog.contextvars.bind_contextvars(message_url=message.jump_url)
+    structlog.contextvars.bind_contextvars(
+        message_url=message_jump_url(
+            sent.guild_id, sent.channel_id, reaction_event.message_id
+        )
+    )
 
     if reaction_event.emoji.name in settings.POSITIVE_FEEDBACK_EMOJIS:
-        return await on_positive_feedback(message)
+        return await on_positive_feedback(reaction_event, sent)
 
     if reaction_event.emoji.name in settings.NEGATIVE_FEEDBACK_EMOJIS:
-        return await on_negative_feedback(message)
+        return await on_negative_feedback(reaction_event, sent)
 
 
-async def on_positive_feedback(message: Message) -> None:
+async def on_positive_feedback(
+    reaction_event: RawReactionActionEvent, sent: SentMessage
+) -> None:
     """Handle a positive feedback message."""
     logger.info("positive feedback received! 😁")
+    record_feedback(reaction_event, sent, polarity=1)
 
 
-async def on_negative_feedback(message: Message) -> None:
+async def on_negative_feedback(
+    reaction_event: RawReactionActionEvent, sent: SentMessage
+) -> None:
     """Handle a negative feedback message."""
     logger.info("negative feedback received 😢")
+    record_feedback(reaction_event, sent, polarity=-1)
+
+
+def record_feedback(
+    reaction_event: RawReactionActionEvent, sent: SentMessage, polarity: int
+) -> None:
+    feedback_store.record(
+        FeedbackRow(
+            message_id=reaction_event.message_id,
+            guild_id=sent.guild_id,
+            channel_id=sent.channel_id,
+            user_id=reaction_event.user_id,
+            emoji=str(reaction_event.emoji),
+            polarity=polarity,
+            model=sent.model,
+            prompt_tokens=sent.prompt_tokens,
+            created_at=time.time(),
+        )
+    )
@@ -0,0 +1,208 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from dataclasses import astuple, dataclass
+from pathlib import Path
+from typing import Literal
+
+import structlog
+
+from src.settings import get_settings
+from src.storage import connect_shared_db
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+# how feedback can be grouped in `FeedbackStore.approval_rates`
+FeedbackGrouping = Literal["model", "channel", "guild", "day"]
+
+GROUPING_COLUMNS: dict[str, str] = {
+    "model": "model",
+    "channel": "channel_id",
+    "guild": "guild_id",
+    "day": "date(created_at, 'unixepoch')",
+}
+
+
+@dataclass
+class FeedbackRow:
+    message_id: int
+    guild_id: int | None
+    channel_id: int
+    user_id: int
+    emoji: str
+    # 1 for positive feedback, -1 for negative
+    polarity: int
+    model: str
+    prompt_tokens: int
+    created_at: float
+
+
+@dataclass
+class ApprovalRate:
+    group: str | int | None
+    positive: int
+    negative: int
+
+    @property
+    def total(self) -> int:
+        return self.positive + self.negative
+
+    @property
+    def approval_rate(self) -> float:
+        return self.positive / self.total if self.total else 0.0
+
+
+class FeedbackStore:
+    """Feedback reactions on the bot's messages, stored in SQLite.
+
+    Reactions are queued and written in batches from a background task, so a burst of reactions
+    doesn't mean a burst of disk writes on the event loop.
+    """
+
+    def __init__(self, db_path: str, batch_size: int, flush_interval: float):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.queue: asyncio.Queue[FeedbackRow] = asyncio.Queue()
+        # rows taken off the queue for the batch currently being gathered
+        self.batch: list[FeedbackRow] = []
+        self._writer_task: asyncio.Task | None = None
+
+        self.written = 0
+        self.write_errors = 0
+
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        # aggregate queries get their own connection so they can run alongside a batch write
+        self._read_db: sqlite3.Connection | None = None
+        self._read_db_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect_shared_db(self.db_path)
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS feedback ("
+                "message_id INTEGER NOT NULL, guild_id INTEGER, channel_id INTEGER NOT NULL, "
+                "user_id INTEGER NOT NULL, emoji TEXT NOT NULL, polarity INTEGER NOT NULL, "
+                "model TEXT NOT NULL, prompt_tokens INTEGER NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (message_id, user_id, emoji))"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS feedback_created_at ON feedback (created_at)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS feedback_guild_created_at "
+                "ON feedback (guild_id, created_at)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _connect_reader(self) -> sqlite3.Connection:
+        if self._read_db is None:
+            with self._db_lock:
+                # make sure the schema exists first
+                self._connect()
+            self._read_db = connect_shared_db(self.db_path)
+        return self._read_db
+
+    def _write_disk(self, rows: list[FeedbackRow]) -> None:
+        with self._db_lock:
+            db = self._connect()
+            # the same person adding the same reaction again isn't new feedback
+            db.executemany(
+                "INSERT OR IGNORE INTO feedback (message_id, guild_id, channel_id, user_id, "
+                "emoji, polarity, model, prompt_tokens, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [astuple(row) for row in rows],
+            )
+            db.commit()
+
+    def record(self, row: FeedbackRow) -> None:
+        """Queue a feedback row to be written with the next batch."""
+        self.queue.put_nowait(row)
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.create_task(self._write_batches())
+
+    async def _gather_batch(self) -> None:
+        self.batch.append(await self.queue.get())
+        # give a burst of reactions a moment to arrive so they're written together
+        deadline = time.monotonic() + self.flush_interval
+        while len(self.batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                async with asyncio.timeout(remaining):
+                    self.batch.append(await self.queue.get())
+            except TimeoutError:
+                break
+
+    async def _write_batches(self) -> None:
+        while True:
+            await self._gather_batch()
+            batch, self.batch = self.batch, []
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[FeedbackRow]) -> None:
+        try:
+            await asyncio.to_thread(self._write_disk, batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.write_errors += len(batch)
+            logger.error(f"error saving {len(batch)} feedback row(s): {e}")
+
+    async def close(self) -> None:
+        """Stop the writer and write out anything still queued."""
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+        batch, self.batch = self.batch, []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self._flush(batch)
+
+    def _query_approval_rates(
+        self,
+        group_by: FeedbackGrouping,
+        since: float | None,
+        guild_id: int | None,
+    ) -> list[ApprovalRate]:
+        column = GROUPING_COLUMNS[group_by]
+        conditions = ["created_at >= ?"]
+        params: list = [since or 0.0]
+        if guild_id is not None:
+            conditions.append("guild_id = ?")
+            params.append(guild_id)
+        with self._read_db_lock:
+            db = self._connect_reader()
+            rows = db.execute(
+                f"SELECT {column}, SUM(polarity > 0), SUM(polarity < 0) FROM feedback "
+                f"WHERE {' AND '.join(conditions)} GROUP BY 1 ORDER BY 1",
+                params,
+            ).fetchall()
+        return [ApprovalRate(*row) for row in rows]
+
+    async def approval_rates(
+        self,
+        group_by: FeedbackGrouping = "model",
+        since: float | None = None,
+        guild_id: int | None = None,
+    ) -> list[ApprovalRate]:
+        """Positive/negative feedback counts grouped by model, channel, guild or (UTC) day,
+        optionally limited to feedback after `since` (a unix timestamp) and to a single guild.
+        """
+        return await asyncio.to_thread(
+            self._query_approval_rates, group_by, since, guild_id
+        )
+
+
+feedback_store = FeedbackStore(
+    db_path=str(Path(settings.DATA_DIR) / "feedback.sqlite3"),
+    batch_size=settings.FEEDBACK_BATCH_SIZE,
+    flush_interval=settings.FEEDBACK_FLUSH_INTERVAL_SECONDS,
+)
@@ -0,0 +1,143 @@
+import json
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Literal
+
+import structlog
+from discord import Guild
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+
+from src.settings import get_settings, get_settings_provider
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+
+class GuildOverrides(BaseModel):
+    """Settings a single server can override, as written in `GUILD_SETTINGS_FILE`. Anything left
+    out falls back to the global settings.
+    """
+
+    model_config = ConfigDict(extra="forbid")
+
+    OPENAI_MODEL: str | None = None
+    OPENAI_STARTING_PROMPT: str | None = None
+    RANDOM_REPLY_CHANCE: float | None = None
+    RANDOM_REACTION_CHANCE: float | None = None
+    OPENAI_TOOL_ROUTING_MODE: Literal["multi", "unified"] | None = None
+    OPENAI_STREAM_RESPONSES: bool | None = None
+    IGNORE_SENDER_NAMES: list[str] | None = None
+
+    @field_validator("OPENAI_STARTING_PROMPT", mode="before")
+    @classmethod
+    def validate_OPENAI_STARTING_PROMPT(cls, v: str | list[str] | None) -> str | None:
+        # long prompts are easier to write as a list of lines
+        if isinstance(v, list):
+            v = "\n".join(v)
+        return v.strip() if v is not None else None
+
+
+@dataclass(frozen=True)
+class GuildSettings:
+    """The effective settings for one server (or for DMs), with overrides already applied."""
+
+    OPENAI_MODEL: str
+    OPENAI_STARTING_PROMPT: str
+    RANDOM_REPLY_CHANCE: float
+    RANDOM_REACTION_CHANCE: float
+    OPENAI_TOOL_ROUTING_MODE: Literal["multi", "unified"]
+    OPENAI_STREAM_RESPONSES: bool
+    IGNORE_SENDER_NAMES: list[str]
+
+    @classmethod
+    def from_settings(cls) -> "GuildSettings":
+        return cls(
+            OPENAI_MODEL=settings.OPENAI_MODEL,
+            OPENAI_STARTING_PROMPT=settings.OPENAI_STARTING_PROMPT,  # type: ignore
+            RANDOM_REPLY_CHANCE=settings.RANDOM_REPLY_CHANCE,
+            RANDOM_REACTION_CHANCE=settings.RANDOM_REACTION_CHANCE,
+            OPENAI_TOOL_ROUTING_MODE=settings.OPENAI_TOOL_ROUTING_MODE,
+            OPENAI_STREAM_RESPONSES=settings.OPENAI_STREAM_RESPONSES,
+            IGNORE_SENDER_NAMES=settings.IGNORE_SENDER_NAMES,  # type: ignore
+        )
+
+
+class GuildSettingsRegistry:
+    """Per-server settings, resolved against the global settings once when they're loaded so
+    each lookup is a single dict access. Reloaded whenever the settings are.
+    """
+
+    def __init__(self):
+        self.defaults = GuildSettings.from_settings()
+        self.guilds: dict[int, GuildSettings] = {}
+
+    def load(self) -> None:
+        """(Re)load overrides from `GUILD_SETTINGS_FILE`, a JSON object mapping server IDs to
+        overrides, e.g. `{"123456789": {"OPENAI_MODEL": "gpt-4o", "RANDOM_REPLY_CHANCE": 0}}`.
+
+        Invalid entries are skipped; if the file as a whole can't be used, the current settings
+        are kept.
+        """
+        path = Path(settings.GUILD_SETTINGS_FILE)
+        try:
+            defaults = GuildSettings.from_settings()
+            guilds = self._read(path, defaults)
+        except Exception as e:
+            logger.error(
+                f"keeping the current server settings, couldn't load {path}: {e}"
+            )
+            return
+        # swapped in together, so lookups never mix old and new settings
+        self.defaults, self.guilds = defaults, guilds
+        if path.exists():
+            logger.info(
+                f"loaded settings overrides for {len(guilds)} server(s)", path=path
+            )
+
+    def _read(self, path: Path, defaults: GuildSettings) -> dict[int, GuildSettings]:
+        if not path.exists():
+            return {}
+
+        raw_guilds = json.loads(path.read_text())
+        if not isinstance(raw_guilds, dict):
+            raise ValueError("expected a JSON object mapping server IDs to overrides")
+
+        guilds = {}
+        for guild_id, raw_overrides in raw_guilds.items():
+            try:
+                overrides = GuildOverrides.model_validate(raw_overrides)
+                guilds[int(guild_id)] = replace(
+                    defaults, **overrides.model_dump(exclude_none=True)
+                )
+            except (ValidationError, ValueError) as e:
+                logger.error(f"ignoring invalid settings for server {guild_id!r}: {e}")
+        return guilds
+
+    def get(self, guild_id: int | None) -> GuildSettings:
+        if guild_id is None:
+            return self.defaults
+        return self.guilds.get(guild_id, self.defaults)
+
+
+guild_settings = GuildSettingsRegistry()
+guild_settings.load()
+get_settings_provider().on_reload(guild_settings.load)
+
+# the settings for the server whose message is being handled; set by the message handlers and
+# carried into scheduled jobs along with the rest of the context, so a reply that's already
+# underway keeps the settings it started with across a reload
+active_guild_settings: ContextVar[GuildSettings | None] = ContextVar(
+    "active_guild_settings", default=None
+)
+
+
+def use_guild_settings(guild: Guild | None) -> GuildSettings:
+    """Look up and activate the settings for `guild` (None for DMs)."""
+    current = guild_settings.get(guild.id if guild is not None else None)
+    active_guild_settings.set(current)
+    return current
+
+
+def current_guild_settings() -> GuildSettings:
+    return active_guild_settings.get() or guild_settings.defaults
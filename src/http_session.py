@@ -0,0 +1,94 @@
+import asyncio
+from functools import lru_cache
+from tempfile import SpooledTemporaryFile
+
+import aiohttp
+import structlog
+
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+@lru_cache
+def get_http_session() -> aiohttp.ClientSession:
+    """Return the process-wide HTTP session used for downloading images and attachments."""
+    connector = aiohttp.TCPConnector(
+        limit=settings.HTTP_MAX_CONNECTIONS,
+        keepalive_timeout=settings.HTTP_KEEPALIVE_SECONDS,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=settings.HTTP_TIMEOUT_SECONDS),
+    )
+
+
+async def close_http_session() -> None:
+    if get_http_session.cache_info().currsize == 0:
+        return
+    await get_http_session().close()
+    get_http_session.cache_clear()
+
+
+async def download(
+    url: str,
+    max_bytes: int | None = None,
+    content_type_prefix: str = "image/",
+) -> SpooledTemporaryFile | None:
+    """Stream a download into a spooled buffer (in memory up to a point, then on disk), rewound
+    and ready to read.
+
+    Returns None if the request fails, the content type doesn't match `content_type_prefix`, or the
+    response is bigger than `max_bytes`.
+    """
+    try:
+        return await _download(url, max_bytes, content_type_prefix)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"Could not download file: {e!r}")
+        return None
+
+
+async def _download(
+    url: str, max_bytes: int | None, content_type_prefix: str
+) -> SpooledTemporaryFile | None:
+    max_bytes = max_bytes or settings.DOWNLOAD_MAX_BYTES
+    session = get_http_session()
+    async with session.get(url) as resp:
+        if resp.status != 200:
+            logger.warning(f"Could not download file: {resp}")
+            return None
+        if not resp.content_type.startswith(content_type_prefix):
+            logger.warning(
+                f"unexpected content type for download: {resp.content_type!r}",
+                expected=content_type_prefix,
+            )
+            return None
+        if resp.content_length is not None and resp.content_length > max_bytes:
+            logger.warning(
+                f"download too large: {resp.content_length} bytes", max_bytes=max_bytes
+            )
+            return None
+
+        buffer = SpooledTemporaryFile(max_size=settings.DOWNLOAD_SPOOL_MAX_MEMORY_BYTES)
+        size = 0
+        try:
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    # Content-Length was missing or wrong
+                    logger.warning(
+                        f"download exceeded {max_bytes} bytes, giving up",
+                        max_bytes=max_bytes,
+                    )
+                    buffer.close()
+                    return None
+                buffer.write(chunk)
+        except BaseException:
+            buffer.close()
+            raise
+
+    buffer.seek(0)
+    return buffer
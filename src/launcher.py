@@ -0,0 +1,177 @@
+"""Run the bot as several processes, each with its own range of gateway shards.
+
+    python ./src/launcher.py --processes 4
+    python ./src/launcher.py --processes 2 --shard-count 8
+
+Each process runs `src/app.py` with `DISCORD_SHARD_COUNT` and `DISCORD_SHARD_IDS` set for its
+range (and its own `METRICS_PORT`, counting up from the configured one). Process starts are
+staggered so shards identify with Discord one bucket at a time, and a process that exits with an
+error is restarted.
+
+The processes share `DATA_DIR`; the SQLite stores there are safe to write from several processes,
+but each process's generated image cache keeps its own index, so each gets its own directory and
+an even share of `IMAGE_CACHE_MAX_BYTES`.
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import sys
+from pathlib import Path
+
+import aiohttp
+import structlog
+
+from src.log_config import configure_logging
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+APP_PATH = Path(__file__).with_name("app.py")
+GATEWAY_BOT_URL = "https://discord.com/api/v10/gateway/bot"
+# Discord allows one shard identify per rate limit bucket every 5 seconds
+IDENTIFY_INTERVAL_SECONDS = 5.0
+RESTART_DELAY_SECONDS = 10.0
+
+
+async def get_gateway_info() -> tuple[int, int]:
+    """Discord's recommended shard count for the bot, and how many shards can identify at once."""
+    headers = {"Authorization": f"Bot {settings.DISCORD_BOT_TOKEN.get_secret_value()}"}
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_BOT_URL, headers=headers) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    return data["shards"], data["session_start_limit"]["max_concurrency"]
+
+
+def split_shards(shard_count: int, processes: int) -> list[list[int]]:
+    """Split shard IDs into `processes` contiguous, evenly sized ranges."""
+    processes = min(processes, shard_count)
+    per_process, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for idx in range(processes):
+        end = start + per_process + (idx < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+class ShardProcess:
+    def __init__(
+        self, index: int, shard_count: int, shard_ids: list[int], num_processes: int
+    ):
+        self.index = index
+        self.num_processes = num_processes
+        self.shard_count = shard_count
+        self.shard_ids = shard_ids
+        self.process: asyncio.subprocess.Process | None = None
+
+    @property
+    def name(self) -> str:
+        return f"shards {self.shard_ids[0]}-{self.shard_ids[-1]}/{self.shard_count}"
+
+    async def start(self) -> None:
+        env = {
+            **os.environ,
+            "DISCORD_SHARD_COUNT": str(self.shard_count),
+            "DISCORD_SHARD_IDS": f"{self.shard_ids[0]}-{self.shard_ids[-1]}",
+            "METRICS_PORT": str(settings.METRICS_PORT + self.index),
+            "IMAGE_CACHE_DIR": str(
+                Path(
+                    settings.IMAGE_CACHE_DIR
+                    or Path(settings.DATA_DIR) / "generated_images"
+                )
+                / f"process-{self.index}"
+            ),
+            "IMAGE_CACHE_MAX_BYTES": str(
+                settings.IMAGE_CACHE_MAX_BYTES // self.num_processes
+            ),
+        }
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, str(APP_PATH), env=env
+        )
+        logger.info(f"started {self.name}", pid=self.process.pid)
+
+    async def run(self, stopping: asyncio.Event) -> None:
+        """Keep the process running until `stopping` is set or it exits cleanly."""
+        while True:
+            await self.start()
+            returncode = await self.process.wait()  # type: ignore
+            if stopping.is_set() or returncode == 0:
+                logger.info(f"{self.name} exited", returncode=returncode)
+                return
+            logger.error(
+                f"{self.name} exited unexpectedly, restarting in {RESTART_DELAY_SECONDS}s",
+                returncode=returncode,
+            )
+            await asyncio.sleep(RESTART_DELAY_SECONDS)
+            if stopping.is_set():
+                return
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+
+async def main(args: argparse.Namespace) -> None:
+    recommended_shards, max_concurrency = await get_gateway_info()
+    shard_count = args.shard_count or settings.DISCORD_SHARD_COUNT or recommended_shards
+    logger.info(
+        f"running {shard_count} shard(s) across {args.processes} process(es)",
+        recommended_shards=recommended_shards,
+        max_concurrency=max_concurrency,
+    )
+
+    shard_ranges = split_shards(shard_count, args.processes)
+    shard_processes = [
+        ShardProcess(idx, shard_count, shard_ids, len(shard_ranges))
+        for idx, shard_ids in enumerate(shard_ranges)
+    ]
+
+    stopping = asyncio.Event()
+
+    def stop() -> None:
+        stopping.set()
+        for shard_process in shard_processes:
+            shard_process.stop()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop)
+
+    async with asyncio.TaskGroup() as tg:
+        for shard_process in shard_processes:
+            tg.create_task(shard_process.run(stopping))
+            # let this process's shards identify before the next process starts on its own
+            identify_seconds = (
+                IDENTIFY_INTERVAL_SECONDS
+                * len(shard_process.shard_ids)
+                / max_concurrency
+            )
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=identify_seconds)
+                break
+            except TimeoutError:
+                pass
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--processes", type=int, default=1, help="how many bot processes to run"
+    )
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        default=None,
+        help="total shards (default: DISCORD_SHARD_COUNT, or Discord's recommendation)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,143 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime, timezone
+
+import structlog
+
+from src.settings import get_settings
+
+settings = get_settings()
+
+# run on the calling thread for every record, so these only add a couple of cheap fields;
+# timestamps, formatting and rendering all happen on the listener thread
+SHARED_PROCESSORS = [
+    structlog.contextvars.merge_contextvars,
+    structlog.processors.add_log_level,
+]
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread as-is. The stock `QueueHandler` renders every record
+    before queueing it, which would put the formatting back on the event loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class LazyRepr:
+    """Defers building an expensive log value until a record is actually rendered, which only
+    happens (on the listener thread) if its level is enabled.
+    """
+
+    __slots__ = ("render",)
+
+    def __init__(self, render):
+        self.render = render
+
+    def __repr__(self) -> str:
+        return self.render()
+
+    __str__ = __repr__
+
+
+def add_record_timestamp(logger, method_name: str, event_dict: dict) -> dict:
+    """Timestamp from when the record was logged, rather than when it was rendered."""
+    record: logging.LogRecord = event_dict["_record"]
+    event_dict["timestamp"] = datetime.fromtimestamp(record.created).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+    return event_dict
+
+
+def add_record_timestamp_iso(logger, method_name: str, event_dict: dict) -> dict:
+    record: logging.LogRecord = event_dict["_record"]
+    event_dict["timestamp"] = datetime.fromtimestamp(
+        record.created, tz=timezone.utc
+    ).isoformat()
+    return event_dict
+
+
+def console_formatter() -> structlog.stdlib.ProcessorFormatter:
+    return structlog.stdlib.ProcessorFormatter(
+        foreign_pre_chain=[*SHARED_PROCESSORS, structlog.stdlib.add_logger_name],
+        processors=[
+            add_record_timestamp,
+            structlog.stdlib.ProcessorFormatter.remove_processors_meta,
+            structlog.dev.ConsoleRenderer(),
+        ],
+    )
+
+
+def json_formatter() -> structlog.stdlib.ProcessorFormatter:
+    return structlog.stdlib.ProcessorFormatter(
+        foreign_pre_chain=[*SHARED_PROCESSORS, structlog.stdlib.add_logger_name],
+        processors=[
+            add_record_timestamp_iso,
+            structlog.processors.format_exc_info,
+            structlog.stdlib.ProcessorFormatter.remove_processors_meta,
+            structlog.processors.JSONRenderer(default=repr),
+        ],
+    )
+
+
+def configure_logging() -> None:
+    """Route structlog (and stdlib logging, e.g. discord.py's) through a queue to a listener
+    thread that renders and writes the records, so logging never blocks the event loop.
+
+    Calls below `LOG_LEVEL` are dropped before any of their arguments are looked at.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    level = logging.getLevelName(settings.LOG_LEVEL.upper())
+
+    console = logging.StreamHandler(sys.stderr)
+    if settings.LOG_FORMAT == "json":
+        console.setFormatter(json_formatter())
+    else:
+        console.setFormatter(console_formatter())
+    handlers: list[logging.Handler] = [console]
+    if settings.LOG_JSON_FILE:
+        json_file = logging.handlers.WatchedFileHandler(settings.LOG_JSON_FILE)
+        json_file.setFormatter(json_formatter())
+        handlers.append(json_file)
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(stop_logging)
+
+    root = logging.getLogger()
+    root.handlers = [DeferredQueueHandler(records)]
+    root.setLevel(level)
+
+    structlog.configure(
+        processors=[
+            *SHARED_PROCESSORS,
+            structlog.processors.StackInfoRenderer(),
+            # tracebacks have to be captured before the record leaves this thread
+            structlog.processors.format_exc_info,
+            structlog.stdlib.ProcessorFormatter.wrap_for_formatter,
+        ],
+        logger_factory=structlog.stdlib.LoggerFactory(),
+        wrapper_class=structlog.make_filtering_bound_logger(level),
+        cache_logger_on_first_use=True,
+    )
+
+
+def stop_logging() -> None:
+    """Write out anything still queued."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
@@ -1,13 +1,11 @@
-import random
-
 import structlog
 from discord import DMChannel, Message
 
-from src.messaging.main import try_to_send_message
-from src.openai_api.chatcompletion import (
-    generate_ai_reaction,
-    generate_ai_text_response,
-)
+from src.guild_settings import use_guild_settings
+from src.messaging.main import respond_to
+from src.messaging.scheduler import scheduler
+from src.openai_api.context import MessageContext
+from src.openai_api.dispatcher import RequestPriority, request_priority
 from src.settings import get_settings
 
 logger = structlog.get_logger()
@@ -20,33 +18,33 @@ async def handle_direct_message(message: Message):
         return
 
     channel: DMChannel = message.channel
+    # DMs aren't tied to a server, so they always use the global settings
+    use_guild_settings(None)
+
+    # check how many others are in the conversation
+    recipients = getattr(channel, "recipients", [channel.recipient])
+    if len(recipients) > 1:
+        # TODO: handle group messages
+        logger.error(
+            f"ignoring group message from {message.author}: {message.content}",
+            reason="not implemented",
+        )
+        return
 
-    async with channel.typing():
-        # check how many others are in the conversation
-        recipients = getattr(channel, "recipients", [channel.recipient])
-        if len(recipients) > 1:
-            # TODO: handle group messages
-            logger.error(
-                f"ignoring group message from {message.author}: {message.content}",
-                reason="not implemented",
-            )
-            return
-
-        # 1:1 message, always respond
-        await send_direct_message_to(message)
+    # 1:1 message, always respond (one reply at a time; messages sent while a reply is being
+    # generated are folded into a single follow-up reply)
+    scheduler.submit(
+        channel.id, lambda: send_direct_message_to(message), coalesce_key="reply"
+    )
 
 
 async def send_direct_message_to(message: Message) -> None:
     """Send a message to a user who has sent a direct message to the bot.
-    Optionally add a reaction to the message first.
+    Optionally add a reaction to the message at the same time.
     """
-    await generate_ai_reaction(message)
-
-    async with message.channel.typing():
-        response, generated_image_url = await generate_ai_text_response(message)
-
-    if not response:
-        return
-
+    request_priority.set(RequestPriority.DIRECT)
+    # shared by the reaction and text response so history, image summaries, etc. are only
+    # gathered once (at the reply's priority)
+    context = MessageContext(message)
     # don't reply directly to this message, just send it back in the conversation
-    await try_to_send_message(message, response, generated_image_url)
+    await respond_to(message, context, with_reaction=True)
@@ -0,0 +1,65 @@
+from typing import Iterable
+
+import structlog
+from discord import Emoji, Guild
+
+logger = structlog.get_logger()
+
+
+class GuildEmojis:
+    """A server's custom emojis by name, along with the prompt text that lists them."""
+
+    __slots__ = ("by_name", "prompt_fragment")
+
+    def __init__(self, emojis: Iterable[Emoji] = ()):
+        self.by_name: dict[str, Emoji] = {emoji.name: emoji for emoji in emojis}
+
+        self.prompt_fragment = "emoji(s)."
+        if self.by_name:
+            self.prompt_fragment = f"the name(s) of one or more available server emoji(s): {list(self.by_name.keys())!r}\n\n...or emoji(s)."
+
+    def __bool__(self) -> bool:
+        return bool(self.by_name)
+
+    def get(self, name: str) -> Emoji | None:
+        return self.by_name.get(name)
+
+
+# shared by DMs and servers without any custom emojis
+NO_EMOJIS = GuildEmojis()
+
+
+class EmojiIndex:
+    """Per-server emoji lookups, kept up to date from gateway events so reactions never need to
+    fetch the emoji list over REST.
+    """
+
+    def __init__(self):
+        self.guilds: dict[int, GuildEmojis] = {}
+
+    def update_guild(
+        self, guild: Guild, emojis: Iterable[Emoji] | None = None
+    ) -> GuildEmojis:
+        guild_emojis = GuildEmojis(guild.emojis if emojis is None else emojis)
+        self.guilds[guild.id] = guild_emojis
+        logger.debug(
+            "updated server emoji index",
+            server=guild.name,
+            num_emojis=len(guild_emojis.by_name),
+        )
+        return guild_emojis
+
+    def remove_guild(self, guild: Guild) -> None:
+        self.guilds.pop(guild.id, None)
+
+    def get(self, guild: Guild | None) -> GuildEmojis:
+        if guild is None:
+            return NO_EMOJIS
+        if (guild_emojis := self.guilds.get(guild.id)) is not None:
+            return guild_emojis
+        # not indexed yet (e.g. before `on_ready`), but the gateway has already given us the
+        # server's emojis so this still doesn't need a network call
+        return self.update_guild(guild)
+
+
+emoji_index = EmojiIndex()
@@ -0,0 +1,290 @@
+import asyncio
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Any, Mapping
+
+import structlog
+from discord import Message
+
+from src.metrics import cache_stats, stage_latency
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+
+class CachedAttachment:
+    """The parts of a `discord.Attachment` we need for building context."""
+
+    __slots__ = ("id", "filename", "content_type", "proxy_url", "url", "size")
+
+    def __init__(
+        self,
+        id: int,
+        filename: str,
+        content_type: str | None,
+        proxy_url: str,
+        url: str,
+        size: int,
+    ):
+        self.id = id
+        self.filename = filename
+        self.content_type = content_type
+        self.proxy_url = proxy_url
+        self.url = url
+        self.size = size
+
+    @classmethod
+    def from_data(cls, data: Mapping[str, Any]) -> "CachedAttachment":
+        """From an attachment in a raw gateway payload."""
+        return cls(
+            id=int(data["id"]),
+            filename=data["filename"],
+            content_type=data.get("content_type"),
+            proxy_url=data["proxy_url"],
+            url=data["url"],
+            size=data["size"],
+        )
+
+
+class CachedMessage:
+    """Compact, gateway-fed copy of a `discord.Message` for history lookups."""
+
+    __slots__ = (
+        "id",
+        "channel_id",
+        "author_id",
+        "author_name",
+        "content",
+        "created_at",
+        "attachments",
+        "token_count",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        channel_id: int,
+        author_id: int,
+        author_name: str,
+        content: str,
+        created_at: datetime,
+        attachments: tuple[CachedAttachment, ...] = (),
+    ):
+        self.id = id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+        self.created_at = created_at
+        self.attachments = attachments
+        # filled in lazily the first time this message is considered for a prompt
+        self.token_count: int | None = None
+
+    @classmethod
+    def from_message(cls, message: Message) -> "CachedMessage":
+        attachments = tuple(
+            CachedAttachment(
+                id=attachment.id,
+                filename=attachment.filename,
+                content_type=getattr(attachment, "content_type", None),
+                proxy_url=attachment.proxy_url,
+                url=attachment.url,
+                size=attachment.size,
+            )
+            for attachment in message.attachments
+        )
+        return cls(
+            id=message.id,
+            channel_id=message.channel.id,
+            author_id=message.author.id,
+            author_name=message.author.name,
+            content=message.content,
+            created_at=message.created_at,
+            attachments=attachments,
+        )
+
+
+class ChannelHistory:
+    """Bounded ring buffer of the most recent messages in a single channel, oldest first."""
+
+    __slots__ = ("messages", "backfilled", "lock")
+
+    def __init__(self, maxlen: int):
+        self.messages: deque[CachedMessage] = deque(maxlen=maxlen)
+        # whether we've pulled the channel's history over REST at least once, since the gateway
+        # only tells us about messages sent after we connected
+        self.backfilled = False
+        self.lock = asyncio.Lock()
+
+    def add(self, cached_message: CachedMessage) -> None:
+        if not self.messages or self.messages[-1].id < cached_message.id:
+            self.messages.append(cached_message)
+            return
+        # out-of-order (or duplicate) message; rebuild in snowflake order
+        self.merge([cached_message])
+
+    def merge(self, cached_messages: list[CachedMessage]) -> None:
+        by_id = {msg.id: msg for msg in cached_messages}
+        # prefer what we already have, since gateway updates (edits) are fresher than REST results
+        by_id.update({msg.id: msg for msg in self.messages})
+        merged = sorted(by_id.values(), key=lambda msg: msg.id)
+        self.messages.clear()
+        self.messages.extend(merged[-self.messages.maxlen :])  # type: ignore
+
+    def get(self, message_id: int) -> CachedMessage | None:
+        for existing in self.messages:
+            if existing.id == message_id:
+                return existing
+        return None
+
+    def remove(self, message_id: int) -> bool:
+        for existing in self.messages:
+            if existing.id == message_id:
+                self.messages.remove(existing)
+                return True
+        return False
+
+
+class HistoryCache:
+    """Per-channel message history kept up to date from gateway events.
+
+    Channels are kept in least-recently-used order; once the total number of cached messages goes
+    over `max_total_messages`, the most idle channels are dropped (and will be backfilled over REST
+    again the next time they're needed).
+    """
+
+    def __init__(self, max_messages_per_channel: int, max_total_messages: int):
+        self.max_messages_per_channel = max_messages_per_channel
+        self.max_total_messages = max_total_messages
+        self.channels: OrderedDict[int, ChannelHistory] = OrderedDict()
+        self.total_messages = 0
+
+        self.hits = 0
+        # lookups that had to fetch the channel's history over REST first
+        self.backfills = 0
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.backfills
+        return {
+            "hits": self.hits,
+            "backfills": self.backfills,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "channels": len(self.channels),
+            "messages": self.total_messages,
+        }
+
+    def _get_channel(
+        self, channel_id: int, create: bool = True
+    ) -> ChannelHistory | None:
+        channel_history = self.channels.get(channel_id)
+        if channel_history is None:
+            if not create:
+                return None
+            channel_history = ChannelHistory(self.max_messages_per_channel)
+            self.channels[channel_id] = channel_history
+        self.channels.move_to_end(channel_id)
+        return channel_history
+
+    def _update_size(self, channel_history: ChannelHistory, before: int) -> None:
+        self.total_messages += len(channel_history.messages) - before
+        self._evict()
+
+    def _evict(self) -> None:
+        # never evict the most recently used channel, even if it alone is over the cap
+        while self.total_messages > self.max_total_messages and len(self.channels) > 1:
+            channel_id, channel_history = self.channels.popitem(last=False)
+            self.total_messages -= len(channel_history.messages)
+            logger.debug(
+                "evicted idle channel from history cache",
+                evicted_channel_id=channel_id,
+                total_messages=self.total_messages,
+            )
+
+    def add(self, message: Message) -> None:
+        """Record a new message from the gateway."""
+        channel_history = self._get_channel(message.channel.id)
+        before = len(channel_history.messages)  # type: ignore
+        channel_history.add(CachedMessage.from_message(message))  # type: ignore
+        self._update_size(channel_history, before)  # type: ignore
+
+    def edit(self, channel_id: int, message_id: int, data: Mapping[str, Any]) -> None:
+        """Apply an edit from a raw gateway payload, which only has the fields that changed."""
+        channel_history = self._get_channel(channel_id, create=False)
+        if channel_history is None:
+            return
+        if (cached_message := channel_history.get(message_id)) is None:
+            return
+        if "content" in data:
+            cached_message.content = data["content"]
+            cached_message.token_count = None
+        if "attachments" in data:
+            cached_message.attachments = tuple(
+                CachedAttachment.from_data(attachment)
+                for attachment in data["attachments"]
+            )
+
+    def delete(self, channel_id: int, message_id: int) -> None:
+        """Drop a deleted message from the cache."""
+        channel_history = self._get_channel(channel_id, create=False)
+        if channel_history is not None and channel_history.remove(message_id):
+            self.total_messages -= 1
+
+    async def _backfill(
+        self, message: Message, channel_history: ChannelHistory
+    ) -> None:
+        async with channel_history.lock:
+            if channel_history.backfilled:
+                return
+            logger.debug("history cache miss, backfilling from REST")
+            self.backfills += 1
+            with stage_latency.time(stage="history backfill"):
+                fetched = [
+                    CachedMessage.from_message(msg)
+                    async for msg in message.channel.history(
+                        limit=self.max_messages_per_channel,
+                        before=message,
+                    )
+                ]
+            before = len(channel_history.messages)
+            channel_history.merge(fetched)
+            channel_history.backfilled = True
+            if self.channels.get(message.channel.id) is channel_history:
+                self._update_size(channel_history, before)
+            # otherwise the channel was evicted while we were waiting on REST, and its messages
+            # were already taken off the total
+
+    async def get_history(
+        self,
+        message: Message,
+        limit: int = 10,
+        lookback: timedelta | None = timedelta(hours=1),
+    ) -> list[CachedMessage]:
+        """Return up to `limit` messages sent within `lookback` (if given) before `message`, oldest
+        first, followed by `message` itself.
+        """
+        channel_history: ChannelHistory = self._get_channel(message.channel.id)  # type: ignore
+        if not channel_history.backfilled:
+            await self._backfill(message, channel_history)
+        else:
+            self.hits += 1
+
+        history_start: datetime | None = (
+            message.created_at - lookback if lookback is not None else None
+        )
+        previous_messages = [
+            msg
+            for msg in channel_history.messages
+            if msg.id < message.id
+            and (history_start is None or msg.created_at > history_start)
+        ]
+        previous_messages = previous_messages[-limit:] if limit > 0 else []
+        previous_messages.append(CachedMessage.from_message(message))
+        return previous_messages
+
+
+history_cache = HistoryCache(
+    max_messages_per_channel=settings.HISTORY_CACHE_MAX_MESSAGES_PER_CHANNEL,
+    max_total_messages=settings.HISTORY_CACHE_MAX_TOTAL_MESSAGES,
+)
+cache_stats.add("history", history_cache.stats)
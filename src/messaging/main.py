@@ -1,38 +1,150 @@
+import asyncio
 import re
 from io import BytesIO
+from typing import Any, Coroutine
 
-import aiohttp
 import structlog
 from discord import File, Message
 from discord.errors import Forbidden
 
 from src.client import client
+from src.guild_settings import current_guild_settings
+from src.messaging.sent_messages import sent_message_index
+from src.metrics import stage_latency
+from src.openai_api.chatcompletion import (
+    generate_ai_reaction,
+    generate_ai_text_response,
+)
+from src.openai_api.context import MessageContext
+from src.openai_api.dispatcher import RequestPriority, request_priority
+from src.openai_api.images import GeneratedImage, ImageJob
+from src.openai_api.stages import run_stage
 from src.settings import get_settings
 
 logger = structlog.get_logger()
 settings = get_settings()
 
+# shown at the end of a reply until its image is attached
+IMAGE_PLACEHOLDER = "*🎨 Generating image...*"
+IMAGE_FAILED_NOTE = "*(Couldn't generate the image.)*"
+# appended to a reply whose text stopped partway (e.g. the text stage timed out)
+TEXT_CUT_OFF_NOTE = "*(response cut off)*"
+
+# replies waiting on an image job, kept here so the tasks aren't garbage collected
+pending_image_edits: set[asyncio.Task] = set()
+# reactions that nothing waits for, kept here for the same reason
+pending_reactions: set[asyncio.Task] = set()
+
+
+async def respond_to(
+    message: Message,
+    context: MessageContext,
+    with_reaction: bool,
+    as_reply: bool = False,
+) -> None:
+    """Reply to a message (in any kind of channel), and react to it too if `with_reaction` is
+    set.
+    """
+    if current_guild_settings().OPENAI_TOOL_ROUTING_MODE == "unified":
+        # the reaction decision is made in the same model call as the reply
+        await reply_to(
+            message, context, as_reply=as_reply, include_reaction=with_reaction
+        )
+        return
+
+    # the reaction decision runs alongside the reply and never holds it up
+    if with_reaction:
+        add_reaction_in_background(add_reaction(message, context))
+    await reply_to(message, context, as_reply=as_reply)
+
+
+async def reply_to(
+    message: Message,
+    context: MessageContext,
+    as_reply: bool = False,
+    include_reaction: bool = False,
+) -> None:
+    # streaming builds on the helpers in this module, so it can only be imported once they exist
+    from src.messaging.streaming import StreamingReply, send_cut_off_reply
+
+    streaming_reply = None
+    if current_guild_settings().OPENAI_STREAM_RESPONSES:
+        streaming_reply = StreamingReply(message, as_reply=as_reply, context=context)
+
+    async with message.channel.typing():
+        response, image_job = await generate_ai_text_response(
+            context,
+            include_reaction=include_reaction,
+            on_text=streaming_reply.update if streaming_reply else None,
+        )
+
+    if response is None:
+        await send_cut_off_reply(
+            message,
+            streaming_reply,
+            image_job,
+            as_reply=as_reply,
+            prompt_tokens=context.prompt_tokens,
+        )
+        return
+    if not response:
+        return
+
+    if streaming_reply is not None:
+        await streaming_reply.finish(response, image_job)
+        return
+
+    await try_to_send_message(
+        message,
+        response,
+        image_job,
+        as_reply=as_reply,
+        prompt_tokens=context.prompt_tokens,
+    )
+
+
+async def add_reaction(message: Message, context: MessageContext | None = None) -> None:
+    # reactions are nice-to-have, so they're the first thing dropped when we're near rate limits
+    request_priority.set(RequestPriority.BACKGROUND)
+    await run_stage(
+        "reaction",
+        generate_ai_reaction(context or MessageContext(message)),
+        timeout=settings.STAGE_TIMEOUT_REACTION_SECONDS,
+        default=None,
+    )
+
 
 async def try_to_send_message(
     message: Message,
     reply_content: str,
-    attached_image_url: str,
+    image_job: ImageJob | None,
     as_reply: bool = False,
+    prompt_tokens: int = 0,
 ):
     """Try to send a message in the current channel, either as a reply or a new message.
-    If an attached image URL is provided, it will be downloaded and sent as an attachment.
+    If an image is being generated for it, it's attached straight away when it's already done;
+    otherwise the message is sent with a placeholder and edited once the image is ready.
     Any errors will be caught and logged.
     """
+    waiting_for_image = image_job is not None and not image_job.done()
     async with message.channel.typing():
         msg_send_op = message.reply if as_reply else message.channel.send
         params = {"content": reply_content}
 
-        image_attachment: File | None = await make_image_attachment(attached_image_url)
-        if image_attachment:
-            params["file"] = image_attachment  # type: ignore
+        if waiting_for_image:
+            params["content"] = with_image_placeholder(reply_content)
+        elif image_job is not None:
+            image_attachment = make_image_attachment(image_job_result(image_job))
+            if image_attachment:
+                params["file"] = image_attachment  # type: ignore
 
     try:
-        await msg_send_op(**params)  # type: ignore
+        with stage_latency.time(stage="discord send"):
+            sent_message = await msg_send_op(**params)  # type: ignore
+        # remembered along with the prompt size so feedback on it can be attributed later
+        sent_message_index.add(sent_message, prompt_tokens=prompt_tokens)
+        if waiting_for_image:
+            attach_image_when_ready(sent_message, reply_content, image_job)  # type: ignore
     except Forbidden:
         logger.error(
             f"missing permissions to send messages in `{message.channel.name}`"  # type: ignore
@@ -41,20 +153,67 @@ async def try_to_send_message(
         logger.error(f"error sending message: {e}")
 
 
-async def make_image_attachment(image_url: str) -> File | None:
-    """Download an image from a URL and return it as a `discord.File` object."""
-    if not image_url:
+def make_image_attachment(image: GeneratedImage | None) -> File | None:
+    """Turn a finished image job's image into a `discord.File` object."""
+    if image is None or image.data is None:
+        return None
+    return File(BytesIO(image.data), filename="image.png")
+
+
+def with_image_placeholder(content: str) -> str:
+    return f"{content}\n\n{IMAGE_PLACEHOLDER}"
+
+
+def with_cut_off_note(content: str) -> str:
+    return (
+        f"{content.rstrip()}...\n\n{TEXT_CUT_OFF_NOTE}"
+        if content.strip()
+        else TEXT_CUT_OFF_NOTE
+    )
+
+
+def image_job_result(image_job: ImageJob) -> GeneratedImage | None:
+    if image_job.cancelled():
         return None
+    return image_job.result()
+
+
+def attach_image_when_ready(
+    sent_message: Message, content: str, image_job: ImageJob
+) -> None:
+    """Edit a sent message once its image is ready, replacing the placeholder with the image (or
+    with a note if it couldn't be generated). Runs in the background, so the channel can move on
+    to its next reply in the meantime.
+    """
+    task = asyncio.create_task(_attach_image(sent_message, content, image_job))
+    pending_image_edits.add(task)
+    task.add_done_callback(pending_image_edits.discard)
+
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(image_url) as resp:
-            if resp.status != 200:
-                logger.warning(
-                    f"Could not download image file to attach to message: {resp}"
+def add_reaction_in_background(reaction: Coroutine[Any, Any, None]) -> None:
+    """Run a reaction without waiting for it, so a slow reaction never holds up the reply it goes
+    with, or the channel's next reply waiting on the scheduler.
+    """
+    task = asyncio.create_task(reaction)
+    pending_reactions.add(task)
+    task.add_done_callback(pending_reactions.discard)
+
+
+async def _attach_image(
+    sent_message: Message, content: str, image_job: ImageJob
+) -> None:
+    await asyncio.wait([image_job])
+    image_attachment = make_image_attachment(image_job_result(image_job))
+    try:
+        with stage_latency.time(stage="discord edit"):
+            if image_attachment is not None:
+                await sent_message.edit(content=content, attachments=[image_attachment])
+            else:
+                await sent_message.edit(
+                    content=f"{content}\n\n{IMAGE_FAILED_NOTE}".strip()
                 )
-                return None
-            data = BytesIO(await resp.read())
-            return File(data, filename="image.png")
+    except Exception as e:
+        logger.error(f"error attaching generated image: {e}")
 
 
 def is_mentioned(message: Message) -> bool:
@@ -0,0 +1,161 @@
+import asyncio
+import contextvars
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import structlog
+
+from src.metrics import queue_stats
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+
+@dataclass
+class ScheduledJob:
+    channel_id: int
+    run: Callable[[], Awaitable[None]]
+    # pending jobs in the same channel with the same key are merged into one
+    coalesce_key: str | None = None
+    # e.g. a `RequestPriority`; lower is more important. A job is never merged into one that's
+    # less important than it
+    priority: int = 0
+    # context the job was submitted from, so context variables (e.g. request priority) set while
+    # handling the message carry over to the job without leaking into the channel's next job
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+    # set once the job has started, been dropped, or been merged into another job
+    done: bool = field(default=False, repr=False)
+
+
+class ChannelScheduler:
+    """Runs message-handling work with a global concurrency cap, one job at a time per channel.
+
+    Jobs submitted for a channel that's already busy wait their turn; if a waiting job in that
+    channel has the same `coalesce_key`, the new job replaces it instead of queueing another
+    generation (unless the waiting job is more important, in which case it's kept and the new
+    job is dropped). Once more than `max_backlog` jobs are waiting across all channels, the oldest
+    waiting job is dropped.
+    """
+
+    def __init__(self, max_concurrent: int, max_backlog: int):
+        self.max_backlog = max_backlog
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.pending: dict[int, deque[ScheduledJob]] = {}
+        # every waiting job in submission order, so we know which one to drop first
+        self.backlog: deque[ScheduledJob] = deque()
+        self.backlog_size = 0
+        self.workers: dict[int, asyncio.Task] = {}
+
+        self.in_flight = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "backlog": self.backlog_size,
+            "in_flight": self.in_flight,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
+
+    def submit(
+        self,
+        channel_id: int,
+        run: Callable[[], Awaitable[None]],
+        coalesce_key: str | None = None,
+        priority: int = 0,
+    ) -> None:
+        self._trim_backlog()
+        channel_jobs = self.pending.setdefault(channel_id, deque())
+
+        if coalesce_key is not None:
+            for job in channel_jobs:
+                if not job.done and job.coalesce_key == coalesce_key:
+                    if priority <= job.priority:
+                        # keep the waiting job's place in line, but run the newest work instead
+                        job.run = run
+                        job.context = contextvars.copy_context()
+                        job.priority = priority
+                    # otherwise the waiting job (e.g. answering a mention) is kept, since a less
+                    # important job could be shed and leave it unanswered
+                    self.coalesced += 1
+                    logger.debug(
+                        "coalesced job with pending work for channel",
+                        coalesce_key=coalesce_key,
+                        **self.stats(),
+                    )
+                    return
+
+        job = ScheduledJob(
+            channel_id=channel_id,
+            run=run,
+            coalesce_key=coalesce_key,
+            priority=priority,
+        )
+        channel_jobs.append(job)
+        self.backlog.append(job)
+        self.backlog_size += 1
+        self._drop_oldest()
+
+        if channel_id not in self.workers:
+            self.workers[channel_id] = asyncio.create_task(self._work(channel_id))
+
+    def _drop_oldest(self) -> None:
+        while self.backlog_size > self.max_backlog and self.backlog:
+            job = self.backlog.popleft()
+            if job.done:
+                continue
+            job.done = True
+            self.backlog_size -= 1
+            self.dropped += 1
+            logger.warning(
+                "scheduler backlog full, dropped oldest job",
+                dropped_channel_id=job.channel_id,
+                **self.stats(),
+            )
+
+    def _next_job(self, channel_id: int) -> ScheduledJob | None:
+        channel_jobs = self.pending.get(channel_id)
+        while channel_jobs:
+            job = channel_jobs.popleft()
+            if not job.done:
+                job.done = True
+                self.backlog_size -= 1
+                return job
+        self.pending.pop(channel_id, None)
+        return None
+
+    async def _work(self, channel_id: int) -> None:
+        while True:
+            await self.semaphore.acquire()
+            job = self._next_job(channel_id)
+            if job is None:
+                # no awaits between finding the channel's queue empty and removing this worker, so
+                # a job can't be submitted in between and get stranded
+                self.semaphore.release()
+                self.workers.pop(channel_id, None)
+                self._trim_backlog()
+                return
+
+            self.in_flight += 1
+            try:
+                await asyncio.create_task(job.run(), context=job.context)
+            except Exception as e:
+                logger.exception(f"scheduled job failed: {e}")
+            finally:
+                self.in_flight -= 1
+                self.semaphore.release()
+
+    def _trim_backlog(self) -> None:
+        # started/merged jobs are only skipped lazily when dropping, so clear them out here
+        while self.backlog and self.backlog[0].done:
+            self.backlog.popleft()
+
+
+scheduler = ChannelScheduler(
+    max_concurrent=settings.SCHEDULER_MAX_CONCURRENT_JOBS,
+    max_backlog=settings.SCHEDULER_MAX_BACKLOG,
+)
+queue_stats.add("scheduler", scheduler.stats)
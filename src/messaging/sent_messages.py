@@ -0,0 +1,158 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import structlog
+from discord import Message
+
+from src.guild_settings import current_guild_settings
+from src.settings import get_settings
+from src.storage import connect_shared_db
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+
+@dataclass
+class SentMessage:
+    """What we know about one of the bot's messages, for attributing feedback on it."""
+
+    channel_id: int
+    guild_id: int | None
+    model: str
+    # size of the prompt the message was generated from
+    prompt_tokens: int
+
+
+class SentMessageIndex:
+    """IDs of the most recent messages the bot has sent, so reaction events on anyone else's
+    messages can be ignored without fetching the message first.
+
+    Kept in memory and mirrored to a SQLite table so feedback on older replies still works after a
+    restart. Only the newest `max_entries` messages are kept.
+    """
+
+    def __init__(self, db_path: str, max_entries: int):
+        self.db_path = db_path
+        self.max_entries = max_entries
+
+        self.messages: OrderedDict[int, SentMessage] = OrderedDict()
+        self.loaded = False
+        # added since the last write to disk
+        self.unsaved: list[tuple] = []
+        self._flush_task: asyncio.Task | None = None
+
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self.messages
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def get(self, message_id: int) -> SentMessage | None:
+        return self.messages.get(message_id)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect_shared_db(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sent_messages "
+                "(message_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL, "
+                "guild_id INTEGER, model TEXT NOT NULL, prompt_tokens INTEGER NOT NULL, "
+                "sent_at REAL NOT NULL)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _read_disk(self) -> list[tuple[int, SentMessage]]:
+        with self._db_lock:
+            db = self._connect()
+            rows = db.execute(
+                "SELECT message_id, channel_id, guild_id, model, prompt_tokens FROM sent_messages "
+                "ORDER BY sent_at DESC LIMIT ?",
+                (self.max_entries,),
+            ).fetchall()
+        # oldest first, so the newest end up at the end of the LRU
+        return [(row[0], SentMessage(*row[1:])) for row in reversed(rows)]
+
+    def _write_disk(self, rows: list[tuple]) -> None:
+        with self._db_lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO sent_messages "
+                "(message_id, channel_id, guild_id, model, prompt_tokens, sent_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            db.execute(
+                "DELETE FROM sent_messages WHERE message_id NOT IN "
+                "(SELECT message_id FROM sent_messages ORDER BY sent_at DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            db.commit()
+
+    def _remember(self, message_id: int, sent: SentMessage) -> None:
+        self.messages[message_id] = sent
+        self.messages.move_to_end(message_id)
+        while len(self.messages) > self.max_entries:
+            self.messages.popitem(last=False)
+
+    async def load(self) -> None:
+        """Read the persisted index (once; `on_ready` can fire again after reconnecting)."""
+        if self.loaded:
+            return
+        self.loaded = True
+        rows = await asyncio.to_thread(self._read_disk)
+        # anything sent before the load finished is newer than what's on disk
+        recent = list(self.messages.items())
+        self.messages.clear()
+        for message_id, sent in [*rows, *recent]:
+            self._remember(message_id, sent)
+        logger.info(f"loaded {len(rows)} sent message ID(s)", path=self.db_path)
+
+    def add(
+        self, message: Message, prompt_tokens: int = 0, model: str | None = None
+    ) -> None:
+        """Record a message the bot just sent."""
+        sent = SentMessage(
+            channel_id=message.channel.id,
+            guild_id=message.guild.id if message.guild else None,
+            model=model or current_guild_settings().OPENAI_MODEL,
+            prompt_tokens=prompt_tokens,
+        )
+        self._remember(message.id, sent)
+        self.unsaved.append(
+            (
+                message.id,
+                sent.channel_id,
+                sent.guild_id,
+                sent.model,
+                sent.prompt_tokens,
+                time.time(),
+            )
+        )
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        try:
+            # batch up everything sent in the meantime (e.g. streamed message rollovers)
+            while self.unsaved:
+                rows, self.unsaved = self.unsaved, []
+                await asyncio.to_thread(self._write_disk, rows)
+        except Exception as e:
+            logger.error(f"error saving sent message IDs: {e}")
+        finally:
+            self._flush_task = None
+
+
+sent_message_index = SentMessageIndex(
+    db_path=str(Path(settings.DATA_DIR) / "sent_messages.sqlite3"),
+    max_entries=settings.SENT_MESSAGE_INDEX_MAX_ENTRIES,
+)
@@ -0,0 +1,177 @@
+import asyncio
+import time
+
+import structlog
+from discord import File, Message
+from discord.errors import Forbidden
+
+from src.messaging.main import (
+    IMAGE_PLACEHOLDER,
+    attach_image_when_ready,
+    image_job_result,
+    make_image_attachment,
+    try_to_send_message,
+    with_cut_off_note,
+    with_image_placeholder,
+)
+from src.messaging.sent_messages import sent_message_index
+from src.metrics import stage_latency
+from src.openai_api.context import MessageContext
+from src.openai_api.images import ImageJob
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+# Discord's limit for message content
+MAX_MESSAGE_LENGTH = 2000
+
+
+def split_message_content(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    """Split text into chunks that fit in a single Discord message, preferring to break on a
+    newline or space.
+
+    Earlier chunks only depend on the text before them, so as streamed text grows, chunks that were
+    already sent don't change.
+    """
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            # no good place to break, so just split mid-word
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip()
+    chunks.append(text)
+    return chunks
+
+
+class StreamingReply:
+    """A reply that's posted as soon as the first bit of text is available and then edited as more
+    text streams in, rolling over into follow-up messages past Discord's length limit.
+    """
+
+    def __init__(
+        self,
+        message: Message,
+        as_reply: bool = False,
+        context: MessageContext | None = None,
+    ):
+        self.message = message
+        self.as_reply = as_reply
+        # the prompt size isn't known until the first text streams in, so it's read at send time
+        self.context = context
+        self.sent_messages: list[Message] = []
+        self.sent_content: list[str] = []
+        # the latest streamed text, including any that hasn't been shown yet
+        self.text = ""
+        self.last_render = 0.0
+        self.lock = asyncio.Lock()
+        self.failed = False
+
+    @property
+    def started(self) -> bool:
+        return bool(self.sent_messages)
+
+    async def update(self, text: str) -> None:
+        """Show the latest streamed text, throttled to stay well within Discord's rate limits."""
+        self.text = text
+        if self.failed or self.lock.locked():
+            # still sending/editing the last update; the next one will include this text anyway
+            return
+        if not self.started and len(text) < settings.STREAM_FIRST_CHUNK_CHARS:
+            return
+        if time.monotonic() - self.last_render < settings.STREAM_EDIT_INTERVAL_SECONDS:
+            return
+        async with self.lock:
+            await self._render(text)
+
+    async def finish(self, text: str, image_job: ImageJob | None = None) -> None:
+        """Show the final text, and attach the generated image (if any) to the last message: right
+        away if it's already done, otherwise in place of a placeholder once it's ready.
+        """
+        if self.failed:
+            return
+        async with self.lock:
+            if image_job is not None and not image_job.done():
+                await self._render(with_image_placeholder(text))
+                if not self.failed:
+                    # the placeholder always ends up at the end of the last message
+                    content = self.sent_content[-1].removesuffix(IMAGE_PLACEHOLDER)
+                    attach_image_when_ready(
+                        self.sent_messages[-1], content.rstrip(), image_job
+                    )
+                return
+
+            image_attachment: File | None = None
+            if image_job is not None:
+                image_attachment = make_image_attachment(image_job_result(image_job))
+            await self._render(text, image_attachment)
+
+    async def _render(self, text: str, image_attachment: File | None = None) -> None:
+        chunks = split_message_content(text.strip() or "...")
+        try:
+            for idx, chunk in enumerate(chunks):
+                is_last = idx == len(chunks) - 1
+                file = image_attachment if is_last else None
+                if idx < len(self.sent_messages):
+                    if chunk == self.sent_content[idx] and file is None:
+                        continue
+                    params: dict = {"content": chunk}
+                    if file is not None:
+                        params["attachments"] = [file]
+                    with stage_latency.time(stage="discord edit"):
+                        self.sent_messages[idx] = await self.sent_messages[idx].edit(
+                            **params
+                        )
+                    self.sent_content[idx] = chunk
+                    continue
+
+                params = {"content": chunk}
+                if file is not None:
+                    params["file"] = file
+                with stage_latency.time(stage="discord send"):
+                    if idx == 0 and self.as_reply:
+                        sent_message = await self.message.reply(**params)
+                    else:
+                        sent_message = await self.message.channel.send(**params)
+                self.sent_messages.append(sent_message)
+                sent_message_index.add(
+                    sent_message,
+                    prompt_tokens=self.context.prompt_tokens if self.context else 0,
+                )
+                self.sent_content.append(chunk)
+        except Forbidden:
+            self.failed = True
+            logger.error(
+                f"missing permissions to send messages in `{self.message.channel.name}`"  # type: ignore
+            )
+        except Exception as e:
+            self.failed = True
+            logger.error(f"error sending streamed message: {e}")
+        self.last_render = time.monotonic()
+
+
+async def send_cut_off_reply(
+    message: Message,
+    streaming_reply: StreamingReply | None,
+    image_job: ImageJob | None,
+    as_reply: bool = False,
+    prompt_tokens: int = 0,
+) -> None:
+    """Wrap up a reply whose text stopped partway (e.g. the text stage timed out): keep whatever
+    text was already streamed, marked as cut off, and still attach the image if one was being made.
+    """
+    if streaming_reply is not None and streaming_reply.text:
+        await streaming_reply.finish(with_cut_off_note(streaming_reply.text), image_job)
+        return
+    if image_job is not None:
+        await try_to_send_message(
+            message,
+            with_cut_off_note(""),
+            image_job,
+            as_reply=as_reply,
+            prompt_tokens=prompt_tokens,
+        )
@@ -5,11 +5,16 @@ import structlog
 from discord import Message, TextChannel
 
 from src.client import client
-from src.messaging.main import is_mentioned, is_reply_to_my_message, try_to_send_message
-from src.openai_api.chatcompletion import (
-    generate_ai_reaction,
-    generate_ai_text_response,
+from src.guild_settings import current_guild_settings, use_guild_settings
+from src.messaging.main import (
+    add_reaction,
+    is_mentioned,
+    is_reply_to_my_message,
+    respond_to,
 )
+from src.messaging.scheduler import scheduler
+from src.openai_api.context import MessageContext
+from src.openai_api.dispatcher import RequestPriority, request_priority
 from src.settings import get_settings
 
 logger = structlog.get_logger()
@@ -27,7 +32,7 @@ def early_exit_check(message: Message) -> EarlyExitResult:
     response generation.
     """
     # ignore messages from certain users (or other bots)
-    if message.author.name in settings.IGNORE_SENDER_NAMES:
+    if message.author.name in current_guild_settings().IGNORE_SENDER_NAMES:
         logger.info(f"(ignoring message from {message.author.name})")
         return EarlyExitResult(should_exit=True, reason="ignored user")
 
@@ -56,65 +61,87 @@ def early_exit_check(message: Message) -> EarlyExitResult:
 async def handle_text_channel_message(message: Message):
     """Handle a message sent in a TextChannel."""
     channel: TextChannel = message.channel  # type: ignore
+    # model, prompt, reply chances etc. for this server, for everything below and any scheduled
+    # replies/reactions
+    use_guild_settings(message.guild)
 
     check: EarlyExitResult = early_exit_check(message)
-    # TESTING
-    logger.info(
-        f"@{message.author.name}: {message.content}",
+    logger.debug(
+        "received message",
+        content=message.content,
         early_exit_check=check,
     )
 
     # checks to make sure we can/should even send a reply
     if check.should_exit:
-        await maybe_add_reaction(message)
+        if should_add_reaction(message):
+            scheduler.submit(
+                channel.id, lambda: add_reaction(message), coalesce_key="reaction"
+            )
         return
 
+    # replies are generated one at a time per channel; anything that comes in while a reply is
+    # being generated is folded into a single follow-up reply to the latest message
     if is_mentioned(message):
-        async with channel.typing():
-            await send_channel_message_to(message)
-            return
+        scheduler.submit(
+            channel.id,
+            lambda: send_channel_message_to(message, RequestPriority.DIRECT),
+            coalesce_key="reply",
+            priority=RequestPriority.DIRECT,
+        )
+        return
 
     if is_reply_to_my_message(message):
-        async with channel.typing():
-            await send_channel_message_to(message)
-            return
+        scheduler.submit(
+            channel.id,
+            lambda: send_channel_message_to(message, RequestPriority.REPLY),
+            coalesce_key="reply",
+            priority=RequestPriority.REPLY,
+        )
+        return
 
     # chance to reply to any message in a channel
-    if random.random() < settings.RANDOM_REPLY_CHANCE:
+    if random.random() < current_guild_settings().RANDOM_REPLY_CHANCE:
         logger.info(
             f"*** Randomly replying to `{message.author.name}` in `{channel.name}` ***"
         )
-        await send_channel_message_to(message)
+        scheduler.submit(
+            channel.id,
+            lambda: send_channel_message_to(message, RequestPriority.BACKGROUND),
+            coalesce_key="reply",
+            priority=RequestPriority.BACKGROUND,
+        )
 
 
-async def send_channel_message_to(message: Message) -> None:
+async def send_channel_message_to(
+    message: Message, priority: RequestPriority = RequestPriority.DIRECT
+) -> None:
     """Send a message in a text channel.
 
-    Optionally add a reaction to the message first.
+    Optionally add a reaction to the message at the same time.
     """
-    await maybe_add_reaction(message)
-
-    async with message.channel.typing():
-        response, generated_image_url = await generate_ai_text_response(message)
-
-    if response is None:
-        await maybe_add_reaction(message)
-        return
-
-    # whether to reply directly to this message or not
-    if random.random() < 0.7:
-        await try_to_send_message(message, response, generated_image_url, as_reply=True)
-    else:
-        await try_to_send_message(message, response, generated_image_url)
+    # every OpenAI request made for this reply is queued at this priority when we're near the
+    # rate limits
+    request_priority.set(priority)
+    # shared by the reaction and text response so history, image summaries, etc. are only
+    # gathered once
+    context = MessageContext(message)
+    await respond_to(
+        message,
+        context,
+        with_reaction=should_add_reaction(message),
+        # whether to reply directly to this message or not
+        as_reply=random.random() < 0.7,
+    )
 
 
-async def maybe_add_reaction(message: Message):
+def should_add_reaction(message: Message) -> bool:
     chance = random.random()
-    adding_reaction = chance < settings.RANDOM_REACTION_CHANCE
+    settings_chance = current_guild_settings().RANDOM_REACTION_CHANCE
+    adding_reaction = chance < settings_chance
     logger.debug(
         f"react to message from {message.author.name}? {adding_reaction}",
         chance=chance,
-        settings_chance=settings.RANDOM_REACTION_CHANCE,
+        settings_chance=settings_chance,
     )
-    if adding_reaction:
-        await generate_ai_reaction(message)
+    return adding_reaction
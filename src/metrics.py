@@ -0,0 +1,329 @@
+import asyncio
+import math
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterator, TypeVar
+
+import structlog
+
+from src.settings import get_settings
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+LabelValues = tuple[str, ...]
+
+# seconds; covers everything from a cache hit to a slow image generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, **extra: str) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    type_name = ""
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+
+    def _label_values(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type_name}",
+            *self.samples(),
+        ]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self.values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._label_values(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """A value that can go up and down. If `callback` is given, it's called at scrape time and
+    should return the current values keyed by label values.
+    """
+
+    type_name = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        callback: Callable[[], dict[LabelValues, float]] | None = None,
+    ):
+        super().__init__(name, description, labels)
+        self.values: dict[LabelValues, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self._label_values(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._label_values(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_in_progress(self, **labels: str) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self) -> Iterator[str]:
+        values = self.values
+        if self.callback is not None:
+            try:
+                values = {**values, **self.callback()}
+            except Exception as e:
+                logger.error(f"error collecting {self.name}: {e}")
+        for key, value in values.items():
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = (*sorted(buckets), math.inf)
+        # label values -> (per-bucket counts, sum)
+        self.values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        if (entry := self.values.get(key)) is None:
+            entry = self.values[key] = ([0] * len(self.buckets), [0.0])
+        counts, total = entry
+        for idx, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                counts[idx] += 1
+                break
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.label_names, key, le=_format_value(upper_bound)
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {_format_value(total[0])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+
+stage_latency = registry.register(
+    Histogram(
+        "discordgpt_stage_duration_seconds",
+        "Time spent in each stage of handling a message.",
+        labels=("stage",),
+    )
+)
+stage_failures = registry.register(
+    Counter(
+        "discordgpt_stage_failures_total",
+        "Stages that timed out, failed or were skipped.",
+        labels=("stage", "reason"),
+    )
+)
+openai_tokens = registry.register(
+    Counter(
+        "discordgpt_openai_tokens_total",
+        "Tokens used by OpenAI requests, as reported by the API.",
+        labels=("model", "kind"),
+    )
+)
+openai_requests = registry.register(
+    Counter(
+        "discordgpt_openai_requests_total",
+        "OpenAI requests made (not counting retries).",
+        labels=("dispatcher",),
+    )
+)
+in_flight = registry.register(
+    Gauge(
+        "discordgpt_in_flight",
+        "Work currently in progress.",
+        labels=("kind",),
+    )
+)
+event_loop_lag = registry.register(
+    Gauge(
+        "discordgpt_event_loop_lag_seconds",
+        "How late the most recent event loop lag probe woke up.",
+    )
+)
+
+
+class StatsSources:
+    """`stats()` methods of long-lived objects (caches, queues), read on every scrape."""
+
+    def __init__(self):
+        self.sources: dict[str, Callable[[], dict[str, float]]] = {}
+
+    def add(self, source: str, stats: Callable[[], dict[str, float]]) -> None:
+        self.sources[source] = stats
+
+    def collect(self) -> dict[LabelValues, float]:
+        return {
+            (source, stat): value
+            for source, stats in self.sources.items()
+            for stat, value in stats().items()
+        }
+
+
+cache_stats = StatsSources()
+registry.register(
+    Gauge(
+        "discordgpt_cache",
+        "Cache hit/miss counts and hit rates.",
+        labels=("cache", "stat"),
+        callback=cache_stats.collect,
+    )
+)
+queue_stats = StatsSources()
+registry.register(
+    Gauge(
+        "discordgpt_queue",
+        "Scheduler and OpenAI request queue sizes, in-flight work and totals.",
+        labels=("queue", "stat"),
+        callback=queue_stats.collect,
+    )
+)
+
+
+async def monitor_event_loop_lag(interval: float) -> None:
+    """Measure how far behind schedule the event loop is running, by how much later than asked a
+    sleep wakes up.
+    """
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started_at - interval)
+        event_loop_lag.set(lag)
+        if lag > 1:
+            logger.warning(f"event loop is running {lag:.2f}s behind")
+
+
+async def handle_metrics(request: "web.Request") -> "web.Response":
+    from aiohttp import web
+
+    return web.Response(
+        text=registry.render(), content_type="text/plain", charset="utf-8"
+    )
+
+
+class MetricsServer:
+    """Serves `/metrics` in the Prometheus text format, and runs the event loop lag probe."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.runner: "web.AppRunner | None" = None
+        self.lag_monitor: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        # the web server is only loaded when metrics are enabled
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        self.lag_monitor = asyncio.create_task(
+            monitor_event_loop_lag(settings.METRICS_LOOP_LAG_INTERVAL_SECONDS)
+        )
+        logger.info(f"serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self.lag_monitor is not None:
+            self.lag_monitor.cancel()
+            self.lag_monitor = None
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+metrics_server = MetricsServer(settings.METRICS_HOST, settings.METRICS_PORT)
@@ -1,122 +1,57 @@
+import asyncio
+import contextlib
 import json
-from datetime import datetime, timedelta
-from typing import Literal
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Awaitable, Callable, Literal
 
 import structlog
-from discord import Attachment, Message
-from openai import OpenAI
-from openai.types.chat.chat_completion import ChatCompletion, ChatCompletionMessage
-from rich import print as rprint
-
+from discord import Message
+
+from src.guild_settings import current_guild_settings
+from src.messaging.emojis import GuildEmojis
+from src.metrics import stage_latency
+from src.openai_api.client import get_openai_client
+from src.openai_api.context import MessageContext
+from src.openai_api.dispatcher import chat_dispatcher
 from src.openai_api.function_calls import MODEL_FUNCTIONS
+from src.openai_api.image_intent import (
+    image_intent_decisions,
+    image_intent_gate,
+    record_image_intent,
+)
+from src.openai_api.images import ImageJob, generate_image, start_image_job
+from src.openai_api.routing_cache import (
+    RoutingDecision,
+    routing_cache,
+    routing_cache_key,
+)
+from src.openai_api.stages import run_stage
+from src.openai_api.tokens import estimate_request_tokens
 from src.settings import get_settings
 
+if TYPE_CHECKING:
+    from openai.types.chat.chat_completion import ChatCompletion, ChatCompletionMessage
+
 logger = structlog.get_logger()
 settings = get_settings()
 
+# called with the full response text so far while a completion is streaming
+TextCallback = Callable[[str], Awaitable[None]]
 
-async def get_message_history(message: Message, limit: int = 10) -> list[Message]:
-    # get messages from the last hour up to the limit
-    history_lookback: datetime = message.created_at - timedelta(hours=1)
-    # get previous messages as context up to the current message (but at most `limit` messages)
-    # and also add the current message in at the end
-    messages = [
-        msg
-        async for msg in message.channel.history(
-            # limit=limit,
-            after=history_lookback,
-            before=message.created_at,
-        )
-    ][-limit:]
-    messages.append(message)
-    # reverse the list so the oldest message is first
-    # NOTE: this isn't necessary with `after` in the history call
-    # messages.reverse()
-    return messages
-
-
-async def generate_context_messages(
-    message: Message,
-    check_for_image_attachments: bool = False,
-) -> list[dict]:
-    # TODO: this shouldn't be required once the Assistants API is used with thread IDs
-    messages: list[Message] = await get_message_history(message)
-
-    # add a starting prompt to the context to set the tone and instructions for the model
-    starting_prompt = (
-        f"You are user ID {settings.CLIENT_USER_ID}. {settings.OPENAI_STARTING_PROMPT}"
-    )
-    context_messages = [{"role": "system", "content": starting_prompt}]
-
-    # add the previous messages to the context, with some print debugging
-    debug_lines = []
-    for other_message in messages:
-        msg_time = other_message.created_at.strftime("%Y-%m-%d %H:%M:%S")
-
-        if other_message.author.name.lower() == settings.DISCORD_BOT_NAME.lower():
-            # sent by the bot
-            message_dict = {
-                "role": "assistant",
-                "content": other_message.content,
-            }
-            debug_lines.append(
-                f"{msg_time} | {message_dict['role']}: {message_dict['content']}"
-            )
-        else:
-            # sent by a user
-            message_dict = {
-                "role": "user",
-                "content": other_message.content,
-                "name": other_message.author.name,
-            }
-            debug_lines.append(
-                f"{msg_time} | {message_dict['role']} ({message_dict['name']}): {message_dict['content']}"
-            )
-
-        context_messages.append(message_dict)
-
-        if check_for_image_attachments:
-            # if any image attachments were included, send them to the vision model for a summary
-            # before creating the final text response
-            image_attachment_messages = await get_image_attachment_context(
-                other_message
-            )
-            if image_attachment_messages:
-                debug_lines.append(
-                    f"{msg_time} | {image_attachment_messages[0]['role']}: {image_attachment_messages[0]['content']}"
-                )
-            context_messages = context_messages + image_attachment_messages
 
-    # print the debug lines (not printing them within the loop since they might get mixed up with
-    # the normal log lines)
-    debug_lines_str = "\n".join(debug_lines)
-    rprint(debug_lines_str)
-
-    return context_messages
-
-
-async def generate_ai_reaction(message: Message) -> None:
-    context_messages = await generate_context_messages(
-        message,
-        check_for_image_attachments=True,
-    )
+async def generate_ai_reaction(context: MessageContext) -> None:
+    message = context.message
+    context_messages = await context.context_messages()
 
     # get available server emojis if this isn't a DM
-    server_emojis = {}
-    if (server := message.guild) is not None:
-        emoji_list = await server.fetch_emojis()
-        server_emojis = {emoji.name: emoji for emoji in emoji_list}
-
-    emoji_str = "emoji(s)."
-    if server_emojis:
-        emoji_str = f"the name(s) of one or more available server emoji(s): {list(server_emojis.keys())!r}\n\n...or emoji(s)."
+    server_emojis = context.server_emojis()
 
     # temporary context for adding a reaction to the message, not to be used in the final response generation
     temp_reaction_context = context_messages[:]
     temp_reaction_context.append(
         {
             "role": "system",
-            "content": f"NOT REQUIRED: Optionally add a reaction to the previous message with {emoji_str}",
+            "content": f"NOT REQUIRED: Optionally add a reaction to the previous message with {server_emojis.prompt_fragment}",
         }
     )
 
@@ -136,126 +71,246 @@ async def generate_ai_reaction(message: Message) -> None:
             )
 
 
-async def generate_ai_text_response(message: Message) -> tuple[str | None, str]:
-    context_messages: list[dict] = await generate_context_messages(
-        message,
-        check_for_image_attachments=True,
-    )
+async def generate_ai_text_response(
+    context: MessageContext,
+    include_reaction: bool = False,
+    on_text: TextCallback | None = None,
+) -> tuple[str | None, ImageJob | None]:
+    """Generate the text response for a message, and start generating an image for it if one was
+    asked for. The image is generated in the background while the text is written, and is
+    returned as a job for the reply to attach once it's ready.
 
-    # possibly create an image based on previous messages (to include any attachmented images)
-    created_image_url, created_image_messages = await create_image_context(
-        message, context_messages
-    )
-    context_messages += created_image_messages
-
-    # finally, generate the text response
-    client = OpenAI(api_key=settings.OPENAI_API_KEY)
-    response: ChatCompletion = client.chat.completions.create(
-        model=settings.OPENAI_MODEL,
-        messages=context_messages,  # type: ignore
-        user=message.author.name,
-    )
-    response_text = response.choices[0].message.content or ""
-    logger.warning(f"sending response: {response_text!r}")
-    return response_text, created_image_url
-
-
-async def generate_image(
-    prompt: str,
-    user_name: str,
-    style: Literal["vivid", "natural"] = "vivid",
-) -> str | None:
-    client = OpenAI(api_key=settings.OPENAI_API_KEY)
-    response = client.images.generate(
-        model=settings.OPENAI_IMAGE_GEN_MODEL,
-        prompt=prompt,
-        size="1024x1024",
-        quality="standard",
-        style=style,
-        n=1,
-        user=user_name,
+    In "unified" tool routing mode, a single model call handles the reaction (if
+    `include_reaction` is set), image and text; otherwise the reaction is expected to be handled
+    separately by `generate_ai_reaction`.
+
+    If `on_text` is passed, the text completion is streamed and `on_text` is called with the full
+    text so far as each chunk arrives.
+    """
+    if current_guild_settings().OPENAI_TOOL_ROUTING_MODE == "unified":
+        return await generate_ai_unified_response(context, include_reaction, on_text)
+
+    message = context.message
+    context_messages: list[dict] = await context.context_messages()
+
+    # don't show a streamed draft until we know it won't be replaced by one that knows about a
+    # generated image
+    image_intent_checked = asyncio.Event()
+
+    async def on_draft_text(text: str) -> None:
+        if on_text is not None and image_intent_checked.is_set():
+            await on_text(text)
+
+    # draft the text response while checking whether an image should be created; most of the time
+    # no image is needed and the draft can be sent as-is
+    async with asyncio.TaskGroup() as tg:
+        draft_task = tg.create_task(
+            run_stage(
+                "text",
+                get_text_completion(
+                    message,
+                    context_messages,
+                    on_text=on_draft_text if on_text is not None else None,
+                ),
+                timeout=settings.STAGE_TIMEOUT_TEXT_SECONDS,
+                default=None,
+            )
+        )
+        # possibly create an image based on previous messages (to include any attachmented images)
+        image_request = await run_stage(
+            "image intent",
+            get_image_request(context_messages),
+            timeout=settings.STAGE_TIMEOUT_IMAGE_INTENT_SECONDS,
+            default=None,
+        )
+        if image_request is not None:
+            # the draft won't know about the image, so it'll need to be regenerated
+            draft_task.cancel()
+        else:
+            image_intent_checked.set()
+
+    if image_request is None:
+        response_text = draft_task.result()
+        image_job = None
+    else:
+        image_job, image_messages = create_image_context(message, image_request)
+        context_messages += image_messages
+        response_text = await run_stage(
+            "text",
+            get_text_completion(message, context_messages, on_text=on_text),
+            timeout=settings.STAGE_TIMEOUT_TEXT_SECONDS,
+            default=None,
+        )
+
+    if response_text is None:
+        return None, image_job
+    logger.debug("sending response", response_text=response_text)
+    return response_text, image_job
+
+
+async def generate_ai_unified_response(
+    context: MessageContext,
+    include_reaction: bool,
+    on_text: TextCallback | None = None,
+) -> tuple[str | None, ImageJob | None]:
+    """Decide on the reaction, image and text response in one model call, then run whichever
+    function calls come back.
+
+    The text written as a function call argument isn't streamed; `on_text` is only used for the
+    follow-up completion when the model asked for an image without any text.
+    """
+    message = context.message
+    context_messages: list[dict] = await context.context_messages()
+
+    function_names = ["generate_text_response"]
+    instructions = "Respond to the previous message by calling generate_text_response."
+    # only offer the image tool when the local check thinks an image might be wanted
+    gate_fired, _ = image_intent_gate(context_messages[-2:])
+    if gate_fired or settings.IMAGE_INTENT_GATE != "on":
+        function_names.append("generate_image")
+        instructions += " If the user is asking for an image to be created or edited, also call generate_image."
+    server_emojis = context.server_emojis()
+    if include_reaction:
+        function_names.append("generate_message_reaction")
+        instructions += f"\n\nNOT REQUIRED: Optionally add a reaction to the previous message with {server_emojis.prompt_fragment}"
+
+    function_call_bundles, response_text = await run_stage(
+        "unified tool routing",
+        get_function_call_and_text_response(
+            context_messages + [{"role": "system", "content": instructions}],
+            function_names=function_names,
+        ),
+        timeout=settings.STAGE_TIMEOUT_TEXT_SECONDS,
+        default=([], None),
     )
-    image_url = response.data[0].url
-    return image_url
 
+    image_request: ImageRequest | None = None
+    for function_call, function_parameters in function_call_bundles:
+        if function_call is generate_text_response:
+            response_text = await function_call(**function_parameters)
+        elif function_call is generate_message_reaction:
+            await run_stage(
+                "reaction",
+                function_call(
+                    message,
+                    function_parameters.get("emojis", []),
+                    server_emojis,
+                    function_parameters.get("reasoning"),
+                ),
+                timeout=settings.STAGE_TIMEOUT_REACTION_SECONDS,
+                default=None,
+            )
+        elif function_call is generate_image and image_request is None:
+            if image_prompt := function_parameters.get("prompt", ""):
+                image_request = ImageRequest(
+                    prompt=image_prompt,
+                    style=function_parameters.get("style", "vivid"),
+                )
+            else:
+                logger.warning(
+                    f"missing prompt in function call: {function_parameters!r}"
+                )
+
+    image_job = None
+    if image_request is not None:
+        image_job, image_messages = create_image_context(message, image_request)
+        if not response_text:
+            # the model only asked for the image, so follow up with the text response now that it
+            # knows the image is on its way
+            response_text = await run_stage(
+                "text",
+                get_text_completion(
+                    message,
+                    context_messages + image_messages,
+                    on_text=on_text,
+                ),
+                timeout=settings.STAGE_TIMEOUT_TEXT_SECONDS,
+                default=None,
+            )
 
-async def get_image_attachment_context(message: Message) -> list[dict[str, str]]:
-    if not message.attachments:
-        return []
+    if response_text is None:
+        return None, image_job
+    logger.debug("sending response", response_text=response_text)
+    return response_text, image_job
 
-    attached_images = []
-    for attachment_message in message.attachments:
-        attachment_message: Attachment  # type: ignore
-        if (content_type := getattr(attachment_message, "content_type", None)) is None:
-            continue
-        if not content_type.startswith("image/"):
-            # skip non-image attachments
-            continue
-        if (image_url := getattr(attachment_message, "proxy_url", None)) is None:
-            continue
-        attached_images.append(
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": image_url,
-                },
-            }
-        )
 
-    if attached_images:
-        num_attached_images = len(attached_images)
-        structlog.contextvars.bind_contextvars(num_attached_images=num_attached_images)
-        logger.info(f"summarizing {num_attached_images} attached image(s)")
-
-        image_count_str = "this image"
-        if num_attached_images > 1:
-            image_count_str = f"these {num_attached_images} images"
-        vision_prompt = f"Give a simple, concise summary of what's in {image_count_str}"
-
-        vision_message_context = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": vision_prompt},
-                ]
-                + attached_images,
-            }
-        ]
-
-        client = OpenAI(api_key=settings.OPENAI_API_KEY)
-        response = client.chat.completions.create(
-            model=settings.OPENAI_VISION_MODEL,
-            messages=vision_message_context,  # type: ignore
-            max_tokens=300,  # default is lower
+async def generate_text_response(response_text: str = "") -> str:
+    # the model already wrote the text as the function call argument
+    return response_text
+
+
+async def get_text_completion(
+    message: Message,
+    context_messages: list[dict],
+    on_text: TextCallback | None = None,
+) -> str:
+    client = get_openai_client()
+    model = current_guild_settings().OPENAI_MODEL
+    if on_text is None:
+        with stage_latency.time(stage="completion"):
+            response: "ChatCompletion" = await chat_dispatcher.call(
+                lambda: client.chat.completions.with_raw_response.create(
+                    model=model,
+                    messages=context_messages,  # type: ignore
+                    user=message.author.name,
+                ),
+                model=model,
+                estimated_tokens=estimate_request_tokens(context_messages),
+            )
+        if response.usage is not None:
+            logger.info(
+                "text completion token usage",
+                prompt_tokens=response.usage.prompt_tokens,
+                completion_tokens=response.usage.completion_tokens,
+            )
+        return response.choices[0].message.content or ""
+
+    with stage_latency.time(stage="completion"):
+        chunks = chat_dispatcher.stream(
+            lambda: client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=context_messages,  # type: ignore
+                user=message.author.name,
+                stream=True,
+                # the last chunk reports the token usage (and has no choices)
+                stream_options={"include_usage": True},
+            ),
+            model=model,
+            estimated_tokens=estimate_request_tokens(context_messages),
         )
-        image_summary_text = response.choices[0].message.content
-        logger.warning(f"vision response: {image_summary_text!r}")
+        response_text = ""
+        # closed right away (along with the stream) if the stage times out partway through
+        async with contextlib.aclosing(chunks):
+            async for chunk in chunks:
+                if not chunk.choices:
+                    continue
+                if delta := chunk.choices[0].delta.content:
+                    response_text += delta
+                    await on_text(response_text)
+    return response_text
 
-        structlog.contextvars.unbind_contextvars("num_attached_images")
-        return [
-            {
-                "role": "system",
-                "content": f"{message.author.name} uploaded {num_attached_images} image(s):\n{image_summary_text}",
-            }
-        ]
 
-    return []
+@dataclass
+class ImageRequest:
+    prompt: str
+    style: Literal["vivid", "natural"] = "vivid"
 
 
-async def create_image_context(
-    message: Message,
-    message_context: list[dict],
-) -> tuple[str, list[dict]]:
+async def get_image_request(message_context: list[dict]) -> ImageRequest | None:
     """Determine whether or not to create an image based on the message history and current message
-    content. If an image is created, return the image URL as well as a system message describing
-    what was made.
+    content, and if so, what prompt and style to use.
     """
-    image_url: str = ""
-    image_context: list[dict] = []
-
     # don't use the full message history, because that will skew the prompting too much. just use
     # the last 1-2 messages, which will be the most relevant to the current message
     recent_message_context = message_context[-2:]
+
+    # most messages obviously aren't asking for an image, so a local check decides whether it's
+    # worth asking the model at all
+    gate_fired, gate_score = image_intent_gate(recent_message_context)
+    if settings.IMAGE_INTENT_GATE == "on" and not gate_fired:
+        image_intent_decisions.inc(gate="skip", model="not asked")
+        return None
+
     image_gen_message_context = recent_message_context + [
         {
             "role": "system",
@@ -267,37 +322,53 @@ async def create_image_context(
         image_gen_message_context,
         function_names=["generate_image", "auto"],
     )
-    for function_call, function_parameters in image_function_calls:
+    if settings.IMAGE_INTENT_GATE == "shadow":
+        record_image_intent(gate_fired, gate_score, bool(image_function_calls))
+    elif settings.IMAGE_INTENT_GATE == "on":
+        image_intent_decisions.inc(
+            gate="fire", model="image" if image_function_calls else "no image"
+        )
+
+    for _, function_parameters in image_function_calls:
         # make sure an image prompt was generated
         image_prompt: str = function_parameters.get("prompt", "")
         if not image_prompt:
             logger.warning(f"missing prompt in function call: {function_parameters!r}")
-            return image_url, image_context
+            return None
 
         image_style = function_parameters.get("style", "vivid")
-        # function_call is really just `generate_image` here
-        image_url = await function_call(
-            prompt=image_prompt,
-            style=image_style,
-            user_name=message.author.name,  # type: ignore
-        )
-        if image_url:
-            # let the model know an image was created successfully and include the generated prompt
-            image_context = [
-                {
-                    "role": "system",
-                    "content": f"The image was successfully generated with the following prompt: `{image_prompt!r}`\n\nYou will attach it in your response; DON'T ADD IMAGE MARKDOWN SYNTAX.",
-                }
-            ]
-            return image_url, image_context
+        return ImageRequest(prompt=image_prompt, style=image_style)
+
+    return None
 
-    return image_url, image_context
+
+def create_image_context(
+    message: Message,
+    image_request: ImageRequest,
+) -> tuple[ImageJob, list[dict]]:
+    """Start creating an image for the given request, and return the job along with a system
+    message describing what's being made.
+    """
+    image_job = start_image_job(
+        prompt=image_request.prompt,
+        style=image_request.style,
+        user_name=message.author.name,  # type: ignore
+    )
+
+    # let the model know an image is being created and include the generated prompt
+    image_context = [
+        {
+            "role": "system",
+            "content": f"An image is being generated with the following prompt: `{image_request.prompt!r}`\n\nIt will be attached to your response once it's ready; DON'T ADD IMAGE MARKDOWN SYNTAX.",
+        }
+    ]
+    return image_job, image_context
 
 
 async def generate_message_reaction(
     message: Message,
     emojis: list[str],
-    server_emojis: dict,
+    server_emojis: GuildEmojis,
     reasoning: str = "",
 ):
     logger.info(f"adding reactions to message: {emojis!r} -> {reasoning=}")
@@ -320,6 +391,19 @@ async def get_function_call_response(
     message_context: list[dict],
     function_names: list[str],
 ):
+    function_call_bundles, _ = await get_function_call_and_text_response(
+        message_context, function_names
+    )
+    return function_call_bundles
+
+
+async def get_function_call_and_text_response(
+    message_context: list[dict],
+    function_names: list[str],
+) -> tuple[list[tuple[Callable, dict]], str]:
+    """Ask the model to call one or more of the named functions. Returns the parsed function call
+    bundles, along with any plain text content the model sent alongside (or instead of) them.
+    """
     if isinstance(function_names, str):
         function_names = [function_names]
 
@@ -342,31 +426,75 @@ async def get_function_call_response(
     )
     if not focused_model_functions:
         logger.warning("no focused model functions found for function names")
-        return
-
-    logger.debug("getting function call response...")
-    client = OpenAI(api_key=settings.OPENAI_API_KEY)
-    response: ChatCompletion = client.chat.completions.create(
-        model=settings.OPENAI_MODEL,
-        messages=message_context,  # type: ignore
-        tools=focused_model_functions,
-        tool_choice=tool_choice,
-    )
-    response_message: ChatCompletionMessage = response.choices[0].message
+        return [], ""
 
     FUNCTION_CALLS = {
         "generate_image": generate_image,
         "generate_message_reaction": generate_message_reaction,
+        "generate_text_response": generate_text_response,
     }
 
-    function_call_bundles = []
+    # when the reply's text is written as one of the function calls, the decision *is* the reply,
+    # so reusing it would send a canned copy of an earlier reply instead of writing a new one
+    cache_key = None
+    if "generate_text_response" not in function_names:
+        cache_key = routing_cache_key(
+            message_context, function_names, current_guild_settings().OPENAI_MODEL
+        )
+    if cache_key is None or (decision := routing_cache.get(cache_key)) is None:
+        decision = await get_routing_decision(
+            message_context, function_names, focused_model_functions, tool_choice
+        )
+        if cache_key is not None:
+            routing_cache.set(cache_key, decision)
+    else:
+        logger.debug("reusing cached routing decision", **routing_cache.stats())
+
+    function_calls, response_content = decision
+    function_call_bundles = [
+        (FUNCTION_CALLS[function_name], function_parameters)
+        for function_name, function_parameters in function_calls
+    ]
+    if not function_call_bundles:
+        logger.info("decided not to call any function(s)")
+
+    structlog.contextvars.unbind_contextvars(
+        "function_names", "tool_choice", "focused_model_functions"
+    )
+    return function_call_bundles, response_content
+
+
+async def get_routing_decision(
+    message_context: list[dict],
+    function_names: list[str],
+    focused_model_functions: list[dict],
+    tool_choice: str | dict,
+) -> RoutingDecision:
+    """Make the tool routing call and parse out the (function name, parameters) pairs."""
+    logger.debug("getting function call response...")
+    client = get_openai_client()
+    model = current_guild_settings().OPENAI_MODEL
+    with stage_latency.time(stage="function call"):
+        response: "ChatCompletion" = await chat_dispatcher.call(
+            lambda: client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=message_context,  # type: ignore
+                tools=focused_model_functions,
+                tool_choice=tool_choice,
+            ),
+            model=model,
+            estimated_tokens=estimate_request_tokens(message_context),
+        )
+    response_message: "ChatCompletionMessage" = response.choices[0].message
+
+    function_calls = []
     tool_calls = response_message.tool_calls or []
     for tool_call in tool_calls:
         if (tool_func := tool_call.function) is None:
             continue
-        logger.info(
-            f"decided to call function: {tool_func.name!r} with args: {tool_func.arguments!r}"
-        )
+        logger.info(f"decided to call function: {tool_func.name!r}")
+        # the arguments can hold the whole response text
+        logger.debug("function call arguments", arguments=tool_func.arguments)
         if tool_func.name not in function_names:
             # hallucinated function name
             continue
@@ -378,13 +506,5 @@ async def get_function_call_response(
             logger.warning(f"invalid JSON in function call: {tool_func.arguments!r}")
             continue
 
-        tool_func_callable = FUNCTION_CALLS[tool_func.name]
-        function_call_bundle = (tool_func_callable, function_parameters)
-        function_call_bundles.append(function_call_bundle)
-    if not function_call_bundles:
-        logger.info("decided not to call any function(s)")
-
-    structlog.contextvars.unbind_contextvars(
-        "function_names", "tool_choice", "focused_model_functions"
-    )
-    return function_call_bundles
+        function_calls.append((tool_func.name, function_parameters))
+    return function_calls, response_message.content or ""
@@ -0,0 +1,55 @@
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+import httpx
+import structlog
+
+from src.settings import get_settings
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+
+@lru_cache
+def get_openai_client() -> "AsyncOpenAI":
+    """Return the process-wide async OpenAI client.
+
+    The underlying HTTP client keeps a pool of keep-alive connections so we aren't doing a fresh
+    TLS handshake for every completion, and since everything is awaited, a slow completion no
+    longer blocks the Discord gateway event loop.
+    """
+    # the openai package takes a good chunk of startup time to import, and isn't needed until
+    # the first request (it's also preloaded in the background once the bot has logged in)
+    from openai import AsyncOpenAI
+
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=settings.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=httpx.Timeout(
+            settings.OPENAI_TIMEOUT_SECONDS,
+            connect=settings.OPENAI_CONNECT_TIMEOUT_SECONDS,
+        ),
+    )
+    logger.debug(
+        "creating shared OpenAI client",
+        max_connections=settings.OPENAI_MAX_CONNECTIONS,
+        timeout=settings.OPENAI_TIMEOUT_SECONDS,
+    )
+    # retries are handled by the dispatcher, which knows about our rate limits
+    return AsyncOpenAI(
+        api_key=settings.OPENAI_API_KEY, http_client=http_client, max_retries=0
+    )
+
+
+async def close_openai_client() -> None:
+    """Close the shared client's connection pool (if it was ever created)."""
+    if get_openai_client.cache_info().currsize == 0:
+        return
+    await get_openai_client().close()
+    get_openai_client.cache_clear()
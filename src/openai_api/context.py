@@ -0,0 +1,279 @@
+import asyncio
+import contextvars
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Awaitable, Callable
+
+import structlog
+from discord import Message
+
+from src.guild_settings import current_guild_settings
+from src.log_config import LazyRepr
+from src.messaging.emojis import GuildEmojis, emoji_index
+from src.messaging.history import CachedMessage, history_cache
+from src.metrics import stage_latency
+from src.openai_api.dispatcher import RequestPriority, request_priority
+from src.openai_api.summaries import ChannelSummary, channel_summaries
+from src.openai_api.tokens import (
+    TOKENS_PER_MESSAGE,
+    count_tokens,
+    get_context_token_budget,
+    message_token_count,
+    truncate_to_tokens,
+)
+from src.openai_api.vision import get_image_attachment_contexts
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+
+@dataclass
+class MessageContext:
+    """Everything derived from a single incoming message that the reaction, image and text stages
+    all need. Each piece is computed the first time a stage asks for it and reused after that.
+    """
+
+    message: Message
+    # the reply's priority, which the shared work runs at whichever stage happens to start it
+    # (the reaction stage runs at BACKGROUND, but shouldn't get the reply's history shed)
+    priority: RequestPriority = field(default_factory=request_priority.get)
+    # estimated size of the rendered prompt, filled in by `generate_context_messages`
+    prompt_tokens: int = 0
+    _results: dict[str, asyncio.Future] = field(default_factory=dict, repr=False)
+
+    async def _memoize(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        if key not in self._results:
+            context = contextvars.copy_context()
+            context.run(request_priority.set, self.priority)
+            self._results[key] = asyncio.get_running_loop().create_task(
+                factory(), context=context
+            )
+        # shielded so one stage being cancelled doesn't cancel the work for the others
+        return await asyncio.shield(self._results[key])
+
+    async def channel_summary(self) -> ChannelSummary | None:
+        """The running summary of the channel's older messages, if there is one yet."""
+        if not settings.CHANNEL_SUMMARIES_ENABLED:
+            return None
+        return await self._memoize(
+            "channel_summary", lambda: channel_summaries.get(self.message.channel.id)
+        )
+
+    async def history(self) -> list[CachedMessage]:
+        async def timed_history() -> list[CachedMessage]:
+            summary = await self.channel_summary()
+            with stage_latency.time(stage="history"):
+                return await get_message_history(
+                    self.message,
+                    reserved_tokens=(
+                        count_prompt_tokens(format_channel_summary(summary.summary))
+                        if summary is not None
+                        else 0
+                    ),
+                )
+
+        return await self._memoize("history", timed_history)
+
+    async def vision_summaries(self) -> list[list[dict]]:
+        """Image attachment summaries for each message in `history()`, in the same order."""
+
+        async def summarize_history() -> list[list[dict]]:
+            return await get_image_attachment_contexts(await self.history())
+
+        return await self._memoize("vision_summaries", summarize_history)
+
+    def server_emojis(self) -> GuildEmojis:
+        """Available server emojis, which will be empty for DMs."""
+        return emoji_index.get(self.message.guild)
+
+    async def context_messages(self) -> list[dict]:
+        """The rendered prompt messages. Returns a new list each time, so callers are free to
+        add their own messages to it.
+        """
+        try:
+            context_messages = await self._memoize(
+                "context_messages", lambda: generate_context_messages(self)
+            )
+        except Exception as e:
+            # still reply, just without the history
+            logger.exception(
+                f"couldn't build the prompt context, using the message alone: {e}"
+            )
+            context_messages = await self._memoize(
+                "fallback_context_messages", lambda: fallback_context_messages(self)
+            )
+        return context_messages[:]
+
+
+def format_prompt_dump(entries: list[tuple[datetime | None, dict]]) -> str:
+    lines = []
+    for created_at, message_dict in entries:
+        prefix = created_at.strftime("%Y-%m-%d %H:%M:%S") if created_at else "summary"
+        role = message_dict["role"]
+        if name := message_dict.get("name"):
+            role = f"{role} ({name})"
+        lines.append(f"{prefix} | {role}: {message_dict['content']}")
+    return "\n".join(lines)
+
+
+def get_starting_prompt() -> str:
+    starting_prompt = current_guild_settings().OPENAI_STARTING_PROMPT
+    return f"You are user ID {settings.CLIENT_USER_ID}. {starting_prompt}"
+
+
+def format_channel_summary(summary: str) -> str:
+    return f"Summary of the earlier conversation in this channel:\n{summary}"
+
+
+@lru_cache(maxsize=64)
+def count_prompt_tokens(prompt: str) -> int:
+    return count_tokens(prompt) + TOKENS_PER_MESSAGE
+
+
+def message_prompt_cost(message: CachedMessage) -> int:
+    # oversized messages get truncated when the prompt is rendered
+    return min(
+        message_token_count(message),
+        settings.CONTEXT_MAX_MESSAGE_TOKENS + TOKENS_PER_MESSAGE,
+    )
+
+
+async def get_message_history(
+    message: Message, reserved_tokens: int = 0
+) -> list[CachedMessage]:
+    """Get the previous messages that fit in the model's context token budget (less
+    `reserved_tokens`), oldest first, with the current message added at the end.
+
+    Older messages that didn't make it in are handed off to be folded into the channel's running
+    summary.
+    """
+    candidates = await history_cache.get_history(
+        message,
+        limit=settings.HISTORY_CACHE_MAX_MESSAGES_PER_CHANNEL,
+        lookback=None,
+    )
+    history_start = message.created_at - timedelta(
+        minutes=settings.CONTEXT_LOOKBACK_MINUTES
+    )
+    token_budget = (
+        get_context_token_budget()
+        - count_prompt_tokens(get_starting_prompt())
+        - reserved_tokens
+    )
+
+    # the current message always goes in, then fill the rest of the budget newest-first
+    *previous_messages, current_message = candidates
+    selected = [current_message]
+    used_tokens = message_prompt_cost(current_message)
+    num_aged_out = len(previous_messages)
+    for previous_message in reversed(previous_messages):
+        if previous_message.created_at <= history_start:
+            break
+        cost = message_prompt_cost(previous_message)
+        if used_tokens + cost > token_budget:
+            break
+        selected.append(previous_message)
+        used_tokens += cost
+        num_aged_out -= 1
+
+    if settings.CHANNEL_SUMMARIES_ENABLED and num_aged_out:
+        channel_summaries.schedule_refresh(
+            message.channel.id, previous_messages[:num_aged_out]
+        )
+
+    selected.reverse()
+    return selected
+
+
+async def fallback_context_messages(context: MessageContext) -> list[dict]:
+    """Just the starting prompt and the current message, for when the full context can't be
+    built.
+    """
+    starting_prompt = get_starting_prompt()
+    content = truncate_to_tokens(
+        context.message.content, settings.CONTEXT_MAX_MESSAGE_TOKENS
+    )
+    context.prompt_tokens = count_prompt_tokens(starting_prompt) + count_prompt_tokens(
+        content
+    )
+    return [
+        {"role": "system", "content": starting_prompt},
+        {"role": "user", "content": content, "name": context.message.author.name},
+    ]
+
+
+async def generate_context_messages(context: MessageContext) -> list[dict]:
+    # TODO: this shouldn't be required once the Assistants API is used with thread IDs
+    messages: list[CachedMessage] = await context.history()
+    try:
+        vision_summaries: list[list[dict]] = await context.vision_summaries()
+    except Exception as e:
+        # the history is still worth sending without the image summaries
+        logger.warning(f"couldn't summarize image attachments: {e}")
+        vision_summaries = [[] for _ in messages]
+    channel_summary = await context.channel_summary()
+
+    # add a starting prompt to the context to set the tone and instructions for the model
+    starting_prompt = get_starting_prompt()
+    context_messages = [{"role": "system", "content": starting_prompt}]
+    prompt_tokens = count_prompt_tokens(starting_prompt)
+
+    # (timestamp, message) pairs for the prompt dump, only rendered if debug logging is enabled
+    dump_entries: list[tuple[datetime | None, dict]] = []
+
+    # carry over what was said before the messages that fit in the prompt
+    if channel_summary is not None:
+        summary_prompt = format_channel_summary(channel_summary.summary)
+        context_messages.append({"role": "system", "content": summary_prompt})
+        prompt_tokens += count_prompt_tokens(summary_prompt)
+        dump_entries.append((None, context_messages[-1]))
+
+    # add the previous messages to the context
+    for other_message, image_attachment_messages in zip(messages, vision_summaries):
+        content = other_message.content
+        if message_token_count(other_message) > message_prompt_cost(other_message):
+            content = truncate_to_tokens(content, settings.CONTEXT_MAX_MESSAGE_TOKENS)
+        prompt_tokens += message_prompt_cost(other_message)
+
+        if other_message.author_name.lower() == settings.DISCORD_BOT_NAME.lower():
+            # sent by the bot
+            message_dict = {
+                "role": "assistant",
+                "content": content,
+            }
+        else:
+            # sent by a user
+            message_dict = {
+                "role": "user",
+                "content": content,
+                "name": other_message.author_name,
+            }
+
+        context_messages.append(message_dict)
+        dump_entries.append((other_message.created_at, message_dict))
+
+        # include the vision model's summary of any image attachments
+        if image_attachment_messages:
+            prompt_tokens += sum(
+                count_tokens(msg["content"]) + TOKENS_PER_MESSAGE
+                for msg in image_attachment_messages
+            )
+            dump_entries.append(
+                (other_message.created_at, image_attachment_messages[0])
+            )
+        context_messages = context_messages + image_attachment_messages
+
+    logger.debug(
+        "prompt dump", prompt=LazyRepr(lambda: "\n" + format_prompt_dump(dump_entries))
+    )
+
+    context.prompt_tokens = prompt_tokens
+    logger.info(
+        f"assembled prompt with {len(messages)} message(s)",
+        prompt_tokens=prompt_tokens,
+        token_budget=get_context_token_budget(),
+    )
+
+    return context_messages
@@ -0,0 +1,369 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, AsyncIterator, Awaitable, Callable, Mapping
+
+import structlog
+
+from src.metrics import in_flight, openai_requests, openai_tokens, queue_stats
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+
+class RequestPriority(IntEnum):
+    # direct mentions and DMs
+    DIRECT = 0
+    # replies to the bot's messages
+    REPLY = 1
+    # random replies/reactions; these are dropped instead of waiting when things are backed up
+    BACKGROUND = 2
+
+
+# set by the messaging handlers so every OpenAI call made while handling a message is dispatched
+# at the right priority
+request_priority: ContextVar[RequestPriority] = ContextVar(
+    "request_priority", default=RequestPriority.DIRECT
+)
+
+
+class RequestShedError(Exception):
+    """Raised instead of making a low-priority request when the dispatcher is backed up."""
+
+
+class TokenBucket:
+    """Per-minute rate limit accounting that refills continuously."""
+
+    def __init__(self, per_minute: int):
+        if per_minute <= 0:
+            # it would never refill
+            raise ValueError(f"per_minute must be positive, not {per_minute}")
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.refill_per_second = per_minute / 60
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(
+            self.capacity, self.level + (now - self.updated_at) * self.refill_per_second
+        )
+        self.updated_at = now
+
+    def time_until(self, amount: float) -> float:
+        """Seconds until `amount` can be consumed (0 if it can be consumed now)."""
+        self._refill()
+        # never wait on a request that's bigger than the whole bucket; it just drains it
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_per_second
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+    def sync(self, remaining: float) -> None:
+        """Trust the API's own count of what's left."""
+        self._refill()
+        self.level = min(self.capacity, remaining)
+
+
+class RateLimits:
+    """Request and token buckets for a single model, since that's what OpenAI's limits (and the
+    rate limit headers on its responses) apply to. A limit of 0 means no limit.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int | None):
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def delay(self, estimated_tokens: int) -> float:
+        delay = 0.0
+        if self.requests is not None:
+            delay = self.requests.time_until(1)
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.time_until(estimated_tokens))
+        return delay
+
+    def consume(self, estimated_tokens: int) -> None:
+        if self.requests is not None:
+            self.requests.consume(1)
+        if self.tokens is not None:
+            self.tokens.consume(estimated_tokens)
+
+    def sync_from_headers(self, headers: Mapping[str, str]) -> bool:
+        """Trust the API's own counts of what's left. Returns whether the token count was synced."""
+        if self.requests is not None:
+            if (
+                remaining := _header_float(headers, "x-ratelimit-remaining-requests")
+            ) is not None:
+                self.requests.sync(remaining)
+        if self.tokens is not None:
+            if (
+                remaining := _header_float(headers, "x-ratelimit-remaining-tokens")
+            ) is not None:
+                self.tokens.sync(remaining)
+                return True
+        return False
+
+
+def _header_float(headers: Mapping[str, str], name: str) -> float | None:
+    try:
+        return float(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class OpenAIDispatcher:
+    """Sends OpenAI API requests in priority order while staying under requests-per-minute and
+    tokens-per-minute limits, retrying rate limit and transient errors with jittered backoff.
+    """
+
+    def __init__(
+        self, name: str, requests_per_minute: int, tokens_per_minute: int | None
+    ):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # every model gets its own buckets, each with the configured limits
+        self.limits: dict[str, RateLimits] = {}
+
+        self.condition = asyncio.Condition()
+        self.queue: list[tuple[int, int, float]] = []
+        self._sequence = itertools.count()
+
+        self.total_requests = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.retries = 0
+        self.shed = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.queue)
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "queue_depth": self.queue_depth,
+            "total_requests": self.total_requests,
+            "avg_wait_seconds": (
+                self.total_wait_seconds / self.total_requests
+                if self.total_requests
+                else 0.0
+            ),
+            "max_wait_seconds": self.max_wait_seconds,
+            "retries": self.retries,
+            "shed": self.shed,
+        }
+
+    def _limits(self, model: str) -> RateLimits:
+        if (limits := self.limits.get(model)) is None:
+            limits = self.limits[model] = RateLimits(
+                self.requests_per_minute, self.tokens_per_minute
+            )
+        return limits
+
+    async def _acquire(
+        self, priority: RequestPriority, limits: RateLimits, estimated_tokens: int
+    ) -> None:
+        if (
+            priority == RequestPriority.BACKGROUND
+            and self.queue_depth >= settings.OPENAI_BACKGROUND_MAX_QUEUE_DEPTH
+        ):
+            self.shed += 1
+            raise RequestShedError(
+                f"{self.name} queue is backed up ({self.queue_depth})"
+            )
+
+        started_at = time.monotonic()
+        entry = (int(priority), next(self._sequence), started_at)
+        async with self.condition:
+            heapq.heappush(self.queue, entry)
+            try:
+                while True:
+                    delay = None
+                    if self.queue[0] is entry:
+                        delay = limits.delay(estimated_tokens)
+                        if delay <= 0:
+                            heapq.heappop(self.queue)
+                            break
+
+                    waited = time.monotonic() - started_at
+                    if priority == RequestPriority.BACKGROUND:
+                        remaining = settings.OPENAI_BACKGROUND_MAX_WAIT_SECONDS - waited
+                        if remaining <= 0:
+                            self.shed += 1
+                            raise RequestShedError(
+                                f"waited {waited:.1f}s for {self.name} rate limits"
+                            )
+                        delay = (
+                            min(delay, remaining) if delay is not None else remaining
+                        )
+
+                    try:
+                        async with asyncio.timeout(delay):
+                            await self.condition.wait()
+                    except TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self.queue:
+                    self.queue.remove(entry)
+                    heapq.heapify(self.queue)
+                raise
+            finally:
+                # let the next request in line check whether it's their turn
+                self.condition.notify_all()
+
+            limits.consume(estimated_tokens)
+
+        waited = time.monotonic() - started_at
+        self.total_requests += 1
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        if waited > 1:
+            logger.info(
+                f"waited {waited:.1f}s for {self.name} rate limits",
+                priority=priority.name,
+                queue_depth=self.queue_depth,
+            )
+
+    def _record_usage(
+        self,
+        response: Any,
+        limits: RateLimits,
+        estimated_tokens: int,
+        tokens_synced: bool,
+    ) -> None:
+        if (usage := getattr(response, "usage", None)) is None:
+            return
+        model = getattr(response, "model", "unknown")
+        openai_tokens.inc(usage.prompt_tokens, model=model, kind="prompt")
+        openai_tokens.inc(usage.completion_tokens, model=model, kind="completion")
+        if limits.tokens is None or tokens_synced:
+            # the API's own count (already synced from the headers) has this request in it
+            return
+        # correct our estimate now that we know what the request actually cost
+        limits.tokens.consume(usage.total_tokens - estimated_tokens)
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        response = getattr(error, "response", None)
+        if response is not None:
+            if (
+                retry_after := _header_float(response.headers, "retry-after")
+            ) is not None:
+                return retry_after
+        delay = min(
+            settings.OPENAI_RETRY_MAX_DELAY_SECONDS,
+            settings.OPENAI_RETRY_BASE_DELAY_SECONDS * 2**attempt,
+        )
+        # full jitter, so a burst of failed requests doesn't retry in lockstep
+        return random.uniform(0, delay)
+
+    async def call(
+        self,
+        request: Callable[[], Awaitable[Any]],
+        model: str,
+        estimated_tokens: int = 0,
+        priority: RequestPriority | None = None,
+    ) -> Any:
+        """Make a request for `model` through the dispatcher.
+
+        `request` should make a `.with_raw_response` API call, so rate limit headers can be read;
+        the parsed response is returned.
+        """
+        limits = self._limits(model)
+        response, tokens_synced = await self._send(
+            request, limits, estimated_tokens, priority
+        )
+        self._record_usage(response, limits, estimated_tokens, tokens_synced)
+        return response
+
+    async def stream(
+        self,
+        request: Callable[[], Awaitable[Any]],
+        model: str,
+        estimated_tokens: int = 0,
+        priority: RequestPriority | None = None,
+    ) -> AsyncIterator[Any]:
+        """Make a streamed request for `model` through the dispatcher, yielding its chunks.
+
+        `request` should make a `.with_raw_response` API call with
+        `stream_options={"include_usage": True}`, so its usage is recorded from the last chunk like
+        any other request's. It counts as in flight until the stream is used up.
+        """
+        limits = self._limits(model)
+        stream, tokens_synced = await self._send(
+            request, limits, estimated_tokens, priority
+        )
+        async with stream:
+            with in_flight.track_in_progress(kind=f"openai_{self.name}"):
+                async for chunk in stream:
+                    self._record_usage(chunk, limits, estimated_tokens, tokens_synced)
+                    yield chunk
+
+    async def _send(
+        self,
+        request: Callable[[], Awaitable[Any]],
+        limits: RateLimits,
+        estimated_tokens: int,
+        priority: RequestPriority | None,
+    ) -> tuple[Any, bool]:
+        """The parsed response, and whether the model's token count was synced from its headers."""
+        # imported here rather than at startup; `request` will have needed it by now anyway
+        import openai
+
+        if priority is None:
+            priority = request_priority.get()
+
+        openai_requests.inc(dispatcher=self.name)
+        for attempt in range(settings.OPENAI_MAX_RETRIES + 1):
+            await self._acquire(priority, limits, estimated_tokens)
+            try:
+                with in_flight.track_in_progress(kind=f"openai_{self.name}"):
+                    raw_response = await request()
+            except (
+                openai.RateLimitError,
+                openai.APIConnectionError,
+                openai.InternalServerError,
+            ) as e:
+                if attempt == settings.OPENAI_MAX_RETRIES:
+                    raise
+                if isinstance(e, openai.RateLimitError):
+                    # back off everyone using this model, not just this request
+                    if limits.requests is not None:
+                        limits.requests.sync(0)
+                    if (response := getattr(e, "response", None)) is not None:
+                        limits.sync_from_headers(response.headers)
+                delay = self._retry_delay(attempt, e)
+                self.retries += 1
+                logger.warning(
+                    f"{self.name} request failed, retrying in {delay:.1f}s: {e}",
+                    attempt=attempt + 1,
+                )
+                await asyncio.sleep(delay)
+                continue
+
+            tokens_synced = limits.sync_from_headers(raw_response.headers)
+            return raw_response.parse(), tokens_synced
+
+
+chat_dispatcher = OpenAIDispatcher(
+    "chat",
+    requests_per_minute=settings.OPENAI_REQUESTS_PER_MINUTE,
+    tokens_per_minute=settings.OPENAI_TOKENS_PER_MINUTE,
+)
+image_dispatcher = OpenAIDispatcher(
+    "image",
+    requests_per_minute=settings.OPENAI_IMAGES_PER_MINUTE,
+    tokens_per_minute=None,
+)
+queue_stats.add("openai_chat", chat_dispatcher.stats)
+queue_stats.add("openai_image", image_dispatcher.stats)
@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import structlog
+
+from src.metrics import cache_stats
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+
+def image_cache_key(prompt: str, style: str, model: str) -> str:
+    return hashlib.sha256(
+        json.dumps([prompt, style, model], ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+class GeneratedImageCache:
+    """Generated images, stored as files named by their cache key and evicted least recently used
+    first once they take up more than `max_bytes`. A `max_bytes` of 0 disables the cache (but
+    concurrent requests for the same image are still shared).
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+
+        # key -> file size, least recently used first; loaded from the directory on first use
+        self.index: OrderedDict[str, int] | None = None
+        self.total_bytes = 0
+        # images that are currently being generated, so identical requests share one call
+        self.in_flight: dict[str, asyncio.Future[bytes | None]] = {}
+
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._disk_lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.shared + self.misses
+        return (self.hits + self.shared) / lookups if lookups else 0.0
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "hits": self.hits,
+            "shared": self.shared,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "cached_bytes": self.total_bytes,
+            "hit_rate": self.hit_rate,
+        }
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.png"
+
+    def _load_index(self) -> OrderedDict[str, int]:
+        if self.index is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            files = []
+            for path in self.directory.glob("*.png"):
+                stat = path.stat()
+                files.append((stat.st_mtime, path.stem, stat.st_size))
+            files.sort()
+            self.index = OrderedDict((key, size) for _, key, size in files)
+            self.total_bytes = sum(self.index.values())
+        return self.index
+
+    def _read(self, key: str) -> bytes | None:
+        with self._disk_lock:
+            index = self._load_index()
+            if key not in index:
+                return None
+            path = self._path(key)
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                self.total_bytes -= index.pop(key)
+                return None
+            # the file's mtime is what orders the index after a restart
+            os.utime(path)
+            index.move_to_end(key)
+            return data
+
+    def _write(self, key: str, data: bytes) -> None:
+        with self._disk_lock:
+            index = self._load_index()
+            path = self._path(key)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(data)
+            tmp_path.replace(path)
+            self.total_bytes += len(data) - index.pop(key, 0)
+            index[key] = len(data)
+
+            while self.total_bytes > self.max_bytes and index:
+                oldest, size = index.popitem(last=False)
+                self._path(oldest).unlink(missing_ok=True)
+                self.total_bytes -= size
+                self.evictions += 1
+
+    async def get_or_generate(
+        self, key: str, generate: Callable[[], Awaitable[bytes | None]]
+    ) -> bytes | None:
+        """Return the cached image for `key`, or call `generate()` exactly once (even across
+        concurrent callers) to produce it.
+        """
+        if self.max_bytes > 0:
+            if (data := await asyncio.to_thread(self._read, key)) is not None:
+                self.hits += 1
+                logger.debug("image cache hit", cache_key=key, **self.stats())
+                return data
+
+        if (pending := self.in_flight.get(key)) is not None:
+            self.shared += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future: asyncio.Future[bytes | None] = (
+            asyncio.get_running_loop().create_future()
+        )
+        self.in_flight[key] = future
+        try:
+            data = await generate()
+            if data and len(data) <= self.max_bytes:
+                await asyncio.to_thread(self._write, key, data)
+            future.set_result(data)
+            return data
+        except asyncio.CancelledError:
+            # anyone sharing this image just doesn't get one, rather than being cancelled too
+            future.set_result(None)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # don't let an unretrieved exception get logged when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            self.in_flight.pop(key, None)
+            logger.debug("image cache miss", cache_key=key, **self.stats())
+
+
+image_cache = GeneratedImageCache(
+    directory=settings.IMAGE_CACHE_DIR
+    or str(Path(settings.DATA_DIR) / "generated_images"),
+    max_bytes=settings.IMAGE_CACHE_MAX_BYTES,
+)
+cache_stats.add("generated_images", image_cache.stats)
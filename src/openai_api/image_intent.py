@@ -0,0 +1,126 @@
+import re
+
+import structlog
+
+from src.metrics import Counter, registry
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+IMAGE_NOUNS = (
+    r"(image|picture|pic|photo|drawing|painting|sketch|illustration|art|artwork|logo|meme|"
+    r"wallpaper|portrait|icon|sticker|poster|render|comic)s?"
+)
+
+# hand-tuned (pattern, weight) rules, checked against the lowercased message text; a message's
+# score is the sum of the weights of every rule it matches
+IMAGE_INTENT_RULES: list[tuple[re.Pattern, float]] = [
+    (re.compile(r"\b(draw|paint|sketch|illustrate|doodle)\b"), 0.6),
+    (
+        re.compile(
+            rf"\b(generate|create|make|produce|design|show me|give me|send me)\b.{{0,40}}\b{IMAGE_NOUNS}\b"
+        ),
+        0.9,
+    ),
+    (re.compile(rf"\b{IMAGE_NOUNS} of\b"), 0.4),
+    (re.compile(r"\b(dall-?e|midjourney|stable diffusion|imagine)\b"), 0.4),
+    (re.compile(r"\bwhat (would|does|do) .{0,40} look like\b"), 0.4),
+    (
+        re.compile(
+            rf"\b(edit|change|modify|redo|tweak|regenerate|update)\b.{{0,30}}\b({IMAGE_NOUNS}|it|background|colou?rs?)\b"
+        ),
+        0.3,
+    ),
+    (re.compile(r"\b(make it|make them|but with|but in|in the style of)\b"), 0.2),
+    # talking about images rather than asking for one
+    (
+        re.compile(
+            rf"\b(don'?t|do not|no need to|stop|never)\b.{{0,20}}\b(draw|generate|create|make|{IMAGE_NOUNS})\b"
+        ),
+        -0.8,
+    ),
+]
+
+# the bot offering an image, and the user accepting
+OFFER_PATTERN = re.compile(
+    rf"\b(draw|paint|generate|create|make)\b.{{0,40}}\b({IMAGE_NOUNS}|one|it)\b.*\?"
+)
+ACCEPT_PATTERN = re.compile(
+    r"^\W*(yes|yeah|yep|yup|sure|please|pls|do it|go ahead|go for it|ok|okay)\b"
+)
+
+# how much the message before the current one counts toward the score
+PREVIOUS_MESSAGE_WEIGHT = 0.5
+
+image_intent_decisions = registry.register(
+    Counter(
+        "discordgpt_image_intent_decisions_total",
+        "Image intent gate decisions, and (when the model was asked) what the model decided.",
+        labels=("gate", "model"),
+    )
+)
+
+
+def _message_text(message: dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        content = " ".join(
+            part.get("text", "") for part in content if part.get("type") == "text"
+        )
+    return content.lower()
+
+
+def _rule_score(text: str) -> float:
+    return sum(weight for pattern, weight in IMAGE_INTENT_RULES if pattern.search(text))
+
+
+def score_image_intent(recent_messages: list[dict]) -> float:
+    """Estimate (0-1) how likely it is that the last message asks for an image, from keyword and
+    regex rules over the last couple of user/assistant messages. System messages (e.g. summaries
+    of attached images) are ignored.
+    """
+    messages = [msg for msg in recent_messages if msg.get("role") != "system"][-2:]
+    if not messages:
+        return 0.0
+
+    *previous, current = messages
+    current_text = _message_text(current)
+    score = _rule_score(current_text)
+    for message in previous:
+        previous_text = _message_text(message)
+        if (
+            message.get("role") == "assistant"
+            and OFFER_PATTERN.search(previous_text)
+            and ACCEPT_PATTERN.search(current_text)
+        ):
+            score += 0.8
+        elif message.get("role") == "user":
+            score += PREVIOUS_MESSAGE_WEIGHT * _rule_score(previous_text)
+    return min(1.0, max(0.0, score))
+
+
+def image_intent_gate(recent_messages: list[dict]) -> tuple[bool, float]:
+    """Whether it's worth asking the model if an image should be generated, along with the
+    score that decision was based on.
+    """
+    score = score_image_intent(recent_messages)
+    return score >= settings.IMAGE_INTENT_THRESHOLD, score
+
+
+def record_image_intent(
+    gate_fired: bool, score: float, model_wants_image: bool
+) -> None:
+    """Track how the gate's decision compares to the model's, logging any disagreement."""
+    image_intent_decisions.inc(
+        gate="fire" if gate_fired else "skip",
+        model="image" if model_wants_image else "no image",
+    )
+    if gate_fired != model_wants_image:
+        logger.info(
+            "image intent gate disagreed with the model",
+            gate_fired=gate_fired,
+            score=round(score, 2),
+            threshold=settings.IMAGE_INTENT_THRESHOLD,
+            model_wants_image=model_wants_image,
+        )
@@ -0,0 +1,106 @@
+import asyncio
+import base64
+from dataclasses import dataclass
+from typing import Literal
+
+import structlog
+
+from src.http_session import download
+from src.openai_api.client import get_openai_client
+from src.openai_api.dispatcher import image_dispatcher
+from src.openai_api.image_cache import image_cache, image_cache_key
+from src.openai_api.stages import run_stage
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+
+@dataclass
+class GeneratedImage:
+    """An image from the image generation model: either the raw image bytes (when requested as
+    `b64_json`) or a URL to download them from.
+    """
+
+    url: str = ""
+    data: bytes | None = None
+
+
+async def generate_image(
+    prompt: str,
+    user_name: str,
+    style: Literal["vivid", "natural"] = "vivid",
+) -> GeneratedImage | None:
+    client = get_openai_client()
+    response = await image_dispatcher.call(
+        lambda: client.images.with_raw_response.generate(
+            model=settings.OPENAI_IMAGE_GEN_MODEL,
+            prompt=prompt,
+            size="1024x1024",
+            quality="standard",
+            style=style,
+            n=1,
+            user=user_name,
+            response_format=settings.OPENAI_IMAGE_RESPONSE_FORMAT,
+        ),
+        model=settings.OPENAI_IMAGE_GEN_MODEL,
+    )
+    image_data = response.data[0]
+    if image_data.b64_json:
+        # no need to download the image again later
+        return GeneratedImage(data=base64.b64decode(image_data.b64_json))
+    if image_data.url:
+        return GeneratedImage(url=image_data.url)
+    return None
+
+
+# an image being generated in the background; resolves to the image with its bytes already
+# downloaded (never just a URL), or None if it couldn't be made
+ImageJob = asyncio.Task[GeneratedImage | None]
+
+
+def start_image_job(
+    prompt: str,
+    user_name: str,
+    style: Literal["vivid", "natural"] = "vivid",
+) -> ImageJob:
+    """Start generating an image in the background, so the text reply doesn't have to wait for
+    it. An image that's already cached (or being generated for someone else) is reused.
+    """
+    key = image_cache_key(prompt, style, settings.OPENAI_IMAGE_GEN_MODEL)
+    return asyncio.create_task(_run_image_job(key, prompt, user_name, style))
+
+
+async def _run_image_job(
+    key: str,
+    prompt: str,
+    user_name: str,
+    style: Literal["vivid", "natural"],
+) -> GeneratedImage | None:
+    data = await run_stage(
+        "image generation",
+        image_cache.get_or_generate(
+            key, lambda: generate_image_bytes(prompt, user_name, style)
+        ),
+        timeout=settings.STAGE_TIMEOUT_IMAGE_GENERATION_SECONDS,
+        default=None,
+    )
+    return GeneratedImage(data=data) if data else None
+
+
+async def generate_image_bytes(
+    prompt: str,
+    user_name: str,
+    style: Literal["vivid", "natural"] = "vivid",
+) -> bytes | None:
+    image = await generate_image(prompt, user_name, style)
+    if image is None:
+        return None
+    if image.data is not None:
+        return image.data
+    # image URLs expire after a while, so the image itself is what gets cached
+    if (buffer := await download(image.url)) is None:
+        logger.warning("Could not download generated image")
+        return None
+    with buffer:
+        return await asyncio.to_thread(buffer.read)
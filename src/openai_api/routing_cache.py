@@ -0,0 +1,89 @@
+import copy
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+import structlog
+
+from src.metrics import cache_stats
+from src.settings import get_settings
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+# (function name, parameters) pairs, plus any plain text the model sent alongside them
+RoutingDecision = tuple[list[tuple[str, dict]], str]
+
+
+def routing_cache_key(
+    messages: list[dict], function_names: list[str], model: str
+) -> str:
+    """Stable hash of everything that goes into a tool routing request."""
+    payload = json.dumps(
+        {
+            "model": model,
+            "functions": sorted(function_names),
+            "messages": messages,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class RoutingDecisionCache:
+    """Recent tool routing decisions, so asking the model the same question again within
+    `ttl_seconds` (retries, edits that didn't change anything, a reaction decision made twice)
+    reuses the answer instead of making another call.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[RoutingDecision, float]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "entries": len(self.entries),
+        }
+
+    def get(self, key: str) -> RoutingDecision | None:
+        if self.ttl_seconds <= 0:
+            return None
+        if (entry := self.entries.get(key)) is not None:
+            decision, created_at = entry
+            if time.monotonic() - created_at <= self.ttl_seconds:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                # callers get their own copy of the parameters to modify
+                return copy.deepcopy(decision)
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key: str, decision: RoutingDecision) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        self.entries[key] = (copy.deepcopy(decision), time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+routing_cache = RoutingDecisionCache(
+    ttl_seconds=settings.ROUTING_CACHE_TTL_SECONDS,
+    max_entries=settings.ROUTING_CACHE_MAX_ENTRIES,
+)
+cache_stats.add("routing", routing_cache.stats)
@@ -0,0 +1,33 @@
+import asyncio
+from typing import Awaitable, TypeVar
+
+import structlog
+
+from src.metrics import stage_failures, stage_latency
+from src.openai_api.dispatcher import RequestShedError
+
+logger = structlog.get_logger()
+
+T = TypeVar("T")
+
+
+async def run_stage(name: str, stage: Awaitable[T], timeout: float, default: T) -> T:
+    """Run a single pipeline stage with a timeout.
+
+    If the stage times out or raises, it's logged and `default` is returned instead, so one slow or
+    broken stage can't take down the stages running alongside it.
+    """
+    try:
+        with stage_latency.time(stage=name):
+            async with asyncio.timeout(timeout):
+                return await stage
+    except TimeoutError:
+        stage_failures.inc(stage=name, reason="timeout")
+        logger.warning(f"{name} stage timed out after {timeout}s")
+    except RequestShedError as e:
+        stage_failures.inc(stage=name, reason="shed")
+        logger.info(f"{name} stage skipped: {e}")
+    except Exception as e:
+        stage_failures.inc(stage=name, reason="error")
+        logger.exception(f"{name} stage failed: {e}")
+    return default
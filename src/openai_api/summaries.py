@@ -0,0 +1,234 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import structlog
+
+from src.guild_settings import current_guild_settings
+from src.messaging.history import CachedMessage
+from src.metrics import cache_stats
+from src.openai_api.client import get_openai_client
+from src.openai_api.dispatcher import (
+    RequestPriority,
+    chat_dispatcher,
+    request_priority,
+)
+from src.openai_api.stages import run_stage
+from src.openai_api.tokens import estimate_request_tokens, truncate_to_tokens
+from src.settings import get_settings
+from src.storage import connect_shared_db
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a Discord channel's conversation, so it can be "
+    "remembered after the messages themselves are gone. Update the summary with the new "
+    "messages below. Keep names, decisions, open questions and anything people asked to be "
+    "remembered; drop small talk. Reply with only the updated summary, in a few short "
+    "paragraphs or bullet points."
+)
+
+
+@dataclass
+class ChannelSummary:
+    summary: str
+    # the newest message the summary takes into account
+    covered_until_id: int
+    updated_at: float
+
+
+class ChannelSummaryStore:
+    """A compacted running summary of each channel's older messages, kept in memory in front of
+    a SQLite table.
+
+    Summaries are refreshed in the background as messages age out of the prompt, at most once
+    every `refresh_interval_seconds` per channel and only once at least `min_new_messages` have
+    aged out since the last refresh.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        refresh_interval_seconds: float,
+        min_new_messages: int,
+        max_concurrent_refreshes: int,
+    ):
+        self.db_path = db_path
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.min_new_messages = min_new_messages
+        self.max_concurrent_refreshes = max_concurrent_refreshes
+
+        # None for channels already looked up on disk that have no summary yet
+        self.memory: dict[int, ChannelSummary | None] = {}
+        self.refreshing: dict[int, asyncio.Task] = {}
+        self._refresh_slots: asyncio.Semaphore | None = None
+
+        self.refreshes = 0
+        self.failed_refreshes = 0
+        self.skipped_refreshes = 0
+
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "channels": len(self.memory),
+            "refreshes": self.refreshes,
+            "failed_refreshes": self.failed_refreshes,
+            "skipped_refreshes": self.skipped_refreshes,
+            "refreshing": len(self.refreshing),
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect_shared_db(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS channel_summaries "
+                "(channel_id INTEGER PRIMARY KEY, summary TEXT NOT NULL, "
+                "covered_until_id INTEGER NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _read_disk(self, channel_id: int) -> ChannelSummary | None:
+        with self._db_lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT summary, covered_until_id, updated_at FROM channel_summaries "
+                    "WHERE channel_id = ?",
+                    (channel_id,),
+                )
+                .fetchone()
+            )
+        return ChannelSummary(*row) if row is not None else None
+
+    def _write_disk(self, channel_id: int, summary: ChannelSummary) -> None:
+        with self._db_lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO channel_summaries "
+                "(channel_id, summary, covered_until_id, updated_at) VALUES (?, ?, ?, ?)",
+                (
+                    channel_id,
+                    summary.summary,
+                    summary.covered_until_id,
+                    summary.updated_at,
+                ),
+            )
+            db.commit()
+
+    async def get(self, channel_id: int) -> ChannelSummary | None:
+        if channel_id not in self.memory:
+            self.memory[channel_id] = await asyncio.to_thread(
+                self._read_disk, channel_id
+            )
+        return self.memory[channel_id]
+
+    def schedule_refresh(
+        self, channel_id: int, aged_out_messages: list[CachedMessage]
+    ) -> None:
+        """Fold messages that no longer fit in the prompt (oldest first) into the channel's
+        summary in the background, if enough of them are new and the channel's summary hasn't
+        been refreshed too recently.
+        """
+        if channel_id in self.refreshing:
+            return
+        summary = self.memory.get(channel_id)
+        covered_until_id = summary.covered_until_id if summary is not None else 0
+        new_messages = [msg for msg in aged_out_messages if msg.id > covered_until_id]
+        if len(new_messages) < self.min_new_messages:
+            return
+        if (
+            summary is not None
+            and time.time() - summary.updated_at < self.refresh_interval_seconds
+        ):
+            self.skipped_refreshes += 1
+            return
+
+        task = asyncio.create_task(self._refresh(channel_id, summary, new_messages))
+        self.refreshing[channel_id] = task
+        task.add_done_callback(lambda _: self.refreshing.pop(channel_id, None))
+
+    async def _refresh(
+        self,
+        channel_id: int,
+        previous: ChannelSummary | None,
+        new_messages: list[CachedMessage],
+    ) -> None:
+        # never worth holding up a reply for
+        request_priority.set(RequestPriority.BACKGROUND)
+        if self._refresh_slots is None:
+            self._refresh_slots = asyncio.Semaphore(self.max_concurrent_refreshes)
+        async with self._refresh_slots:
+            summary_text = await run_stage(
+                "channel summary",
+                summarize_messages(
+                    previous.summary if previous is not None else None, new_messages
+                ),
+                timeout=settings.STAGE_TIMEOUT_SUMMARY_SECONDS,
+                default=None,
+            )
+        if not summary_text:
+            self.failed_refreshes += 1
+            return
+
+        summary = ChannelSummary(
+            summary=summary_text,
+            covered_until_id=new_messages[-1].id,
+            updated_at=time.time(),
+        )
+        self.memory[channel_id] = summary
+        self.refreshes += 1
+        await asyncio.to_thread(self._write_disk, channel_id, summary)
+        logger.info(
+            f"updated summary for channel {channel_id} with {len(new_messages)} message(s)",
+            covered_until_id=summary.covered_until_id,
+        )
+
+
+async def summarize_messages(
+    previous_summary: str | None, new_messages: list[CachedMessage]
+) -> str | None:
+    """Ask the model to fold `new_messages` into `previous_summary`."""
+    transcript = "\n".join(
+        f"{msg.author_name}: {truncate_to_tokens(msg.content, settings.CONTEXT_MAX_MESSAGE_TOKENS)}"
+        for msg in new_messages
+        if msg.content
+    )
+    summary_context = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {
+            "role": "user",
+            "content": f"Current summary:\n{previous_summary or '(none yet)'}\n\n"
+            f"New messages:\n{transcript}",
+        },
+    ]
+
+    client = get_openai_client()
+    model = settings.OPENAI_SUMMARY_MODEL or current_guild_settings().OPENAI_MODEL
+    response = await chat_dispatcher.call(
+        lambda: client.chat.completions.with_raw_response.create(
+            model=model,
+            messages=summary_context,  # type: ignore
+            max_tokens=settings.SUMMARY_MAX_TOKENS,
+        ),
+        model=model,
+        estimated_tokens=estimate_request_tokens(
+            summary_context, max_completion_tokens=settings.SUMMARY_MAX_TOKENS
+        ),
+    )
+    return response.choices[0].message.content
+
+
+channel_summaries = ChannelSummaryStore(
+    db_path=str(Path(settings.DATA_DIR) / "channel_summaries.sqlite3"),
+    refresh_interval_seconds=settings.SUMMARY_REFRESH_INTERVAL_SECONDS,
+    min_new_messages=settings.SUMMARY_MIN_NEW_MESSAGES,
+    max_concurrent_refreshes=settings.SUMMARY_MAX_CONCURRENT_REFRESHES,
+)
+cache_stats.add("channel_summaries", channel_summaries.stats)
@@ -0,0 +1,102 @@
+from functools import lru_cache
+
+import structlog
+
+from src.guild_settings import current_guild_settings
+from src.messaging.history import CachedMessage
+from src.settings import get_settings
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover
+    # token counts fall back to a deliberately high characters-per-token estimate
+    tiktoken = None
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+# used when tiktoken isn't available; English averages about 4 characters per token, but code,
+# emoji and non-Latin scripts use far fewer, so this errs toward overcounting (keeping requests
+# inside the rate limits and context budgets) rather than undercounting
+CHARS_PER_TOKEN = 2
+# every chat message costs a few tokens on top of its content (role, name, separators)
+TOKENS_PER_MESSAGE = 4
+# upper end of what a single image costs in a vision request
+IMAGE_TOKEN_ESTIMATE = 765
+# what an image costs at the "low" detail level, whatever its size
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+
+def warn_if_estimating_tokens() -> None:
+    """Log (once, at startup) when token counts are estimated rather than exact."""
+    if tiktoken is None:
+        logger.warning(
+            f"tiktoken isn't installed, so token counts are estimated at {CHARS_PER_TOKEN} "
+            "characters per token; install it for exact counts"
+        )
+
+
+@lru_cache
+def get_encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model: str = "") -> int:
+    encoding = get_encoding(model or current_guild_settings().OPENAI_MODEL)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "") -> str:
+    """Cut text down to at most `max_tokens` tokens, marking that it was truncated."""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+
+    marker = " [...truncated]"
+    encoding = get_encoding(model or current_guild_settings().OPENAI_MODEL)
+    if encoding is None:
+        return text[: max_tokens * CHARS_PER_TOKEN] + marker
+    return (
+        encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+        + marker
+    )
+
+
+def estimate_request_tokens(
+    messages: list[dict],
+    max_completion_tokens: int | None = None,
+) -> int:
+    """Rough total token cost of a chat completion request, for rate limit accounting."""
+    total = max_completion_tokens or settings.OPENAI_ESTIMATED_COMPLETION_TOKENS
+    for message in messages:
+        total += TOKENS_PER_MESSAGE
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            total += count_tokens(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                total += count_tokens(part["text"])
+            elif part.get("image_url", {}).get("detail") == "low":
+                total += LOW_DETAIL_IMAGE_TOKENS
+            else:
+                total += IMAGE_TOKEN_ESTIMATE
+    return total
+
+
+def message_token_count(message: CachedMessage) -> int:
+    """Token count for a cached message's content, computed once and stored on the message."""
+    if message.token_count is None:
+        message.token_count = count_tokens(message.content) + TOKENS_PER_MESSAGE
+    return message.token_count
+
+
+def get_context_token_budget(model: str = "") -> int:
+    model = model or current_guild_settings().OPENAI_MODEL
+    return settings.CONTEXT_TOKEN_BUDGETS.get(model, settings.CONTEXT_TOKEN_BUDGET)
@@ -0,0 +1,308 @@
+import asyncio
+import base64
+import json
+from io import BytesIO
+
+import structlog
+
+from src.http_session import download
+from src.messaging.history import CachedAttachment, CachedMessage
+from src.metrics import stage_latency
+from src.openai_api.client import get_openai_client
+from src.openai_api.dispatcher import chat_dispatcher
+from src.openai_api.tokens import estimate_request_tokens
+from src.openai_api.vision_cache import (
+    attachment_id_key,
+    content_hash_key,
+    vision_cache,
+)
+from src.settings import get_settings
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    # the vision model is given the attachment URLs to download at full size instead (see
+    # `shrinks_images`)
+    Image = None
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+# completion tokens allowed per image in a vision request
+SUMMARY_TOKENS_PER_IMAGE = 150
+MIN_SUMMARY_TOKENS = 300
+
+
+def shrinks_images() -> bool:
+    """Whether attachments are downloaded and shrunk before they're sent to the vision model.
+    Otherwise the model fetches them itself, so they're never downloaded here (not even to hash
+    their content).
+    """
+    return Image is not None and settings.VISION_MAX_IMAGE_DIMENSION > 0
+
+
+def image_attachments(message: CachedMessage) -> list[CachedAttachment]:
+    image_attachments: list[CachedAttachment] = []
+    for attachment in message.attachments:
+        if (content_type := attachment.content_type) is None:
+            continue
+        if not content_type.startswith("image/"):
+            # skip non-image attachments
+            continue
+        if not attachment.proxy_url:
+            continue
+        image_attachments.append(attachment)
+    return image_attachments
+
+
+async def get_image_attachment_contexts(
+    messages: list[CachedMessage],
+) -> list[list[dict[str, str]]]:
+    """Image attachment summaries for each of `messages`, in the same order. Images that aren't
+    cached yet are summarized together, in as few vision requests as possible.
+    """
+    attachments_by_message = [image_attachments(message) for message in messages]
+    attachments_by_key = {
+        attachment_id_key([attachment.id]): attachment
+        for attachments in attachments_by_message
+        for attachment in attachments
+    }
+    if not attachments_by_key:
+        return [[] for _ in messages]
+
+    async def summarize(keys: list[str]) -> dict[str, tuple[str | None, list[str]]]:
+        return await summarize_attachments(
+            {key: attachments_by_key[key] for key in keys}
+        )
+
+    summaries = await vision_cache.get_or_summarize_many(
+        list(attachments_by_key), summarize
+    )
+
+    contexts = []
+    for message, attachments in zip(messages, attachments_by_message):
+        image_summaries = [
+            summary
+            for attachment in attachments
+            if (summary := summaries.get(attachment_id_key([attachment.id])))
+        ]
+        if not image_summaries:
+            contexts.append([])
+            continue
+        if len(image_summaries) == 1:
+            image_summary_text = image_summaries[0]
+        else:
+            image_summary_text = "\n".join(
+                f"{idx}. {summary}" for idx, summary in enumerate(image_summaries, 1)
+            )
+        contexts.append(
+            [
+                {
+                    "role": "system",
+                    "content": f"{message.author_name} uploaded {len(image_summaries)} image(s):\n{image_summary_text}",
+                }
+            ]
+        )
+    return contexts
+
+
+async def summarize_attachments(
+    attachments_by_key: dict[str, CachedAttachment],
+) -> dict[str, tuple[str | None, list[str]]]:
+    """Download, shrink and summarize a batch of image attachments, skipping any whose content
+    has already been summarized under another attachment ID.
+    """
+    keys = list(attachments_by_key)
+    downloads: list[bytes | BaseException | None] = [None] * len(keys)
+    if shrinks_images():
+        downloads = await asyncio.gather(
+            *(
+                download_attachment(attachment)
+                for attachment in attachments_by_key.values()
+            ),
+            return_exceptions=True,
+        )
+
+    results: dict[str, tuple[str | None, list[str]]] = {}
+    # the same image can show up more than once, so each distinct image is only sent once
+    image_keys: dict[str, list[str]] = {}
+    image_urls: dict[str, str] = {}
+    for key, data in zip(keys, downloads):
+        attachment = attachments_by_key[key]
+        if isinstance(data, BaseException):
+            logger.warning(
+                f"error downloading attachment: {data!r}", filename=attachment.filename
+            )
+            data = None
+        if data is None:
+            # let the model download the full-size image itself, cached by attachment ID only
+            image_keys[key] = [key]
+            image_urls[key] = attachment.proxy_url
+            continue
+
+        hash_key = content_hash_key([data])
+        extra_keys = [hash_key] if settings.VISION_CACHE_HASH_CONTENT else []
+        if settings.VISION_CACHE_HASH_CONTENT:
+            # the same image may have been uploaded before under a different attachment ID
+            if (
+                cached_summary := await vision_cache.get(hash_key, record_stats=False)
+            ) is not None:
+                vision_cache.content_hash_hits += 1
+                results[key] = (cached_summary, extra_keys)
+                continue
+        results[key] = (None, extra_keys)
+        if hash_key in image_keys:
+            image_keys[hash_key].append(key)
+            continue
+        image_keys[hash_key] = [key]
+        # inlining the full-size image would cost more than letting the model fetch it
+        image_urls[hash_key] = (
+            await asyncio.to_thread(image_data_url, data) or attachment.proxy_url
+        )
+
+    if not image_urls:
+        return results
+
+    image_ids = list(image_urls)
+    batch_size = max(1, settings.VISION_MAX_IMAGES_PER_REQUEST)
+    batches = [
+        image_ids[start : start + batch_size]
+        for start in range(0, len(image_ids), batch_size)
+    ]
+    batch_summaries = await asyncio.gather(
+        *(
+            summarize_images([image_urls[image_id] for image_id in batch])
+            for batch in batches
+        ),
+        return_exceptions=True,
+    )
+    for batch, summaries in zip(batches, batch_summaries):
+        if isinstance(summaries, BaseException):
+            # the other batches' summaries are still good
+            logger.warning(f"error summarizing {len(batch)} image(s): {summaries!r}")
+            continue
+        for image_id, summary in zip(batch, summaries):
+            for key in image_keys[image_id]:
+                _, extra_keys = results.get(key, (None, []))
+                results[key] = (summary, extra_keys)
+    return results
+
+
+async def download_attachment(attachment: CachedAttachment) -> bytes | None:
+    if (data := await download(attachment.url)) is None:
+        logger.warning("Could not download attachment", filename=attachment.filename)
+        return None
+    with data:
+        return data.read()
+
+
+def image_data_url(data: bytes) -> str | None:
+    """Encode an image as a base64 data URL, shrunk to fit within `VISION_MAX_IMAGE_DIMENSION`.
+    Returns None if that can't be done locally (e.g. Pillow isn't installed). Runs in a worker
+    thread.
+    """
+    if (resized := downscale_image(data)) is None:
+        return None
+    data, content_type = resized
+    return f"data:{content_type};base64,{base64.b64encode(data).decode()}"
+
+
+def downscale_image(data: bytes) -> tuple[bytes, str] | None:
+    """The image shrunk (if needed) to fit within `VISION_MAX_IMAGE_DIMENSION`, along with its
+    content type, or None if it can't be checked or resized.
+    """
+    max_dimension = settings.VISION_MAX_IMAGE_DIMENSION
+    if Image is None or max_dimension <= 0:
+        return None
+    try:
+        with Image.open(BytesIO(data)) as image:
+            if max(image.size) <= max_dimension:
+                return data, Image.MIME.get(image.format or "", "image/png")
+            # only the first frame of an animated image is kept
+            image.thumbnail((max_dimension, max_dimension))
+            output = BytesIO()
+            if image.mode in ("RGBA", "LA", "P"):
+                image.save(output, format="PNG", optimize=True)
+                return output.getvalue(), "image/png"
+            image.convert("RGB").save(output, format="JPEG", quality=85)
+            return output.getvalue(), "image/jpeg"
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning(f"couldn't downscale image: {e}")
+        return None
+
+
+async def summarize_images(image_urls: list[str]) -> list[str | None]:
+    """Ask the vision model for a short summary of each of one or more images, in one request."""
+    num_images = len(image_urls)
+    logger.info(f"summarizing {num_images} attached image(s)")
+
+    if num_images == 1:
+        vision_prompt = "Give a simple, concise summary of what's in this image"
+    else:
+        vision_prompt = (
+            f"Give a simple, concise summary of what's in each of these {num_images} images. "
+            'Reply with a JSON object with a "summaries" list holding one summary string per '
+            "image, in the same order as the images."
+        )
+
+    attached_images = [
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": image_url,
+                "detail": settings.VISION_IMAGE_DETAIL,
+            },
+        }
+        for image_url in image_urls
+    ]
+    vision_message_context = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": vision_prompt},
+            ]
+            + attached_images,
+        }
+    ]
+    max_tokens = max(MIN_SUMMARY_TOKENS, SUMMARY_TOKENS_PER_IMAGE * num_images)
+    extra_params = {}
+    if num_images > 1:
+        extra_params["response_format"] = {"type": "json_object"}
+
+    client = get_openai_client()
+    with stage_latency.time(stage="vision"):
+        response = await chat_dispatcher.call(
+            lambda: client.chat.completions.with_raw_response.create(
+                model=settings.OPENAI_VISION_MODEL,
+                messages=vision_message_context,  # type: ignore
+                max_tokens=max_tokens,  # default is lower
+                **extra_params,
+            ),
+            model=settings.OPENAI_VISION_MODEL,
+            estimated_tokens=estimate_request_tokens(
+                vision_message_context, max_completion_tokens=max_tokens
+            ),
+        )
+    response_text = response.choices[0].message.content
+    logger.debug("vision response", summary=response_text)
+    if num_images == 1:
+        return [response_text]
+    return parse_image_summaries(response_text, num_images)
+
+
+def parse_image_summaries(
+    response_text: str | None, num_images: int
+) -> list[str | None]:
+    try:
+        summaries = json.loads(response_text or "")["summaries"]
+    except (ValueError, KeyError, TypeError):
+        logger.warning("invalid JSON in vision response", response_text=response_text)
+        return [None] * num_images
+    if not isinstance(summaries, list) or len(summaries) != num_images:
+        logger.warning(
+            "wrong number of image summaries in vision response",
+            expected=num_images,
+            response_text=response_text,
+        )
+        return [None] * num_images
+    return [str(summary) if summary else None for summary in summaries]
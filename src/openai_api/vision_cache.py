@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import structlog
+
+from src.metrics import cache_stats
+from src.settings import get_settings
+from src.storage import connect_shared_db
+
+logger = structlog.get_logger()
+settings = get_settings()
+
+
+def attachment_id_key(attachment_ids: list[int]) -> str:
+    """Primary cache key for a group of attachments."""
+    return "ids:" + ",".join(
+        str(attachment_id) for attachment_id in sorted(attachment_ids)
+    )
+
+
+def content_hash_key(image_bytes: list[bytes]) -> str:
+    """Fallback cache key for a group of images, for when the same image is uploaded again (and
+    gets a new attachment ID).
+    """
+    digests = sorted(hashlib.sha256(data).hexdigest() for data in image_bytes)
+    return "sha256:" + hashlib.sha256(",".join(digests).encode()).hexdigest()
+
+
+class VisionSummaryCache:
+    """Image summaries from the vision model, kept in an in-memory LRU in front of a SQLite table.
+
+    Entries older than `ttl_seconds` are treated as misses and removed.
+    """
+
+    def __init__(self, db_path: str, max_memory_entries: int, ttl_seconds: float):
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.ttl_seconds = ttl_seconds
+
+        self.memory: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        # lookups that are currently waiting on the vision model, so concurrent requests for the
+        # same image share one call
+        self.in_flight: dict[str, asyncio.Future[str | None]] = {}
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        # primary key misses that were then found under their content hash
+        self.content_hash_hits = 0
+        self.misses = 0
+
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hits = self.memory_hits + self.disk_hits + self.content_hash_hits
+        return hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "content_hash_hits": self.content_hash_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect_shared_db(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS vision_summaries "
+                "(key TEXT PRIMARY KEY, summary TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _read_disk(self, key: str) -> tuple[str, float] | None:
+        with self._db_lock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT summary, created_at FROM vision_summaries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and time.time() - row[1] > self.ttl_seconds:
+                db.execute("DELETE FROM vision_summaries WHERE key = ?", (key,))
+                db.commit()
+                return None
+            return row
+
+    def _write_disk(self, keys: list[str], summary: str, created_at: float) -> None:
+        with self._db_lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO vision_summaries (key, summary, created_at) VALUES (?, ?, ?)",
+                [(key, summary, created_at) for key in keys],
+            )
+            # opportunistically clear out anything expired while we have the lock
+            db.execute(
+                "DELETE FROM vision_summaries WHERE created_at < ?",
+                (created_at - self.ttl_seconds,),
+            )
+            db.commit()
+
+    def _remember(self, key: str, summary: str, created_at: float) -> None:
+        self.memory[key] = (summary, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    async def get(self, key: str, record_stats: bool = True) -> str | None:
+        """Look up a cached summary, checking memory first and then disk."""
+        if (entry := self.memory.get(key)) is not None:
+            summary, created_at = entry
+            if time.time() - created_at <= self.ttl_seconds:
+                self.memory.move_to_end(key)
+                self.memory_hits += record_stats
+                return summary
+            del self.memory[key]
+
+        row = await asyncio.to_thread(self._read_disk, key)
+        if row is not None:
+            summary, created_at = row
+            self._remember(key, summary, created_at)
+            self.disk_hits += record_stats
+            return summary
+
+        return None
+
+    async def set(self, keys: list[str], summary: str) -> None:
+        """Store a summary under one or more keys (e.g. attachment IDs and content hash)."""
+        created_at = time.time()
+        for key in keys:
+            self._remember(key, summary, created_at)
+        await asyncio.to_thread(self._write_disk, keys, summary, created_at)
+
+    async def get_or_summarize_many(
+        self,
+        keys: list[str],
+        summarize: Callable[
+            [list[str]], Awaitable[dict[str, tuple[str | None, list[str]]]]
+        ],
+    ) -> dict[str, str | None]:
+        """Return the summary for each of `keys`, calling `summarize()` once for all the keys that
+        aren't cached (or already being summarized by a concurrent caller).
+
+        `summarize` maps each key it's given to its summary along with any extra keys it should
+        also be stored under. It may also return summaries it found in the cache under one of
+        those extra keys.
+        """
+        summaries: dict[str, str | None] = {}
+        pending: dict[str, asyncio.Future[str | None]] = {}
+        # claimed as soon as they're found to be missing, so concurrent callers wait on them
+        futures: dict[str, asyncio.Future[str | None]] = {}
+        loop = asyncio.get_running_loop()
+        try:
+            for key in dict.fromkeys(keys):
+                if (summary := await self.get(key)) is not None:
+                    summaries[key] = summary
+                elif (future := self.in_flight.get(key)) is not None:
+                    self.memory_hits += 1
+                    pending[key] = future
+                else:
+                    self.misses += 1
+                    futures[key] = self.in_flight[key] = loop.create_future()
+
+            if futures:
+                results = await summarize(list(futures))
+                for key, future in futures.items():
+                    summary, extra_keys = results.get(key, (None, []))
+                    if summary:
+                        await self.set([key, *extra_keys], summary)
+                    future.set_result(summary)
+                    summaries[key] = summary
+        except asyncio.CancelledError:
+            for future in futures.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # don't let an unretrieved exception get logged when nobody else was waiting
+                    future.exception()
+            raise
+        finally:
+            for key in futures:
+                self.in_flight.pop(key, None)
+
+        for key, future in pending.items():
+            # a concurrent caller that failed or was cancelled just means no summary here
+            await asyncio.wait([future])
+            summaries[key] = (
+                future.result()
+                if not future.cancelled() and future.exception() is None
+                else None
+            )
+        logger.debug(
+            "vision cache lookup",
+            keys=len(summaries),
+            missed=len(futures),
+            **self.stats(),
+        )
+        return summaries
+
+
+vision_cache = VisionSummaryCache(
+    db_path=str(Path(settings.DATA_DIR) / "vision_summaries.sqlite3"),
+    max_memory_entries=settings.VISION_CACHE_MAX_MEMORY_ENTRIES,
+    ttl_seconds=settings.VISION_CACHE_TTL_SECONDS,
+)
+cache_stats.add("vision", vision_cache.stats)
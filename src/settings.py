@@ -1,15 +1,37 @@
+import asyncio
+import contextlib
 import os
+import time
 from functools import lru_cache
+from typing import Any, Callable, Literal, cast
 
+import structlog
 from pydantic import SecretStr, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from src.startup import startup_timer
+
+logger = structlog.get_logger()
+
+ENV_FILE = ".env"
+PROMPT_FILE = "initial_prompt.md"
+
 
 class Settings(BaseSettings):
     DISCORD_BOT_TOKEN: SecretStr = SecretStr("")
     DISCORD_BOT_NAME: str = ""
     CLIENT_USER_ID: str = ""
 
+    # number of gateway shards across all processes; leave unset to use Discord's recommendation
+    DISCORD_SHARD_COUNT: int | None = None
+    # shards this process runs, e.g. "0,1" or "0-3" (requires DISCORD_SHARD_COUNT); leave unset to
+    # run all of them (see `src/launcher.py` for splitting them across processes)
+    DISCORD_SHARD_IDS: str | list[int] | None = None
+
+    # JSON file of per-server overrides for the model, starting prompt, reply chances, etc. (see
+    # `src/guild_settings.py`)
+    GUILD_SETTINGS_FILE: str = "guild_settings.json"
+
     OPENAI_API_KEY: str = ""
 
     OPENAI_MODEL: str = ""
@@ -20,6 +42,39 @@ class Settings(BaseSettings):
     # required for generating images and adding to message responses
     OPENAI_IMAGE_GEN_MODEL: str = ""
 
+    # connection pool / timeout settings for the shared async OpenAI client
+    OPENAI_MAX_CONNECTIONS: int = 20
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = 10
+    OPENAI_KEEPALIVE_EXPIRY_SECONDS: float = 60.0
+    OPENAI_CONNECT_TIMEOUT_SECONDS: float = 5.0
+    OPENAI_TIMEOUT_SECONDS: float = 60.0
+
+    # "b64_json" returns the generated image bytes directly, instead of a URL we have to download
+    OPENAI_IMAGE_RESPONSE_FORMAT: Literal["url", "b64_json"] = "url"
+
+    # shared HTTP session for downloading images/attachments
+    HTTP_MAX_CONNECTIONS: int = 20
+    HTTP_KEEPALIVE_SECONDS: float = 30.0
+    HTTP_TIMEOUT_SECONDS: float = 30.0
+    # downloads bigger than this are dropped; anything over the spool size is buffered on disk
+    DOWNLOAD_MAX_BYTES: int = 8 * 1024 * 1024
+    DOWNLOAD_SPOOL_MAX_MEMORY_BYTES: int = 1024 * 1024
+
+    # rate limits for each model (see https://platform.openai.com/account/limits); requests are
+    # queued by priority to stay under them, and 0 means no limit
+    OPENAI_REQUESTS_PER_MINUTE: int = 500
+    OPENAI_TOKENS_PER_MINUTE: int = 200_000
+    OPENAI_IMAGES_PER_MINUTE: int = 5
+    # assumed completion size when estimating a request's token cost
+    OPENAI_ESTIMATED_COMPLETION_TOKENS: int = 500
+    OPENAI_MAX_RETRIES: int = 4
+    OPENAI_RETRY_BASE_DELAY_SECONDS: float = 1.0
+    OPENAI_RETRY_MAX_DELAY_SECONDS: float = 30.0
+    # low-priority requests (random replies/reactions) are dropped rather than queued once this
+    # many requests are waiting, or after waiting this long
+    OPENAI_BACKGROUND_MAX_QUEUE_DEPTH: int = 10
+    OPENAI_BACKGROUND_MAX_WAIT_SECONDS: float = 10.0
+
     # required for using the Assistants API
     # TODO: use this instead of managing history manually
     OPENAI_ASSISTANT_ID: str = ""
@@ -30,6 +85,126 @@ class Settings(BaseSettings):
     # ...or react to a message with an emoji or server reaction
     RANDOM_REACTION_CHANCE: float = 0.05
 
+    # "multi": separate model calls decide on reactions, images and the text response
+    # "unified": a single model call with all tools available decides on everything at once
+    OPENAI_TOOL_ROUTING_MODE: Literal["multi", "unified"] = "multi"
+
+    # stream text completions, posting the reply once the first few characters are in and then
+    # editing it as more text arrives
+    OPENAI_STREAM_RESPONSES: bool = False
+    STREAM_FIRST_CHUNK_CHARS: int = 40
+    # minimum time between edits to a streaming reply, to stay well within Discord's rate limits
+    STREAM_EDIT_INTERVAL_SECONDS: float = 1.0
+
+    # prompt size is driven by a token budget: the newest messages from the lookback window are
+    # added until the budget is used up
+    CONTEXT_TOKEN_BUDGET: int = 4000
+    # per-model overrides for the budget, e.g. `{"gpt-4o": 8000}`
+    CONTEXT_TOKEN_BUDGETS: dict[str, int] = {}
+    CONTEXT_LOOKBACK_MINUTES: int = 60
+    # any single message longer than this is truncated
+    CONTEXT_MAX_MESSAGE_TOKENS: int = 1000
+
+    # how many replies/reactions can be generated at once across all channels (each channel only
+    # ever has one at a time)
+    SCHEDULER_MAX_CONCURRENT_JOBS: int = 8
+    # once this many jobs are waiting, the oldest waiting job is dropped
+    SCHEDULER_MAX_BACKLOG: int = 100
+
+    # per-stage timeouts; a stage that runs over is skipped (or, for text, no reply is sent)
+    STAGE_TIMEOUT_REACTION_SECONDS: float = 15.0
+    STAGE_TIMEOUT_IMAGE_INTENT_SECONDS: float = 15.0
+    STAGE_TIMEOUT_IMAGE_GENERATION_SECONDS: float = 90.0
+    STAGE_TIMEOUT_TEXT_SECONDS: float = 90.0
+
+    # in-memory channel history kept up to date from gateway events, so we don't have to pull
+    # history over REST for every message we handle
+    HISTORY_CACHE_MAX_MESSAGES_PER_CHANNEL: int = 50
+    # once this many messages are cached across all channels, the most idle channels are dropped
+    HISTORY_CACHE_MAX_TOTAL_MESSAGES: int = 20_000
+
+    # local directory for caches and other persistent state
+    DATA_DIR: str = "data"
+    # how long a SQLite write waits on another process's (e.g. other shard processes sharing
+    # DATA_DIR) before giving up with "database is locked"
+    SQLITE_BUSY_TIMEOUT_SECONDS: float = 30.0
+
+    # image attachment summaries are cached (by attachment ID, falling back to a hash of the image
+    # content) so each image only gets sent to the vision model once
+    VISION_CACHE_MAX_MEMORY_ENTRIES: int = 1000
+    VISION_CACHE_TTL_SECONDS: float = 7 * 24 * 60 * 60
+    # also look images up by a hash of their content, to catch re-uploads of an already-summarized
+    # image
+    VISION_CACHE_HASH_CONTENT: bool = True
+    # attachments are shrunk to fit within this many pixels on their longest side and sent to the
+    # vision model inline; with 0 (or without Pillow), attachments aren't downloaded at all and the
+    # model is given their URLs to fetch at full size instead, cached by attachment ID alone
+    VISION_MAX_IMAGE_DIMENSION: int = 1024
+    # "low" has the model look at a 512px version of each image for a small fixed token cost
+    VISION_IMAGE_DETAIL: Literal["low", "high", "auto"] = "auto"
+    # images in the history that aren't cached yet are summarized together, this many per request
+    VISION_MAX_IMAGES_PER_REQUEST: int = 10
+
+    # generated images are cached on disk (by prompt, style and model) so repeat requests don't
+    # generate them again; past this size the least recently used are removed, 0 disables.
+    # `src/launcher.py` gives each process its own IMAGE_CACHE_DIR and share of the size
+    IMAGE_CACHE_MAX_BYTES: int = 500 * 1024 * 1024
+    # defaults to DATA_DIR/generated_images
+    IMAGE_CACHE_DIR: str = ""
+
+    # IDs of the bot's own recent messages, so reactions on other messages are ignored without
+    # fetching them
+    SENT_MESSAGE_INDEX_MAX_ENTRIES: int = 50_000
+
+    # feedback reactions are saved in batches of up to this many rows, at most this often
+    FEEDBACK_BATCH_SIZE: int = 100
+    FEEDBACK_FLUSH_INTERVAL_SECONDS: float = 2.0
+
+    # serve Prometheus metrics (stage latencies, token usage, cache hit rates, queue sizes) on
+    # http://METRICS_HOST:METRICS_PORT/metrics
+    METRICS_ENABLED: bool = False
+    METRICS_HOST: str = "127.0.0.1"
+    METRICS_PORT: int = 9090
+    # how often to check how far behind the event loop is running
+    METRICS_LOOP_LAG_INTERVAL_SECONDS: float = 1.0
+
+    # tool routing decisions (react? generate an image?) are reused for identical requests made
+    # within this many seconds; 0 disables the cache
+    ROUTING_CACHE_TTL_SECONDS: float = 120.0
+    ROUTING_CACHE_MAX_ENTRIES: int = 1000
+
+    # local keyword/regex check run before asking the model whether to generate an image:
+    # "on" only asks the model when the check fires, "shadow" always asks and logs any disagreement
+    # (for tuning), "off" always asks
+    IMAGE_INTENT_GATE: Literal["on", "shadow", "off"] = "on"
+    # 0-1; lower asks the model more often (fewer missed image requests), higher skips more calls
+    IMAGE_INTENT_THRESHOLD: float = 0.4
+
+    # each channel keeps a running summary of the messages that have aged out of the prompt
+    # (older than the lookback window, or over the token budget), which is added to the prompt
+    # after the starting prompt
+    CHANNEL_SUMMARIES_ENABLED: bool = True
+    # defaults to OPENAI_MODEL; a smaller, cheaper model is usually good enough
+    OPENAI_SUMMARY_MODEL: str = ""
+    SUMMARY_MAX_TOKENS: int = 300
+    # a channel's summary is refreshed at most this often, once at least this many messages have
+    # aged out since the last refresh
+    SUMMARY_REFRESH_INTERVAL_SECONDS: float = 10 * 60
+    SUMMARY_MIN_NEW_MESSAGES: int = 10
+    SUMMARY_MAX_CONCURRENT_REFRESHES: int = 2
+    STAGE_TIMEOUT_SUMMARY_SECONDS: float = 60.0
+
+    # how often to check `.env`, `initial_prompt.md` and GUILD_SETTINGS_FILE for changes, which
+    # are applied without restarting; 0 disables reloading
+    SETTINGS_RELOAD_INTERVAL_SECONDS: float = 5.0
+
+    # DEBUG also logs full prompts and responses (these are only rendered when enabled)
+    LOG_LEVEL: str = "INFO"
+    # "console" for readable output, "json" for one JSON object per line (e.g. for log shipping)
+    LOG_FORMAT: Literal["console", "json"] = "console"
+    # optionally also write JSON logs to this file, whatever LOG_FORMAT is
+    LOG_JSON_FILE: str = ""
+
     # comma-separated list of usernames to ignore messages from
     IGNORE_SENDER_NAMES: str | list[str] = ""
 
@@ -37,7 +212,7 @@ class Settings(BaseSettings):
     NEGATIVE_FEEDBACK_EMOJIS: list[str] = ["👎", "😢", "😑", "😡"]
 
     model_config = SettingsConfigDict(
-        env_file=".env",
+        env_file=ENV_FILE,
         env_file_encoding="utf-8",
     )
 
@@ -49,14 +224,152 @@ class Settings(BaseSettings):
             v = [name.strip() for name in v.split(",")]
         return v
 
+    @field_validator("DISCORD_SHARD_IDS", mode="before")
+    @classmethod
+    def validate_DISCORD_SHARD_IDS(cls, v: str | list[int] | None) -> list[int] | None:
+        if not isinstance(v, str):
+            return v
+        if not v.strip():
+            return None
+        shard_ids = []
+        for part in v.split(","):
+            start, _, end = part.partition("-")
+            shard_ids.extend(range(int(start), int(end or start) + 1))
+        return shard_ids
+
     @field_validator("OPENAI_STARTING_PROMPT", mode="before")
     @classmethod
     def validate_OPENAI_STARTING_PROMPT(cls, v: str | list[str]) -> str:
         # multi-line strings don't load well from .env files, so we load directly from a separate
         # file instead
-        return open("initial_prompt.md").read().strip()
+        with open(PROMPT_FILE) as f:
+            return f.read().strip()
+
+
+class SettingsProvider:
+    """Holds the current `Settings` snapshot, and swaps in a new one when `.env`, the prompt file
+    or the per-server settings file change.
+
+    A reload builds and validates a complete new snapshot before swapping it in with a single
+    assignment, so readers never see a half-updated one and never need a lock. An invalid file
+    keeps the previous snapshot in place.
+
+    Only settings read while handling a message (prompt, models, ignore list, reply chances,
+    timeouts, etc.) take effect on reload; sizes and limits that were used to set up caches,
+    queues and connection pools at startup still need a restart.
+    """
+
+    def __init__(self):
+        started_at = time.perf_counter()
+        self.current = Settings()
+        startup_timer.record("settings", time.perf_counter() - started_at)
+        # values set while running (e.g. the bot's user ID once logged in), which carry over to
+        # every new snapshot
+        self.runtime_values: dict[str, Any] = {}
+        self.listeners: list[Callable[[], None]] = []
+        self.mtimes = self._mtimes()
+        self.task: asyncio.Task | None = None
+
+    def _mtimes(self) -> dict[str, float | None]:
+        mtimes: dict[str, float | None] = {}
+        for path in (ENV_FILE, PROMPT_FILE, self.current.GUILD_SETTINGS_FILE):
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def set_runtime_value(self, name: str, value: Any) -> None:
+        self.runtime_values[name] = value
+        setattr(self.current, name, value)
+
+    def on_reload(self, listener: Callable[[], None]) -> None:
+        """Call `listener` after every successful reload."""
+        self.listeners.append(listener)
+
+    def reload(self) -> bool:
+        try:
+            snapshot = Settings()
+        except Exception as e:
+            # validation errors, unparseable values (pydantic-settings' SettingsError), unreadable
+            # files, ...
+            logger.error(f"keeping the current settings, new ones are invalid: {e}")
+            return False
+        for name, value in self.runtime_values.items():
+            setattr(snapshot, name, value)
+
+        changed = [
+            name
+            for name in Settings.model_fields
+            if getattr(snapshot, name) != getattr(self.current, name)
+        ]
+        self.current = snapshot
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception as e:
+                logger.exception(f"settings reload listener failed: {e}")
+        logger.info("reloaded settings", changed=changed)
+        return True
+
+    def check_for_changes(self) -> bool:
+        """Reload if any of the watched files changed since the last check."""
+        mtimes = self._mtimes()
+        if mtimes == self.mtimes:
+            return False
+        self.mtimes = mtimes
+        return self.reload()
+
+    async def watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.check_for_changes()
+            except Exception as e:
+                # keep watching; the next change to the files gets another try
+                logger.exception(f"error checking settings files for changes: {e}")
+
+    def start(self) -> None:
+        if self.current.SETTINGS_RELOAD_INTERVAL_SECONDS <= 0 or self.task is not None:
+            return
+        self.task = asyncio.create_task(
+            self.watch(self.current.SETTINGS_RELOAD_INTERVAL_SECONDS)
+        )
+        logger.info(
+            "watching settings files for changes",
+            files=list(self.mtimes),
+            interval=self.current.SETTINGS_RELOAD_INTERVAL_SECONDS,
+        )
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        self.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.task
+        self.task = None
+
+
+class SettingsProxy:
+    """Stands in for `Settings` in every module's `settings = get_settings()`, reading each value
+    from whichever snapshot is current.
+    """
+
+    def __init__(self, provider: SettingsProvider):
+        object.__setattr__(self, "_provider", provider)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._provider.current, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        self._provider.set_runtime_value(name, value)
+
+
+@lru_cache
+def get_settings_provider() -> SettingsProvider:
+    return SettingsProvider()
 
 
 @lru_cache
-def get_settings():
-    return Settings()
+def get_settings() -> Settings:
+    return cast(Settings, SettingsProxy(get_settings_provider()))
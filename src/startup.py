@@ -0,0 +1,82 @@
+import asyncio
+import importlib
+import os
+import time
+
+import structlog
+
+logger = structlog.get_logger()
+
+# modules that are imported lazily on first use to keep startup fast, but that are worth loading
+# in the background once the bot is up so the first reply doesn't pay for them
+PRELOAD_MODULES = ("openai",)
+
+
+def process_uptime() -> float | None:
+    """Seconds since this process started, where the OS makes that available (Linux)."""
+    try:
+        with open("/proc/self/stat") as f:
+            # the command name can contain spaces, so count fields from the end of it
+            fields = f.read().rsplit(")", 1)[1].split()
+        started_ticks = int(fields[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started_ticks / os.sysconf(
+            "SC_CLK_TCK"
+        )
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupTimer:
+    """Breaks startup down into phases (imports, settings, login, gateway ready), each measured
+    from the end of the previous one. Phases that happen inside another one (settings are loaded
+    while modules are being imported) are recorded separately and not counted twice.
+    """
+
+    def __init__(self):
+        # count imports that happened before this module, when we can tell when the process
+        # started
+        self.started_at = time.perf_counter() - (process_uptime() or 0.0)
+        self.last_mark = self.started_at
+        self.nested = 0.0
+        self.phases: dict[str, float] = {}
+        self.reported = False
+
+    def record(self, phase: str, seconds: float) -> None:
+        """Record a phase that happened within the current one."""
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        self.nested += seconds
+
+    def mark(self, phase: str) -> None:
+        """End `phase`, which started when the previous phase ended."""
+        now = time.perf_counter()
+        self.phases[phase] = now - self.last_mark - self.nested
+        self.last_mark = now
+        self.nested = 0.0
+
+    def report(self) -> None:
+        if self.reported:
+            return
+        self.reported = True
+        logger.info(
+            f"started in {self.last_mark - self.started_at:.2f}s",
+            **{
+                f"{phase}_seconds": round(seconds, 3)
+                for phase, seconds in self.phases.items()
+            },
+        )
+
+
+async def preload_modules() -> None:
+    started_at = time.perf_counter()
+    for module in PRELOAD_MODULES:
+        try:
+            await asyncio.to_thread(importlib.import_module, module)
+        except ImportError as e:
+            logger.warning(f"couldn't preload {module}: {e}")
+    logger.debug(
+        f"preloaded {len(PRELOAD_MODULES)} module(s)",
+        seconds=round(time.perf_counter() - started_at, 3),
+    )
+
+
+startup_timer = StartupTimer()
@@ -0,0 +1,22 @@
+import sqlite3
+from pathlib import Path
+
+from src.settings import get_settings
+
+settings = get_settings()
+
+
+def connect_shared_db(path: str) -> sqlite3.Connection:
+    """Open (creating it if needed) one of the SQLite stores kept in DATA_DIR. The connection is
+    used from worker threads, so callers serialize access to it with their own lock.
+
+    Shard processes started by `src/launcher.py` share DATA_DIR, so the database is switched to WAL
+    mode to let readers and a writer from different processes overlap, and a write that still
+    collides with another process waits up to `SQLITE_BUSY_TIMEOUT_SECONDS` instead of failing.
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(
+        path, timeout=settings.SQLITE_BUSY_TIMEOUT_SECONDS, check_same_thread=False
+    )
+    db.execute("PRAGMA journal_mode=WAL")
+    return db